@@ -30,6 +30,7 @@ class ComplexPolicy(ModeEnum):
 class Transform(ModeEnum):
     SPECTRAL = "spectral"
     COSINE = "cosine"
+    ROW = "row"
     NONE = None
 
 
@@ -63,6 +63,10 @@ class Key:
         def spatial(cls) -> str:
             return "spatial"
 
+        @classmethod
+        def nhood_composition(cls, cluster: str, value: Optional[str] = None) -> str:
+            return f"{cluster}_nhood_composition" if value is None else value
+
     class uns:
         @cprop
         def spatial(cls) -> str:
@@ -76,6 +80,10 @@ class Key:
         def spatial_neighs(cls, value: Optional[str] = None) -> str:
             return f"{Key.obsm.spatial}_neighbors" if value is None else f"{value}_neighbors"
 
+        @classmethod
+        def spatial_index(cls, value: Optional[str] = None) -> str:
+            return f"{Key.obsm.spatial}_index" if value is None else f"{value}_index"
+
         @classmethod
         def ligrec(cls, cluster: str, value: Optional[str] = None) -> str:
             return f"{cluster}_ligrec" if value is None else value
@@ -89,8 +97,8 @@ class Key:
             return f"{cluster}_centrality_scores"
 
         @classmethod
-        def interaction_matrix(cls, cluster: str) -> str:
-            return f"{cluster}_interactions"
+        def interaction_matrix(cls, cluster: str, library_key: Optional[str] = None) -> str:
+            return f"{cluster}_interactions" if library_key is None else f"{cluster}_interactions_{library_key}"
 
         @classmethod
         def co_occurrence(cls, cluster: str) -> str:
@@ -43,6 +43,12 @@ seed
 _n_perms = """\
 n_perms
     Number of permutations for the permutation test."""
+_early_stopping = """\
+early_stopping
+    If not `None`, stop permuting an entry once this many permutations were at least as extreme as the observed
+    statistic and estimate its p-value as the ratio of this count to the number of permutations it used, as in
+    :cite:`besag1991`. The permutations are run in rounds and only the undecided entries are permuted further,
+    up to ``n_perms``."""
 _img_layer = """\
 layer
     Image layer in ``img`` that should be processed. If `None` and only 1 layer is present, it will be selected."""
@@ -119,6 +125,8 @@ If ``copy = True``, returns a :class:`dict` with following keys:
     - `'means'` - :class:`pandas.DataFrame` containing the mean expression.
     - `'pvalues'` - :class:`pandas.DataFrame` containing the possibly corrected p-values.
     - `'metadata'` - :class:`pandas.DataFrame` containing interaction metadata.
+    - `'n_perms'` - :class:`pandas.DataFrame` containing the number of permutations used for each p-value.
+      Only present if ``early_stopping != None``.
 
 Otherwise, modifies the ``adata`` object with the following key:
 
@@ -186,6 +194,7 @@ d = DocstringProcessor(
     numba_parallel=_numba_parallel,
     seed=_seed,
     n_perms=_n_perms,
+    early_stopping=_early_stopping,
     img_layer=_img_layer,
     feature_name=_feature_name,
     yx=_yx,
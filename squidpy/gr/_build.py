@@ -1,32 +1,37 @@
 """Functions for building graphs from spatial coordinates."""
 from __future__ import annotations
 
-from typing import List, Tuple, Union, Iterable  # noqa: F401
+from copy import deepcopy
+from typing import Union  # noqa: F401
+from typing import Any, Mapping, Callable, Iterable, Sequence
+from pathlib import Path
 from functools import partial
 from itertools import chain
+import tempfile
 import warnings
 
 from scanpy import logging as logg
-from anndata import AnnData
-from anndata.utils import make_index_unique
+from anndata import concat, AnnData
 
 from numba import njit
 from scipy.sparse import (
     spmatrix,
-    block_diag,
     csr_matrix,
     isspmatrix_csr,
     SparseEfficiencyWarning,
 )
 from scipy.spatial import Delaunay
-from sklearn.neighbors import NearestNeighbors
-from sklearn.metrics.pairwise import cosine_similarity, euclidean_distances
+from scipy.special import gamma
+from numpy.lib.format import open_memmap
 import numpy as np
 
 from squidpy._docs import d, inject_docs
-from squidpy._utils import NDArrayA
+from squidpy._utils import Signal, NDArrayA, SigQueue, parallelize, _get_n_cores
+from squidpy.gr._index import SpatialIndex, _get_spatial_index
 from squidpy.gr._utils import (
     _save_data,
+    _get_strata,
+    _assert_in_range,
     _assert_positive,
     _assert_spatial_basis,
     _assert_categorical_obs,
@@ -34,7 +39,9 @@ from squidpy.gr._utils import (
 from squidpy._constants._constants import CoordType, Transform
 from squidpy._constants._pkg_constants import Key
 
-__all__ = ["spatial_neighbors"]
+__all__ = ["spatial_neighbors", "update_spatial_neighbors"]
+
+_TILE_BYTES_PER_EDGE = 64  # neighbor index and distance, including the intermediate copies
 
 
 @d.dedent
@@ -44,15 +51,27 @@ def spatial_neighbors(
     spatial_key: str = Key.obsm.spatial,
     library_key: str | None = None,
     coord_type: str | CoordType | None = None,
-    n_neighs: int = 6,
+    n_neighs: int | Sequence[int] = 6,
     radius: float | tuple[float, float] | None = None,
     delaunay: bool = False,
     n_rings: int = 1,
+    percentile: float | None = None,
     transform: str | Transform | None = None,
     set_diag: bool = False,
     key_added: str = "spatial",
     copy: bool = False,
-) -> tuple[csr_matrix, csr_matrix] | None:
+    radii: Sequence[float] | None = None,
+    max_memory: float | None = None,
+    store: str | Path | None = None,
+    section_key: str | None = None,
+    section_offsets: Sequence[float] | Mapping[Any, float] | None = None,
+    z_radius: float | None = None,
+    store_index: bool = False,
+    dtype: np.dtype | type = np.float64,
+    n_jobs: int | None = None,
+    backend: str = "loky",
+    show_progress_bar: bool = False,
+) -> tuple[csr_matrix, csr_matrix] | dict[str, tuple[csr_matrix, csr_matrix]] | None:
     """
     Create a graph from spatial coordinates.
 
@@ -61,6 +80,7 @@ def spatial_neighbors(
     %(adata)s
     %(spatial_key)s
     %(library_key)s
+        The libraries are processed in parallel using ``n_jobs``.
     coord_type
         Type of coordinate system. Valid options are:
 
@@ -73,6 +93,7 @@ def spatial_neighbors(
 
             - `{c.GRID.s!r}` - number of neighboring tiles.
             - `{c.GENERIC.s!r}` - number of neighborhoods for non-grid data. Only used when ``delaunay = False``.
+              If a sequence, compute a graph for each number of neighbors, see ``radii``.
     radius
         Only available when ``coord_type = {c.GENERIC.s!r}``. Depending on the type:
 
@@ -82,31 +103,97 @@ def spatial_neighbors(
         Whether to compute the graph from Delaunay triangulation. Only used when ``coord_type = {c.GENERIC.s!r}``.
     n_rings
         Number of rings of neighbors for grid data. Only used when ``coord_type = {c.GRID.s!r}``.
+    percentile
+        Percentile of the Delaunay edge lengths above which the edges are removed, e.g. to prune the long edges
+        spanning the convex hull. Only used when ``coord_type = {c.GENERIC.s!r}`` and ``delaunay = True``.
     transform
         Type of adjacency matrix transform. Valid options are:
 
             - `{t.SPECTRAL.s!r}` - spectral transformation of the adjacency matrix.
             - `{t.COSINE.s!r}` - cosine transformation of the adjacency matrix.
+            - `{t.ROW.s!r}` - row-normalization of the adjacency matrix, such that the weights of each row sum
+              to `1`. :func:`squidpy.gr.spatial_autocorr` then doesn't need to normalize the graph again.
             - `{t.NONE.v}` - no transformation of the adjacency matrix.
     set_diag
         Whether to set the diagonal of the spatial connectivities to `1.0`.
     key_added
         Key which controls where the results are saved if ``copy = False``.
     %(copy)s
+    radii
+        Compute a graph for each radius, instead of using ``radius``. The neighbors are queried only once,
+        at the largest radius, and the other graphs are obtained by thresholding the distances. The graphs are saved
+        using ``key_added = '{{key_added}}_{{radius}}'``, the same applies to a sequence of ``n_neighs``.
+        Only available when ``coord_type = {c.GENERIC.s!r}`` and ``delaunay = False``.
+    max_memory
+        Approximate memory budget in MiB for querying the neighbors of one spatial tile. If not `None`, the plane
+        is split into tiles whose neighbors are queried independently and the graph is incrementally written
+        to ``store``, which is useful for graphs that do not fit into memory. The graph is the same as when
+        ``max_memory = None``. Only available when ``coord_type = {c.GENERIC.s!r}`` and ``delaunay = False``.
+    store
+        Directory where the tiled graph is saved as :mod:`numpy` memory-mapped arrays.
+        If `None`, use a temporary directory. Only used when ``max_memory != None``.
+    section_key
+        Key in :attr:`anndata.AnnData.obs` where the serial sections, e.g. of a z-stack, are stored as categorical.
+        If not `None`, ``spatial_key`` contains the in-plane coordinates of each section and the cells are also
+        connected across sections: two cells are neighbors if their in-plane distance is at most ``radius`` and the
+        distance of their sections is at most ``z_radius``. The distances are the 3D euclidean distances.
+        The section pairs are queried in parallel using ``n_jobs``. Only available when
+        ``coord_type = {c.GENERIC.s!r}``, ``delaunay = False`` and ``radius`` is a :class:`float`.
+    section_offsets
+        The z-offset of each section, either in the order of the categories or as a mapping from the categories.
+        If `None`, the sections are assumed to be `1` apart, in the order of the categories.
+        Only used when ``section_key != None``.
+    z_radius
+        Maximum distance between the z-offsets of two connected sections. If `None`, use ``radius``.
+        Only used when ``section_key != None``.
+    store_index
+        Whether to save the spatial index of the coordinates in :attr:`anndata.AnnData.uns`, such that
+        :func:`squidpy.gr.sepal`, :func:`squidpy.gr.co_occurrence` and :func:`squidpy.gr.update_spatial_neighbors`
+        reuse it instead of building it again.
+        Only used when ``copy = False`` and the index is built, i.e. ``delaunay = False`` and ``library_key = None``.
+    dtype
+        Floating point data type of the spatial connectivities and distances, e.g. :class:`numpy.float32`
+        to halve the memory of the stored values.
+    %(parallelize)s
 
     Returns
     -------
     If ``copy = True``, returns a :class:`tuple` with the spatial connectivities and distances matrices.
+    If ``radii`` is not `None` or ``n_neighs`` is a sequence, returns a :class:`dict` mapping each
+    ``'{{key_added}}_{{scale}}'`` to such a :class:`tuple`.
 
     Otherwise, modifies the ``adata`` with the following keys:
 
         - :attr:`anndata.AnnData.obsp` ``['{{key_added}}_connectivities']`` - the spatial connectivities.
         - :attr:`anndata.AnnData.obsp` ``['{{key_added}}_distances']`` - the spatial distances.
         - :attr:`anndata.AnnData.uns`  ``['{{key_added}}']`` - :class:`dict` containing parameters.
+        - :attr:`anndata.AnnData.uns`  ``['{{spatial_key}}_index']`` - the spatial index, if ``store_index = True``.
     """
+    scales: list[float] | list[int] | None = None
+    if radii is not None:
+        if radius is not None:
+            raise ValueError("Expected only one of `radius` or `radii`, found both.")
+        if not isinstance(n_neighs, (int, np.integer)):
+            raise ValueError("Expected only one of `radii` or `n_neighs` to be a sequence.")
+        scales = list(radii)
+    elif not isinstance(n_neighs, (int, np.integer)):
+        if radius is not None:
+            raise ValueError("Expected only one of `radius` or `n_neighs` to be set, when `n_neighs` is a sequence.")
+        scales = list(n_neighs)
+    if scales is not None:
+        if not len(scales):
+            raise ValueError("Expected at least one `radii` or `n_neighs`, found none.")
+        for scale in scales:
+            _assert_positive(scale, name="radii" if radii is not None else "n_neighs")
+    else:
+        _assert_positive(n_neighs, name="n_neighs")  # type: ignore[arg-type]
     _assert_positive(n_rings, name="n_rings")
-    _assert_positive(n_neighs, name="n_neighs")
     _assert_spatial_basis(adata, spatial_key)
+    if percentile is not None:
+        _assert_in_range(percentile, 0, 100, name="percentile")
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.floating):
+        raise TypeError(f"Expected `dtype` to be a floating point type, found `{dtype}`.")
 
     transform = Transform.NONE if transform is None else Transform(transform)
     if coord_type is None:
@@ -122,137 +209,1140 @@ def spatial_neighbors(
     if library_key is not None:
         _assert_categorical_obs(adata, key=library_key)
         libs = adata.obs[library_key].cat.categories
-        make_index_unique(adata.obs_names)
     else:
         libs = [None]
 
+    if scales is not None and (coord_type != CoordType.GENERIC or delaunay):
+        raise NotImplementedError(
+            f"Graphs for multiple `radii` or `n_neighs` are only available for `coord_type = {CoordType.GENERIC!r}` "
+            f"and `delaunay = False`."
+        )
+    if max_memory is not None:
+        _assert_positive(max_memory, name="max_memory")
+        if scales is not None:
+            raise NotImplementedError("Tiled graph creation for multiple `radii` or `n_neighs` is not yet implemented.")
+        if coord_type != CoordType.GENERIC or delaunay:
+            raise NotImplementedError(
+                f"Tiled graph creation is only available for `coord_type = {CoordType.GENERIC!r}` "
+                f"and `delaunay = False`."
+            )
+        if transform == Transform.COSINE:
+            raise NotImplementedError(f"Tiled graph creation with transform `{transform}` is not yet implemented.")
+        if library_key is not None:
+            raise NotImplementedError("Tiled graph creation with `library_key` is not yet implemented.")
+    if section_key is not None:
+        _assert_categorical_obs(adata, key=section_key)
+        if coord_type != CoordType.GENERIC or delaunay or not isinstance(radius, (int, float)):
+            raise NotImplementedError(
+                f"Graph creation across sections is only available for `coord_type = {CoordType.GENERIC!r}`, "
+                f"`delaunay = False` and `radius` of type `float`."
+            )
+        if library_key is not None or max_memory is not None:
+            raise NotImplementedError(
+                "Graph creation across sections with `library_key` or `max_memory` is not yet implemented."
+            )
+        z_radius = radius if z_radius is None else z_radius
+        _assert_positive(z_radius, name="z_radius")
+
     start = logg.info(
         f"Creating graph using `{coord_type}` coordinates and `{transform}` transform and `{len(libs)}` libraries."
     )
-    _build_fun = partial(
-        _spatial_neighbor,
-        spatial_key=spatial_key,
-        coord_type=coord_type,
-        n_neighs=n_neighs,
-        radius=radius,
-        delaunay=delaunay,
-        n_rings=n_rings,
-        transform=transform,
-        set_diag=set_diag,
-    )
-
-    if library_key is not None:
-        mats: List[Tuple[spmatrix, spmatrix]] = []
-        ixs = []
-        for lib in libs:
-            ixs.extend(np.where(adata.obs[library_key] == lib)[0])
-            mats.append(_build_fun(adata[adata.obs[library_key] == lib]))
-        ixs = np.argsort(ixs)  # type: ignore[assignment] # invert
-        Adj = block_diag([m[0] for m in mats], format="csr")[ixs, :][:, ixs]
-        Dst = block_diag([m[1] for m in mats], format="csr")[ixs, :][:, ixs]
+    if scales is None:
+        _build_fun = partial(
+            _spatial_neighbor,
+            coord_type=coord_type,
+            n_neighs=n_neighs,
+            radius=radius,
+            delaunay=delaunay,
+            n_rings=n_rings,
+            percentile=percentile,
+            transform=transform,
+            set_diag=set_diag,
+            dtype=dtype,
+        )
     else:
-        Adj, Dst = _build_fun(adata)
+        _build_fun = partial(
+            _spatial_neighbor_family,
+            n_neighs=n_neighs,
+            radius=None if radii is None else scales,
+            transform=transform,
+            set_diag=set_diag,
+            dtype=dtype,
+        )
+    n_scales = 1 if scales is None else len(scales)
 
-    neighs_key = Key.uns.spatial_neighs(key_added)
-    conns_key = Key.obsp.spatial_conn(key_added)
-    dists_key = Key.obsp.spatial_dist(key_added)
+    coords = adata.obsm[spatial_key]
+    if section_key is not None:
+        sections = adata.obs[section_key].cat
+        Adj, Dst = _build_sections(
+            coords,
+            sections=sections.codes.values,
+            offsets=_section_offsets(sections.categories, section_offsets),
+            radius=radius,  # type: ignore[arg-type]
+            z_radius=z_radius,  # type: ignore[arg-type]
+            set_diag=set_diag,
+            dtype=dtype,
+            n_jobs=n_jobs,
+            backend=backend,
+            show_progress_bar=show_progress_bar,
+        )
+        graphs = [(_transform_adj(Adj, transform), Dst)]
+    elif max_memory is not None:
+        Adj, Dst = _build_tiled(
+            coords,
+            n_neighs=n_neighs,  # type: ignore[arg-type]
+            radius=radius,  # type: ignore[arg-type]
+            set_diag=set_diag,
+            max_memory=max_memory,
+            store=store,
+            dtype=dtype,
+        )
+        # the transforms other than cosine are applied in place, i.e. in the memory-mapped array
+        graphs = [(_transform_adj(Adj, transform), Dst)]
+    elif library_key is not None:
+        # the observations without a library are not connected
+        ixs = _get_strata(adata.obs[library_key].cat.codes.values, n_strata=len(libs))
+        ixs = [ix for ix in ixs if len(ix)]
 
-    neighbors_dict = {
-        "connectivities_key": conns_key,
-        "distances_key": dists_key,
-        "params": {"n_neighbors": n_neighs, "coord_type": coord_type.v, "radius": radius, "transform": transform.v},
-    }
+        n_jobs = _get_n_cores(n_jobs)
+        mats = list(
+            parallelize(
+                _spatial_neighbor_helper,
+                collection=ixs,
+                extractor=chain.from_iterable,
+                n_jobs=n_jobs,
+                backend=backend,
+                unit="library",
+                show_progress_bar=show_progress_bar,
+            )(coords=coords, build_fun=_build_fun)
+        )
+        if scales is None:
+            mats = [[m] for m in mats]
+        graphs = [
+            (
+                _scatter_csr([m[s][0] for m in mats], ixs, n_obs=adata.n_obs),
+                _scatter_csr([m[s][1] for m in mats], ixs, n_obs=adata.n_obs),
+            )
+            for s in range(n_scales)
+        ]
+    else:
+        # the index is reused by the other functions, as long as the coordinates don't change
+        index = None if delaunay else _get_spatial_index(adata, spatial_key)
+        graphs = _build_fun(coords, index=index)
+        graphs = graphs if scales is not None else [graphs]
+        if index is not None and store_index and not copy:
+            adata.uns[Key.uns.spatial_index(spatial_key)] = index.to_dict()
+
+    if scales is None:
+        keys, params = [key_added], [(n_neighs, radius)]
+    elif radii is not None:
+        keys, params = [f"{key_added}_{r}" for r in scales], [(n_neighs, r) for r in scales]
+    else:
+        keys, params = [f"{key_added}_{n}" for n in scales], [(n, radius) for n in scales]
 
     if copy:
-        return Adj, Dst
+        return graphs[0] if scales is None else dict(zip(keys, graphs))
 
-    _save_data(adata, attr="obsp", key=conns_key, data=Adj)
-    _save_data(adata, attr="obsp", key=dists_key, data=Dst, prefix=False)
-    _save_data(adata, attr="uns", key=neighs_key, data=neighbors_dict, prefix=False, time=start)
+    for key, (n, r), (Adj, Dst) in zip(keys, params, graphs):
+        neighs_key = Key.uns.spatial_neighs(key)
+        conns_key = Key.obsp.spatial_conn(key)
+        dists_key = Key.obsp.spatial_dist(key)
 
+        neighbors_dict = {
+            "connectivities_key": conns_key,
+            "distances_key": dists_key,
+            "params": {
+                "n_neighbors": n,
+                "coord_type": coord_type.v,
+                "radius": r,
+                "transform": transform.v,
+                "delaunay": delaunay,
+                "set_diag": set_diag,
+            },
+        }
+        if library_key is not None:
+            neighbors_dict["params"]["library_key"] = library_key
+        if section_key is not None:
+            neighbors_dict["params"].update({"section_key": section_key, "z_radius": z_radius})
 
-def _spatial_neighbor(
+        _save_data(adata, attr="obsp", key=conns_key, data=Adj)
+        _save_data(adata, attr="obsp", key=dists_key, data=Dst, prefix=False)
+        _save_data(adata, attr="uns", key=neighs_key, data=neighbors_dict, prefix=False, time=start)
+
+
+@d.dedent
+def update_spatial_neighbors(
     adata: AnnData,
+    added: AnnData | None = None,
+    removed: Sequence[int] | NDArrayA | None = None,
     spatial_key: str = Key.obsm.spatial,
+    key_added: str = "spatial",
+) -> AnnData:
+    """
+    Update the spatial graph after adding or removing observations, without rebuilding it.
+
+    Only the neighborhoods which can change are queried again, i.e. the ones near the added or the removed
+    observations, using the spatial index of ``adata``, see ``store_index`` in :func:`squidpy.gr.spatial_neighbors`.
+    The rest of the graph is copied, so the graph is the same as when building it from scratch.
+
+    Parameters
+    ----------
+    %(adata)s
+        It must contain the graph computed by :func:`squidpy.gr.spatial_neighbors` with
+        ``coord_type = 'generic'``, ``delaunay = False``, no ``transform`` and without ``library_key``
+        or ``section_key``.
+    added
+        Observations to add. Their coordinates are in :attr:`anndata.AnnData.obsm` ``['{{spatial_key}}']``.
+    removed
+        Indices or boolean mask of the observations in ``adata`` to remove.
+    %(spatial_key)s
+    key_added
+        Key of the graph, as in :func:`squidpy.gr.spatial_neighbors`.
+
+    Returns
+    -------
+    New annotated data object containing the observations of ``adata`` which were not removed, in their order,
+    followed by the observations of ``added``. The graph is saved in the same keys as in ``adata``:
+
+        - :attr:`anndata.AnnData.obsp` ``['{{key_added}}_connectivities']`` - the spatial connectivities.
+        - :attr:`anndata.AnnData.obsp` ``['{{key_added}}_distances']`` - the spatial distances.
+        - :attr:`anndata.AnnData.uns`  ``['{{key_added}}']`` - :class:`dict` containing parameters.
+    """
+    _assert_spatial_basis(adata, spatial_key)
+    if added is not None:
+        _assert_spatial_basis(added, spatial_key)
+    neighs_key = Key.uns.spatial_neighs(key_added)
+    if neighs_key not in adata.uns:
+        raise KeyError(f"Spatial graph key `{neighs_key}` not found in `adata.uns`. Please run `spatial_neighbors`.")
+    neighbors_dict = adata.uns[neighs_key]
+    params = neighbors_dict["params"]
+    if "set_diag" not in params or "delaunay" not in params:
+        raise ValueError("Unable to find all parameters of the spatial graph. Please run `spatial_neighbors` again.")
+    if (
+        params["coord_type"] != CoordType.GENERIC.v
+        or params["delaunay"]
+        or params["transform"] != Transform.NONE.v
+        or "library_key" in params
+        or "section_key" in params
+    ):
+        raise NotImplementedError(
+            f"Updating the graph is only available for `coord_type = {CoordType.GENERIC!r}`, `delaunay = False`, "
+            f"`transform = {Transform.NONE!r}` and without `library_key` or `section_key`."
+        )
+
+    removed = np.zeros((0,), dtype=np.int64) if removed is None else np.asarray(removed)
+    if removed.dtype == bool:
+        if removed.shape != (adata.n_obs,):
+            raise ValueError(f"Expected the mask of the removed observations to be of shape `({adata.n_obs},)`.")
+        removed = np.flatnonzero(removed)
+    removed = np.unique(removed.astype(np.int64))
+    keep = np.ones((adata.n_obs,), dtype=bool)
+    keep[removed] = False
+    radius = params["radius"]
+    if radius is not None and np.ndim(radius):
+        radius = tuple(radius)
+
+    start = logg.info(
+        f"Updating graph with `{0 if added is None else added.n_obs}` added and `{len(removed)}` removed observations"
+    )
+    Adj, Dst = _update_spatial_neighbors(
+        adata.obsp[neighbors_dict["connectivities_key"]],
+        adata.obsp[neighbors_dict["distances_key"]],
+        adata.obsm[spatial_key],
+        new_coords=None if added is None else added.obsm[spatial_key],
+        removed=removed,
+        n_neighs=params["n_neighbors"],
+        radius=radius,
+        set_diag=bool(params["set_diag"]),
+        index=_get_spatial_index(adata, spatial_key),
+    )
+
+    res = concat([adata[keep]] + ([] if added is None else [added]), merge="same")
+    # the stored index doesn't match the new coordinates
+    res.uns = deepcopy({k: v for k, v in adata.uns.items() if k != Key.uns.spatial_index(spatial_key)})
+    _save_data(res, attr="obsp", key=neighbors_dict["connectivities_key"], data=Adj)
+    _save_data(res, attr="obsp", key=neighbors_dict["distances_key"], data=Dst, prefix=False)
+    _save_data(res, attr="uns", key=neighs_key, data=res.uns[neighs_key], prefix=False, time=start)
+
+    return res
+
+
+def _spatial_neighbor(
+    coords: NDArrayA,
     coord_type: str | CoordType | None = None,
     n_neighs: int = 6,
     radius: float | tuple[float, float] | None = None,
     delaunay: bool = False,
     n_rings: int = 1,
+    percentile: float | None = None,
     transform: str | Transform | None = None,
     set_diag: bool = False,
+    dtype: np.dtype | type = np.float64,
+    index: SpatialIndex | None = None,
 ) -> tuple[csr_matrix, csr_matrix]:
-    coords = adata.obsm[spatial_key]
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", SparseEfficiencyWarning)
         if coord_type == CoordType.GRID:
-            Adj, Dst = _build_grid(coords, n_neighs=n_neighs, n_rings=n_rings, delaunay=delaunay, set_diag=set_diag)
+            Adj, Dst = _build_grid(
+                coords,
+                n_neighs=n_neighs,
+                n_rings=n_rings,
+                delaunay=delaunay,
+                set_diag=set_diag,
+                dtype=dtype,
+                index=index,
+            )
         elif coord_type == CoordType.GENERIC:
             Adj, Dst = _build_connectivity(
-                coords, n_neighs=n_neighs, radius=radius, delaunay=delaunay, return_distance=True, set_diag=set_diag
+                coords,
+                n_neighs=n_neighs,
+                radius=radius,
+                delaunay=delaunay,
+                return_distance=True,
+                set_diag=set_diag,
+                percentile=percentile,
+                dtype=dtype,
+                index=index,
             )
         else:
             raise NotImplementedError(f"Coordinate type `{coord_type}` is not yet implemented.")
 
-    if coord_type == CoordType.GENERIC and isinstance(radius, Iterable):
-        minn, maxx = sorted(radius)[:2]  # type: ignore[var-annotated]
-        mask = (Dst.data < minn) | (Dst.data > maxx)
-        a_diag = Adj.diagonal()
+    return _transform_adj(Adj, transform), Dst
 
-        Dst.data[mask] = 0.0
-        Adj.data[mask] = 0.0
-        Adj.setdiag(a_diag)
 
-    Adj.eliminate_zeros()
-    Dst.eliminate_zeros()
+def _spatial_neighbor_family(
+    coords: NDArrayA,
+    n_neighs: int | Sequence[int] = 6,
+    radius: list[float] | None = None,
+    transform: str | Transform | None = None,
+    set_diag: bool = False,
+    dtype: np.dtype | type = np.float64,
+    index: SpatialIndex | None = None,
+) -> list[tuple[csr_matrix, csr_matrix]]:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", SparseEfficiencyWarning)
+        graphs = _build_connectivity_family(
+            coords, n_neighs=n_neighs, radius=radius, set_diag=set_diag, dtype=dtype, index=index
+        )
 
+    return [(_transform_adj(Adj, transform), Dst) for Adj, Dst in graphs]
+
+
+def _transform_adj(Adj: csr_matrix, transform: str | Transform | None = None) -> csr_matrix:
     # check transform
     if transform == Transform.SPECTRAL:
         Adj = _transform_a_spectral(Adj)
     elif transform == Transform.COSINE:
         Adj = _transform_a_cosine(Adj)
+    elif transform == Transform.ROW:
+        Adj = _transform_a_row(Adj)
     elif transform == Transform.NONE:
         pass
     else:
         raise NotImplementedError(f"Transform `{transform}` is not yet implemented.")
 
+    return Adj
+
+
+def _spatial_neighbor_helper(
+    ixs: Sequence[NDArrayA],
+    coords: NDArrayA,
+    build_fun: Callable[[NDArrayA], tuple[csr_matrix, csr_matrix]],
+    queue: SigQueue | None = None,
+) -> list[tuple[csr_matrix, csr_matrix]]:
+    res = []
+    for ix in ixs:
+        res.append(build_fun(coords[ix]))
+
+        if queue is not None:
+            queue.put(Signal.UPDATE)
+
+    if queue is not None:
+        queue.put(Signal.FINISH)
+
+    return res
+
+
+def _scatter_csr(mats: Sequence[csr_matrix], ixs: Sequence[NDArrayA], n_obs: int) -> csr_matrix:
+    """
+    Place the per-library graphs into one graph over all observations.
+
+    Parameters
+    ----------
+    mats
+        Graphs of the individual libraries.
+    ixs
+        Sorted global indices of the observations of each library.
+    n_obs
+        Total number of observations.
+
+    Returns
+    -------
+    Graph of shape ``(n_obs, n_obs)`` whose rows are in the original order of the observations.
+    """
+    counts = np.zeros((n_obs + 1,), dtype=np.int64)
+    for m, ix in zip(mats, ixs):
+        counts[ix + 1] = np.diff(m.indptr)
+    nnz = counts.sum()
+
+    idx_dtype = np.int32 if max(nnz, n_obs) <= np.iinfo(np.int32).max else np.int64
+    indptr = np.cumsum(counts, dtype=idx_dtype)
+    indices = np.empty((nnz,), dtype=idx_dtype)
+    data = np.empty((nnz,), dtype=np.result_type(*(m.dtype for m in mats)) if len(mats) else np.float64)
+
+    for m, ix in zip(mats, ixs):
+        # `ix` is sorted, so the mapped column indices stay sorted within each row
+        lengths = np.diff(m.indptr)
+        dest = np.repeat(indptr[ix] - m.indptr[:-1], lengths) + np.arange(m.nnz)
+        indices[dest] = ix[m.indices]
+        data[dest] = m.data
+
+    return csr_matrix((data, indices, indptr), shape=(n_obs, n_obs))
+
+
+def _section_offsets(
+    categories: Sequence[Any], offsets: Sequence[float] | Mapping[Any, float] | None = None
+) -> NDArrayA:
+    if offsets is None:
+        return np.arange(len(categories), dtype=np.float64)
+    if isinstance(offsets, Mapping):
+        missing = [c for c in categories if c not in offsets]
+        if missing:
+            raise KeyError(f"Unable to find the z-offsets of sections `{missing}`.")
+        offsets = [offsets[c] for c in categories]
+    offsets = np.asarray(offsets, dtype=np.float64)
+    if offsets.shape != (len(categories),):
+        raise ValueError(f"Expected `{len(categories)}` section offsets, found `{offsets.shape}`.")
+
+    return offsets
+
+
+def _build_sections(
+    coords: NDArrayA,
+    sections: NDArrayA,
+    offsets: NDArrayA,
+    radius: float,
+    z_radius: float,
+    set_diag: bool = False,
+    dtype: np.dtype | type = np.float64,
+    n_jobs: int | None = None,
+    backend: str = "loky",
+    show_progress_bar: bool = False,
+) -> tuple[csr_matrix, csr_matrix]:
+    """
+    Build the radius graph of serial sections, connecting the cells within and across the nearby sections.
+
+    Parameters
+    ----------
+    coords
+        Array of shape ``(n_obs, n_dims)`` containing the in-plane coordinates.
+    sections
+        Array of shape ``(n_obs,)`` containing the section codes, `-1` for the cells without a section.
+    offsets
+        Array of shape ``(n_sections,)`` containing the z-offset of each section.
+    radius
+        Maximum in-plane distance of the neighbors.
+    z_radius
+        Maximum distance of the z-offsets of the neighboring sections.
+    set_diag
+        Whether to set the diagonal of the connectivities to `1.0`.
+    dtype
+        Data type of the connectivities and distances.
+    n_jobs
+        Number of parallel jobs.
+    backend
+        Parallelization backend to use.
+    show_progress_bar
+        Whether to show the progress bar.
+
+    Returns
+    -------
+    The connectivities and the 3D distances. Each section builds one spatial index that is queried by
+    the section itself and by the sections below it within ``z_radius``, so that the number of queries
+    grows linearly with the number of sections.
+    """
+    n_obs = coords.shape[0]
+    ixs = _get_strata(sections, n_strata=len(offsets))
+
+    # each unordered pair of sections is queried once, by the section with the larger code
+    pairs = [
+        (b, [a for a in range(b + 1) if len(ixs[a]) and abs(offsets[a] - offsets[b]) <= z_radius])
+        for b in range(len(offsets))
+        if len(ixs[b])
+    ]
+    n_jobs = _get_n_cores(n_jobs)
+    edges = parallelize(
+        _section_pairs_helper,
+        collection=pairs,
+        extractor=lambda res: list(chain.from_iterable(res)),
+        n_jobs=n_jobs,
+        backend=backend,
+        unit="section",
+        show_progress_bar=show_progress_bar,
+    )(coords=coords, ixs=ixs, offsets=offsets, radius=radius)
+
+    rows = [e[0] for e in edges]
+    cols = [e[1] for e in edges]
+    dists = [e[2] for e in edges]
+    if set_diag:
+        diag = np.flatnonzero(sections >= 0)
+        rows.append(diag)
+        cols.append(diag)
+        dists.append(np.zeros((len(diag),)))
+    rows = np.concatenate(rows) if len(rows) else np.zeros((0,), dtype=np.int64)
+    cols = np.concatenate(cols) if len(cols) else np.zeros((0,), dtype=np.int64)
+    dists = np.concatenate(dists) if len(dists) else np.zeros((0,))
+
+    nnz = len(rows)
+    idx_dtype = np.int32 if max(nnz, n_obs) <= np.iinfo(np.int32).max else np.int64
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_obs))]).astype(idx_dtype)
+    indices = cols[order].astype(idx_dtype)
+
+    Adj = csr_matrix((np.ones((nnz,), dtype=dtype), indices, indptr), shape=(n_obs, n_obs))
+    Dst = csr_matrix((dists[order].astype(dtype, copy=False), indices, indptr), shape=(n_obs, n_obs))
+    Adj.has_sorted_indices = Dst.has_sorted_indices = True
+
     return Adj, Dst
 
 
+def _section_pairs_helper(
+    pairs: Sequence[tuple[int, Sequence[int]]],
+    coords: NDArrayA,
+    ixs: Sequence[NDArrayA],
+    offsets: NDArrayA,
+    radius: float,
+    queue: SigQueue | None = None,
+) -> list[tuple[NDArrayA, NDArrayA, NDArrayA]]:
+    res = []
+    for b, sections in pairs:
+        index = SpatialIndex(coords[ixs[b]])
+        for a in sections:
+            if a == b:
+                dists, neighs, ptr = index.radius_neighbors(radius=radius)
+                res.append((ixs[b][neighs], np.repeat(ixs[b], np.diff(ptr)), dists))
+                continue
+
+            dists, neighs, ptr = index.radius_neighbors(coords[ixs[a]], radius=radius)
+            dists = np.sqrt(dists**2 + (offsets[a] - offsets[b]) ** 2)
+            neighs, queries = ixs[b][neighs], np.repeat(ixs[a], np.diff(ptr))
+            # neighbor `j` of query `i` is stored in row `j`, column `i`, the other direction is symmetric
+            res.append((neighs, queries, dists))
+            res.append((queries, neighs, dists))
+
+        if queue is not None:
+            queue.put(Signal.UPDATE)
+
+    if queue is not None:
+        queue.put(Signal.FINISH)
+
+    return res
+
+
 def _build_grid(
-    coords: NDArrayA, n_neighs: int, n_rings: int, delaunay: bool = False, set_diag: bool = False
+    coords: NDArrayA,
+    n_neighs: int,
+    n_rings: int,
+    delaunay: bool = False,
+    set_diag: bool = False,
+    dtype: np.dtype | type = np.float64,
+    index: SpatialIndex | None = None,
 ) -> tuple[csr_matrix, csr_matrix]:
     if n_rings > 1:
         Adj: csr_matrix = _build_connectivity(
             coords,
             n_neighs=n_neighs,
             neigh_correct=True,
-            set_diag=True,
             delaunay=delaunay,
             return_distance=False,
+            dtype=dtype,
+            index=index,
         )
-        Res, Walk = Adj, Adj
-        for i in range(n_rings - 1):
-            Walk = Walk @ Adj
-            Walk[Res.nonzero()] = 0.0
-            Walk.eliminate_zeros()
-            Walk.data[:] = i + 2.0
-            Res = Res + Walk
-        Adj = Res
-        Adj.setdiag(float(set_diag))
-        Adj.eliminate_zeros()
+        Adj = _build_rings(Adj, n_rings=n_rings, set_diag=set_diag, dtype=dtype)
 
         Dst = Adj.copy()
         Adj.data[:] = 1.0
     else:
-        Adj = _build_connectivity(coords, n_neighs=n_neighs, neigh_correct=True, delaunay=delaunay, set_diag=set_diag)
+        Adj = _build_connectivity(
+            coords,
+            n_neighs=n_neighs,
+            neigh_correct=True,
+            delaunay=delaunay,
+            set_diag=set_diag,
+            dtype=dtype,
+            index=index,
+        )
         Dst = Adj.copy()
 
     Dst.setdiag(0.0)
+    Dst.eliminate_zeros()
 
     return Adj, Dst
 
 
+def _build_tiled(
+    coords: NDArrayA,
+    n_neighs: int,
+    radius: float | tuple[float, float] | None = None,
+    set_diag: bool = False,
+    max_memory: float = 1024,
+    store: str | Path | None = None,
+    dtype: np.dtype | type = np.float64,
+) -> tuple[csr_matrix, csr_matrix]:
+    """
+    Build the graph from spatial tiles and write it incrementally to disk.
+
+    The neighbors of the observations in each tile are queried against the observations in the tile and its halo.
+    For radius graphs, the halo is the radius. For kNN graphs, the halo is doubled until the :math:`k`-th neighbor
+    of each observation is closer than the boundary of the halo, which makes the result exact.
+
+    Parameters
+    ----------
+    coords
+        Array of shape ``(n_obs, n_dims)`` containing the coordinates.
+    n_neighs
+        Number of neighbors. Only used when ``radius = None``.
+    radius
+        Radius or the ``[min, max]`` distance interval.
+    set_diag
+        Whether to set the diagonal of the connectivities to `1.0`.
+    max_memory
+        Approximate memory budget in MiB for the neighbor queries of one tile.
+    store
+        Directory where the graph is saved. If `None`, use a temporary directory.
+    dtype
+        Data type of the connectivities and distances.
+
+    Returns
+    -------
+    The connectivities and distances, backed by the memory-mapped arrays in ``store``.
+    """
+    store = Path(tempfile.mkdtemp(prefix="squidpy_")) if store is None else Path(store)
+    tiles_dir = store / "tiles"
+    tiles_dir.mkdir(parents=True, exist_ok=True)
+
+    coords = np.asarray(coords)
+    n_obs, n_dims = coords.shape
+    lo, hi = coords.min(axis=0), coords.max(axis=0)
+    extent = np.maximum(hi - lo, np.finfo(np.float32).eps * max(1.0, np.max(hi - lo)))
+    # volume of the unit ball, used to estimate the number of neighbors from the density
+    unit_volume = np.pi ** (n_dims / 2.0) / gamma(n_dims / 2.0 + 1.0)
+    density = n_obs / np.prod(extent)
+
+    min_dist, max_dist = -np.inf, np.inf
+    if radius is None:
+        halo = 2.0 * (n_neighs / density / unit_volume) ** (1.0 / n_dims)
+        n_edges = n_neighs + 1.0
+    else:
+        halo = radius if isinstance(radius, (int, float)) else max(radius)
+        n_edges = max(1.0, density * unit_volume * halo**n_dims)
+        if isinstance(radius, Iterable):
+            min_dist, max_dist = sorted(radius)[:2]  # type: ignore[var-annotated]
+
+    obs_per_tile = max(1, int(max_memory * 1024**2 / (n_edges * _TILE_BYTES_PER_EDGE)))
+    n_tiles = max(1, int(np.ceil((n_obs / obs_per_tile) ** (1.0 / n_dims))))
+    tile_size = extent / n_tiles
+    shape = (n_tiles,) * n_dims
+    tile_ids = np.ravel_multi_index(
+        np.clip(((coords - lo) / tile_size).astype(np.int64), 0, n_tiles - 1).T, shape  # type: ignore[arg-type]
+    )
+    order = np.argsort(tile_ids, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(tile_ids, minlength=n_tiles**n_dims))])
+
+    def reference(box_lo: NDArrayA, box_hi: NDArrayA) -> NDArrayA:
+        tile_lo = np.clip(np.floor((box_lo - lo) / tile_size).astype(np.int64), 0, n_tiles - 1)
+        tile_hi = np.clip(np.floor((box_hi - lo) / tile_size).astype(np.int64), 0, n_tiles - 1)
+        tiles = np.ravel_multi_index(
+            np.stack(np.meshgrid(*(np.arange(a, b + 1) for a, b in zip(tile_lo, tile_hi)))).reshape(n_dims, -1), shape
+        )
+        ixs = np.concatenate([order[bounds[t] : bounds[t + 1]] for t in tiles])
+        mask = np.all((coords[ixs] >= box_lo) & (coords[ixs] <= box_hi), axis=1)
+        return ixs[mask]  # type: ignore[no-any-return]
+
+    counts = np.zeros((n_obs + 1,), dtype=np.int64)
+    pieces = []
+    for t in range(len(bounds) - 1):
+        core = order[bounds[t] : bounds[t + 1]]
+        if not len(core):
+            continue
+        box_lo = lo + np.array(np.unravel_index(t, shape)) * tile_size
+        box_hi = box_lo + tile_size
+        if radius is None:
+            queries, neighs, offsets, dists = _query_tile_knn(
+                coords, core, box_lo, box_hi, lo, hi, n_neighs=n_neighs, halo=halo, reference=reference
+            )
+        else:
+            ref = reference(box_lo - halo, box_hi + halo)
+            dists, neighs, offsets = SpatialIndex(coords[ref]).radius_neighbors(coords[core], radius=halo)
+            queries, neighs = core, ref[neighs]
+
+        _count_neighbors(queries, neighs, offsets, dists, min_dist, max_dist, set_diag, counts[1:])
+        piece = tiles_dir / f"{t}.npz"
+        np.savez(piece, queries=queries, neighs=neighs, offsets=offsets, dists=dists)
+        pieces.append(piece)
+
+    nnz = counts.sum()
+    idx_dtype = np.int32 if max(nnz, n_obs) <= np.iinfo(np.int32).max else np.int64
+    indptr = open_memmap(store / "indptr.npy", mode="w+", dtype=idx_dtype, shape=(n_obs + 1,))
+    indptr[:] = np.cumsum(counts)
+    indices = open_memmap(store / "indices.npy", mode="w+", dtype=idx_dtype, shape=(nnz,))
+    adj = open_memmap(store / "connectivities.npy", mode="w+", dtype=dtype, shape=(nnz,))
+    dst = open_memmap(store / "distances.npy", mode="w+", dtype=dtype, shape=(nnz,))
+
+    pos = np.array(indptr[:-1], dtype=np.int64)
+    for piece in pieces:
+        with np.load(piece) as p:
+            _fill_neighbors(
+                p["queries"],
+                p["neighs"],
+                p["offsets"],
+                p["dists"],
+                min_dist,
+                max_dist,
+                set_diag,
+                pos,
+                indices,
+                adj,
+                dst,
+            )
+        piece.unlink()
+    tiles_dir.rmdir()
+
+    # the tiles are not visited in the order of the observations, sort the columns in blocks of rows
+    for start in range(0, n_obs, obs_per_tile):
+        end = min(start + obs_per_tile, n_obs)
+        sl = slice(indptr[start], indptr[end])
+        _sort_rows(np.asarray(indptr[start : end + 1] - indptr[start]), np.asarray(indices[sl]), np.asarray(dst[sl]))
+    for arr in (indptr, indices, adj, dst):
+        arr.flush()
+
+    Adj = csr_matrix((adj, indices, indptr), shape=(n_obs, n_obs))
+    Dst = csr_matrix((dst, indices, indptr), shape=(n_obs, n_obs))
+    Adj.has_sorted_indices = Dst.has_sorted_indices = True
+
+    return Adj, Dst
+
+
+def _query_tile_knn(
+    coords: NDArrayA,
+    core: NDArrayA,
+    box_lo: NDArrayA,
+    box_hi: NDArrayA,
+    lo: NDArrayA,
+    hi: NDArrayA,
+    n_neighs: int,
+    halo: float,
+    reference: Callable[[NDArrayA, NDArrayA], NDArrayA],
+) -> tuple[NDArrayA, NDArrayA, NDArrayA, NDArrayA]:
+    """Query the kNN of the ``core`` observations, growing the halo around the tile until the result is exact."""
+    res_queries, res_neighs, res_dists = [], [], []
+    todo = core
+    while len(todo):
+        halo_lo, halo_hi = box_lo - halo, box_hi + halo
+        ref = reference(halo_lo, halo_hi)
+        k = min(n_neighs + 1, len(ref))
+        dists, neighs = SpatialIndex(coords[ref]).kneighbors(coords[todo], n_neighbors=k)
+        neighs = ref[neighs]
+
+        # remove the query itself, or the farthest neighbor if it's not present due to duplicates
+        is_self = neighs == todo[:, np.newaxis]
+        keep = np.ones_like(is_self)
+        keep[np.arange(len(todo)), np.where(is_self.any(axis=1), is_self.argmax(axis=1), k - 1)] = False
+        neighs, dists = neighs[keep].reshape(len(todo), k - 1), dists[keep].reshape(len(todo), k - 1)
+
+        if k - 1 < n_neighs:
+            if len(ref) == len(coords):
+                raise ValueError(f"Expected `n_neighs` to be less than `{len(coords)}`, found `{n_neighs}`.")
+            safe = np.zeros((len(todo),), dtype=bool)
+        else:
+            # distance to the closest side of the halo which is not beyond the extent of all observations
+            pts = coords[todo]
+            below = np.where(halo_lo <= lo, np.inf, pts - halo_lo)
+            above = np.where(halo_hi >= hi, np.inf, halo_hi - pts)
+            safe = dists[:, -1] < np.minimum(below, above).min(axis=1)
+
+        res_queries.append(todo[safe])
+        res_neighs.append(neighs[safe].reshape(-1))
+        res_dists.append(dists[safe].reshape(-1))
+        todo = todo[~safe]
+        halo *= 2.0
+
+    queries = np.concatenate(res_queries)
+    offsets = np.arange(0, len(queries) * n_neighs + 1, n_neighs)
+
+    return queries, np.concatenate(res_neighs), offsets, np.concatenate(res_dists)
+
+
+def _update_spatial_neighbors(
+    adj: csr_matrix,
+    dst: csr_matrix,
+    coords: NDArrayA,
+    new_coords: NDArrayA | None = None,
+    removed: Sequence[int] | NDArrayA | None = None,
+    n_neighs: int = 6,
+    radius: float | tuple[float, float] | None = None,
+    set_diag: bool = False,
+    index: SpatialIndex | None = None,
+) -> tuple[csr_matrix, csr_matrix]:
+    """
+    Update a generic kNN or radius graph after adding or removing observations, without rebuilding it.
+
+    Only the neighborhoods which can change are queried again: the ones containing a removed observation
+    (kNN graphs), the ones reached by an added observation, i.e. closer than the current :math:`k`-th neighbor
+    or than the radius, and the ones of the added observations. The queries use the index of the existing
+    observations, masking the removed ones, and an index of the added observations only. The other
+    neighborhoods are copied row by row from the existing graph and only the rows receiving a new neighbor
+    are sorted again. The result is the same as building the graph from scratch.
+
+    Parameters
+    ----------
+    adj
+        Connectivities of shape ``(n_obs, n_obs)``, as returned by :func:`squidpy.gr.spatial_neighbors`
+        with ``coord_type = 'generic'``, ``delaunay = False`` and no transform.
+    dst
+        Distances with the same sparsity structure as ``adj``.
+    coords
+        Array of shape ``(n_obs, n_dims)`` containing the coordinates of the graph.
+    new_coords
+        Array of shape ``(n_new, n_dims)`` containing the coordinates of the added observations.
+    removed
+        Indices of the removed observations.
+    n_neighs
+        Number of neighbors. Only used when ``radius = None``.
+    radius
+        Radius or the ``[min, max]`` distance interval.
+    set_diag
+        Whether to set the diagonal of the connectivities to `1.0`.
+    index
+        Spatial index of ``coords``. If `None`, build it.
+
+    Returns
+    -------
+    The connectivities and distances. The observations which were not removed come first, in their
+    original order, followed by the added observations.
+    """
+    coords = np.asarray(coords)
+    n_old = coords.shape[0]
+    if adj.shape != (n_old, n_old) or dst.shape != adj.shape:
+        raise ValueError(f"Expected the graphs to be of shape `{(n_old, n_old)}`, found `{adj.shape}`.")
+    if dst.nnz != adj.nnz:
+        raise ValueError(
+            f"Expected the distances to have the same sparsity structure as the connectivities, "
+            f"found `{dst.nnz}` and `{adj.nnz}` stored values."
+        )
+    adj, dst = csr_matrix(adj), csr_matrix(dst)
+    new_coords = np.empty((0, coords.shape[1]), dtype=coords.dtype) if new_coords is None else np.asarray(new_coords)
+    removed = np.unique(np.asarray([] if removed is None else removed, dtype=np.int64))
+    if len(removed) and (removed[0] < 0 or removed[-1] >= n_old):
+        raise ValueError(f"Expected the removed indices to be in interval `[0, {n_old})`.")
+
+    keep = np.ones((n_old,), dtype=bool)
+    keep[removed] = False
+    old_to_new = np.cumsum(keep) - 1
+    n_keep, n_new = int(keep.sum()), new_coords.shape[0]
+    n_obs = n_keep + n_new
+    # the removed observations are masked, so the index of the existing observations stays valid
+    index = SpatialIndex(coords) if index is None else index
+    new_index = SpatialIndex(new_coords) if n_new else None
+    mask = keep if len(removed) else None
+
+    min_dist, max_dist = -np.inf, np.inf
+    if isinstance(radius, Iterable):
+        min_dist, max_dist = sorted(radius)[:2]  # type: ignore[var-annotated]
+    r = 1 if radius is None else radius if isinstance(radius, (int, float)) else max(radius)
+
+    affected = np.zeros((n_old,), dtype=bool)
+    if radius is None:
+        # neighbor `j` of query `i` is stored in row `j`, column `i`, the rows of the removed observations
+        # contain the queries whose neighbors need to be replaced
+        affected[adj[removed].indices] = True
+        lengths, kdist = np.zeros((n_old,), dtype=np.int64), np.zeros((n_old,), dtype=np.float64)
+        _column_stats(adj.indices, dst.data, lengths, kdist)
+        affected |= lengths - (set_diag & (lengths > 0)) < n_neighs
+        if n_new and n_keep:
+            dists, cands, _ = index.radius_neighbors(new_coords, radius=kdist[keep].max(), mask=mask)
+            affected[cands[dists <= kdist[cands]]] = True
+    elif n_new and n_keep:
+        _, cands, _ = index.radius_neighbors(new_coords, radius=r, mask=mask)
+        affected[cands] = True
+    affected &= keep
+
+    ids = np.flatnonzero(affected)
+    queries = np.concatenate([old_to_new[ids], np.arange(n_keep, n_obs)])
+    points = np.concatenate([coords[ids], new_coords], axis=0)
+    if not len(queries):
+        q_neighs, q_dists, q_offsets = np.empty((0,), dtype=np.int64), np.empty((0,)), np.zeros((1,), dtype=np.int64)
+    elif radius is None:
+        q_neighs, q_dists, q_offsets = _query_union_knn(
+            index, new_index, points, queries, old_to_new, n_neighs=n_neighs, n_keep=n_keep, mask=mask
+        )
+    else:
+        q_neighs, q_dists, q_offsets = _query_union_radius(
+            index, new_index, points, old_to_new, radius=r, n_keep=n_keep, mask=mask
+        )
+
+    # the neighborhoods of the removed and the queried observations are replaced
+    stale = ~keep
+    stale[ids] = True
+    counts = np.zeros((n_obs + 1,), dtype=np.int64)
+    _count_kept(adj.indptr, adj.indices, keep, stale, old_to_new, counts[1:])
+    _count_neighbors(queries, q_neighs, q_offsets, q_dists, min_dist, max_dist, set_diag, counts[1:])
+    nnz = counts.sum()
+
+    idx_dtype = np.int32 if max(nnz, n_obs) <= np.iinfo(np.int32).max else np.int64
+    indptr = np.cumsum(counts, dtype=idx_dtype)
+    indices = np.empty((nnz,), dtype=idx_dtype)
+    adj_data = np.empty((nnz,), dtype=adj.dtype)
+    dst_data = np.empty((nnz,), dtype=dst.dtype)
+
+    pos = indptr[:-1].astype(np.int64)
+    _copy_kept(adj.indptr, adj.indices, adj.data, dst.data, keep, stale, old_to_new, pos, indices, adj_data, dst_data)
+    _fill_neighbors(
+        queries, q_neighs, q_offsets, q_dists, min_dist, max_dist, set_diag, pos, indices, adj_data, dst_data
+    )
+    # the copied and the new columns are each sorted, merge them only in the rows which received both
+    touched = np.unique(np.concatenate([q_neighs, queries])) if len(queries) else np.empty((0,), dtype=np.int64)
+    _sort_rows_subset(touched, indptr, indices, adj_data, dst_data)
+
+    Adj = csr_matrix((adj_data, indices, indptr), shape=(n_obs, n_obs))
+    Dst = csr_matrix((dst_data, indices, indptr), shape=(n_obs, n_obs))
+    Adj.has_sorted_indices = Dst.has_sorted_indices = True
+
+    return Adj, Dst
+
+
+def _query_union_knn(
+    index: SpatialIndex,
+    new_index: SpatialIndex | None,
+    points: NDArrayA,
+    queries: NDArrayA,
+    old_to_new: NDArrayA,
+    n_neighs: int,
+    n_keep: int,
+    mask: NDArrayA | None = None,
+) -> tuple[NDArrayA, NDArrayA, NDArrayA]:
+    """Query the kNN of ``points`` among the kept and the added observations, without the queries themselves."""
+    n_obs = n_keep + (0 if new_index is None else new_index.coords.shape[0])
+    k = n_neighs + 1
+    if k > n_obs:
+        raise ValueError(f"Expected `n_neighs` to be less than `{n_obs}`, found `{n_neighs}`.")
+
+    dists, neighs = [], []
+    if n_keep:
+        d, n = index.kneighbors(points, n_neighbors=min(k, n_keep), mask=mask)
+        dists.append(d)
+        neighs.append(old_to_new[n])
+    if new_index is not None:
+        d, n = new_index.kneighbors(points, n_neighbors=min(k, new_index.coords.shape[0]))
+        dists.append(d)
+        neighs.append(n + n_keep)
+    dists, neighs = np.concatenate(dists, axis=1), np.concatenate(neighs, axis=1)
+    # both are sorted by the distance and then by the index, which keeps the same order after the merge
+    order = np.lexsort((neighs, dists), axis=-1)[:, :k]
+    dists, neighs = np.take_along_axis(dists, order, axis=1), np.take_along_axis(neighs, order, axis=1)
+
+    # remove the query itself, or the farthest neighbor if it's not present due to duplicates
+    is_self = neighs == queries[:, np.newaxis]
+    is_neigh = np.ones_like(is_self)
+    is_neigh[np.arange(len(queries)), np.where(is_self.any(axis=1), is_self.argmax(axis=1), k - 1)] = False
+
+    return neighs[is_neigh], dists[is_neigh], np.arange(0, len(queries) * n_neighs + 1, n_neighs)
+
+
+def _query_union_radius(
+    index: SpatialIndex,
+    new_index: SpatialIndex | None,
+    points: NDArrayA,
+    old_to_new: NDArrayA,
+    radius: float,
+    n_keep: int,
+    mask: NDArrayA | None = None,
+) -> tuple[NDArrayA, NDArrayA, NDArrayA]:
+    """Query the neighbors of ``points`` within ``radius`` among the kept and the added observations."""
+    res = []
+    if n_keep:
+        dists, neighs, offsets = index.radius_neighbors(points, radius=radius, mask=mask)
+        res.append((dists, old_to_new[neighs], offsets))
+    if new_index is not None:
+        dists, neighs, offsets = new_index.radius_neighbors(points, radius=radius)
+        res.append((dists, neighs + n_keep, offsets))
+
+    # group the neighbors of both indices by their query
+    lengths = np.sum([np.diff(offsets) for _, _, offsets in res], axis=0)
+    qids = np.concatenate([np.repeat(np.arange(points.shape[0]), np.diff(offsets)) for _, _, offsets in res])
+    order = np.argsort(qids, kind="stable")
+
+    return (
+        np.concatenate([neighs for _, neighs, _ in res])[order],
+        np.concatenate([dists for dists, _, _ in res])[order],
+        np.concatenate([[0], np.cumsum(lengths)]),
+    )
+
+
+@njit(cache=True)
+def _column_stats(indices: NDArrayA, data: NDArrayA, counts: NDArrayA, maxs: NDArrayA) -> None:
+    for k in range(indices.shape[0]):
+        counts[indices[k]] += 1
+        maxs[indices[k]] = max(maxs[indices[k]], data[k])
+
+
+@njit(cache=True)
+def _count_kept(
+    indptr: NDArrayA, indices: NDArrayA, keep: NDArrayA, stale: NDArrayA, old_to_new: NDArrayA, counts: NDArrayA
+) -> None:
+    for j in range(indptr.shape[0] - 1):
+        if not keep[j]:
+            continue
+        for k in range(indptr[j], indptr[j + 1]):
+            if not stale[indices[k]]:
+                counts[old_to_new[j]] += 1
+
+
+@njit(cache=True)
+def _copy_kept(
+    indptr: NDArrayA,
+    indices: NDArrayA,
+    adj: NDArrayA,
+    dst: NDArrayA,
+    keep: NDArrayA,
+    stale: NDArrayA,
+    old_to_new: NDArrayA,
+    pos: NDArrayA,
+    res_indices: NDArrayA,
+    res_adj: NDArrayA,
+    res_dst: NDArrayA,
+) -> None:
+    for j in range(indptr.shape[0] - 1):
+        if not keep[j]:
+            continue
+        i = old_to_new[j]
+        for k in range(indptr[j], indptr[j + 1]):
+            if not stale[indices[k]]:
+                p = pos[i]
+                res_indices[p] = old_to_new[indices[k]]
+                res_adj[p], res_dst[p] = adj[k], dst[k]
+                pos[i] += 1
+
+
+@njit(cache=True)
+def _sort_rows_subset(rows: NDArrayA, indptr: NDArrayA, indices: NDArrayA, adj: NDArrayA, dst: NDArrayA) -> None:
+    for i in rows:
+        start, end = indptr[i], indptr[i + 1]
+        order = np.argsort(indices[start:end], kind="mergesort")
+        indices[start:end] = indices[start:end][order]
+        adj[start:end] = adj[start:end][order]
+        dst[start:end] = dst[start:end][order]
+
+
+@njit(cache=True)
+def _sort_rows(indptr: NDArrayA, indices: NDArrayA, data: NDArrayA) -> None:
+    for i in range(indptr.shape[0] - 1):
+        start, end = indptr[i], indptr[i + 1]
+        order = np.argsort(indices[start:end])
+        indices[start:end] = indices[start:end][order]
+        data[start:end] = data[start:end][order]
+
+
+def _build_rings(
+    adj: csr_matrix, n_rings: int, set_diag: bool = False, dtype: np.dtype | type = np.float64
+) -> csr_matrix:
+    """
+    Expand the graph to the neighbors which are at most ``n_rings`` hops away.
+
+    Parameters
+    ----------
+    adj
+        Graph containing the first ring of neighbors.
+    n_rings
+        Number of rings.
+    set_diag
+        Whether to include the diagonal, with ring index `0`.
+    dtype
+        Data type of the ring indices.
+
+    Returns
+    -------
+    Graph whose values are the ring indices of the neighbors. The cost is linear in the number of
+    observations times the number of neighbors within ``n_rings``.
+    """
+    n_obs = adj.shape[0]
+    indptr, indices = adj.indptr, adj.indices
+
+    counts = np.zeros((n_obs + 1,), dtype=np.int64)
+    _count_rings(indptr, indices, n_rings, set_diag, counts[1:])
+    nnz = counts.sum()
+
+    idx_dtype = np.int32 if max(nnz, n_obs) <= np.iinfo(np.int32).max else np.int64
+    res_indptr = np.cumsum(counts, dtype=idx_dtype)
+    res_indices = np.empty((nnz,), dtype=idx_dtype)
+    res_data = np.empty((nnz,), dtype=dtype)
+    _fill_rings(indptr, indices, n_rings, set_diag, res_indptr, res_indices, res_data)
+
+    res = csr_matrix((res_data, res_indices, res_indptr), shape=(n_obs, n_obs))
+    res.has_sorted_indices = True
+
+    return res
+
+
+@njit(cache=True)
+def _ring_bfs(
+    indptr: NDArrayA, indices: NDArrayA, src: int, n_rings: int, seen: NDArrayA, nodes: NDArrayA, rings: NDArrayA
+) -> int:
+    # `seen` is stamped with the source, so it never needs to be reset between the searches
+    seen[src] = src
+    nodes[0], rings[0] = src, 0
+    head, tail = 0, 1
+    while head < tail:
+        u, r = nodes[head], rings[head]
+        head += 1
+        if r == n_rings:
+            continue
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            if seen[v] != src:
+                seen[v] = src
+                nodes[tail], rings[tail] = v, r + 1
+                tail += 1
+
+    return tail
+
+
+@njit(cache=True)
+def _count_rings(indptr: NDArrayA, indices: NDArrayA, n_rings: int, set_diag: bool, counts: NDArrayA) -> None:
+    n_obs = indptr.shape[0] - 1
+    seen = np.full((n_obs,), -1, dtype=np.int64)
+    nodes = np.empty((n_obs,), dtype=np.int64)
+    rings = np.empty((n_obs,), dtype=np.int64)
+
+    for i in range(n_obs):
+        counts[i] = _ring_bfs(indptr, indices, i, n_rings, seen, nodes, rings) - (not set_diag)
+
+
+@njit(cache=True)
+def _fill_rings(
+    indptr: NDArrayA,
+    indices: NDArrayA,
+    n_rings: int,
+    set_diag: bool,
+    res_indptr: NDArrayA,
+    res_indices: NDArrayA,
+    res_data: NDArrayA,
+) -> None:
+    n_obs = indptr.shape[0] - 1
+    seen = np.full((n_obs,), -1, dtype=np.int64)
+    nodes = np.empty((n_obs,), dtype=np.int64)
+    rings = np.empty((n_obs,), dtype=np.int64)
+    offset = 0 if set_diag else 1
+
+    for i in range(n_obs):
+        n = _ring_bfs(indptr, indices, i, n_rings, seen, nodes, rings)
+        order = np.argsort(nodes[offset:n])
+        start = res_indptr[i]
+        for k in range(order.shape[0]):
+            res_indices[start + k] = nodes[offset + order[k]]
+            res_data[start + k] = rings[offset + order[k]]
+
+
 def _build_connectivity(
     coords: NDArrayA,
     n_neighs: int,
@@ -261,79 +1351,300 @@ def _build_connectivity(
     neigh_correct: bool = False,
     set_diag: bool = False,
     return_distance: bool = False,
+    percentile: float | None = None,
+    dtype: np.dtype | type = np.float64,
+    index: SpatialIndex | None = None,
 ) -> csr_matrix | tuple[csr_matrix, csr_matrix]:
     N = coords.shape[0]
     if delaunay:
         tri = Delaunay(coords)
-        indptr, indices = tri.vertex_neighbor_vertices
-        Adj = csr_matrix((np.ones_like(indices, dtype=np.float64), indices, indptr), shape=(N, N))
-
-        if return_distance:
-            # fmt: off
-            dists = np.array(list(chain(*(
-                euclidean_distances(coords[indices[indptr[i] : indptr[i + 1]], :], coords[np.newaxis, i, :])
-                for i in range(N)
-                if len(indices[indptr[i] : indptr[i + 1]])
-            )))).squeeze()
-            Dst = csr_matrix((dists, indices, indptr), shape=(N, N))
-            # fmt: on
+        offsets, neighs = tri.vertex_neighbor_vertices
+        if return_distance or isinstance(radius, Iterable) or percentile is not None:
+            dists = _edge_lengths(coords, neighs, offsets)
+        else:
+            dists = np.zeros_like(neighs, dtype=np.float64)
     else:
-        r = 1 if radius is None else radius if isinstance(radius, (int, float)) else max(radius)
-        tree = NearestNeighbors(n_neighbors=n_neighs, radius=r, metric="euclidean")
-        tree.fit(coords)
-
+        index = SpatialIndex(coords) if index is None else index
         if radius is None:
-            results = tree.kneighbors()
-            dists, row_indices = (result.reshape(-1) for result in results)
-            col_indices = np.repeat(np.arange(N), n_neighs)
-            if neigh_correct:
-                dist_cutoff = np.median(dists) * 1.3  # there's a small amount of sway
-                mask = dists < dist_cutoff
-                row_indices, col_indices = row_indices[mask], col_indices[mask]
-                dists = dists[mask]
+            dists, neighs = index.kneighbors(n_neighbors=n_neighs)
+            offsets = np.arange(0, dists.size + 1, n_neighs)
+            dists, neighs = dists.reshape(-1), neighs.reshape(-1)
         else:
-            results = tree.radius_neighbors()
-            dists = np.concatenate(results[0])
-            row_indices = np.concatenate(results[1])
-            col_indices = np.repeat(np.arange(N), [len(x) for x in results[1]])
+            r = radius if isinstance(radius, (int, float)) else max(radius)
+            dists, neighs, offsets = index.radius_neighbors(radius=r)
+
+    min_dist, max_dist = -np.inf, np.inf
+    if isinstance(radius, Iterable):
+        min_dist, max_dist = sorted(radius)[:2]  # type: ignore[var-annotated]
+    if neigh_correct and not delaunay and radius is None:
+        # there's a small amount of sway; `nextafter` makes the upper bound exclusive
+        max_dist = np.nextafter(np.median(dists) * 1.3, -np.inf)
+    if delaunay and percentile is not None and len(dists):
+        max_dist = min(max_dist, np.percentile(dists, percentile))
+
+    return _neighbors_to_csr(
+        neighs,
+        offsets,
+        dists,
+        n_obs=N,
+        min_dist=min_dist,
+        max_dist=max_dist,
+        set_diag=set_diag,
+        return_distance=return_distance,
+        dtype=dtype,
+    )
+
+
+def _build_connectivity_family(
+    coords: NDArrayA,
+    n_neighs: int | Sequence[int],
+    radius: list[float] | None = None,
+    set_diag: bool = False,
+    dtype: np.dtype | type = np.float64,
+    index: SpatialIndex | None = None,
+) -> list[tuple[csr_matrix, csr_matrix]]:
+    """
+    Build the kNN or radius graphs at multiple scales from one neighbor query.
+
+    Parameters
+    ----------
+    coords
+        Array of shape ``(n_obs, n_dims)`` containing the coordinates.
+    n_neighs
+        Numbers of neighbors. Only used when ``radius = None``.
+    radius
+        Radii.
+    set_diag
+        Whether to set the diagonal of the connectivities to `1.0`.
+    dtype
+        Data type of the connectivities and distances.
+    index
+        Spatial index of ``coords``. If `None`, build it.
+
+    Returns
+    -------
+    The connectivities and distances for each scale. The neighbors are queried at the largest scale
+    and the smaller scales keep the closest neighbors, which are sorted by distance.
+    """
+    N = coords.shape[0]
+    index = SpatialIndex(coords) if index is None else index
+    if radius is None:
+        n_neighs = [n_neighs] if isinstance(n_neighs, (int, np.integer)) else list(n_neighs)
+        dists, neighs = index.kneighbors(n_neighbors=max(n_neighs))
+        return [
+            _neighbors_to_csr(  # type: ignore[misc]
+                np.ascontiguousarray(neighs[:, :n]).reshape(-1),
+                np.arange(0, N * n + 1, n),
+                np.ascontiguousarray(dists[:, :n]).reshape(-1),
+                n_obs=N,
+                set_diag=set_diag,
+                return_distance=True,
+                dtype=dtype,
+            )
+            for n in n_neighs
+        ]
+
+    dists, neighs, offsets = index.radius_neighbors(radius=max(radius))
+
+    return [
+        _neighbors_to_csr(  # type: ignore[misc]
+            neighs, offsets, dists, n_obs=N, max_dist=r, set_diag=set_diag, return_distance=True, dtype=dtype
+        )
+        for r in radius
+    ]
+
+
+def _neighbors_to_csr(
+    neighs: NDArrayA,
+    offsets: NDArrayA,
+    dists: NDArrayA,
+    n_obs: int,
+    min_dist: float = -np.inf,
+    max_dist: float = np.inf,
+    set_diag: bool = False,
+    return_distance: bool = False,
+    dtype: np.dtype | type = np.float64,
+) -> csr_matrix | tuple[csr_matrix, csr_matrix]:
+    """
+    Build the spatial graph directly in the sorted CSR format.
+
+    Parameters
+    ----------
+    neighs
+        Array of shape ``(n_edges,)`` containing the neighbors of all queries, concatenated.
+    offsets
+        Array of shape ``(n_obs + 1,)`` such that the neighbors of query `i` are
+        ``neighs[offsets[i] : offsets[i + 1]]``.
+    dists
+        Array of shape ``(n_edges,)`` containing the distances to the neighbors.
+    n_obs
+        Number of observations.
+    min_dist
+        Edges shorter than this are removed.
+    max_dist
+        Edges longer than this are removed.
+    set_diag
+        Whether to set the diagonal of the connectivities to `1.0`. The diagonal of the distances is always `0.0`.
+    return_distance
+        Whether to also return the distances.
+    dtype
+        Data type of the connectivities and distances.
+
+    Returns
+    -------
+    The connectivities and optionally the distances. Neighbor `j` of query `i` is stored in row `j`, column `i`.
+    Both matrices share the same ``indptr`` and ``indices`` arrays, whose data type is :class:`numpy.int32`
+    whenever possible, so that :mod:`scipy` does not downcast and copy them.
+    """
+    queries = np.arange(n_obs)
+    counts = np.zeros((n_obs + 1,), dtype=np.int64)
+    _count_neighbors(queries, neighs, offsets, dists, min_dist, max_dist, set_diag, counts[1:])
+    nnz = counts.sum()
 
-        Adj = csr_matrix((np.ones_like(row_indices, dtype=np.float64), (row_indices, col_indices)), shape=(N, N))
-        if return_distance:
-            Dst = csr_matrix((dists, (row_indices, col_indices)), shape=(N, N))
+    idx_dtype = np.int32 if max(nnz, n_obs) <= np.iinfo(np.int32).max else np.int64
+    indptr = np.cumsum(counts, dtype=idx_dtype)
+    indices = np.empty((nnz,), dtype=idx_dtype)
+    adj = np.empty((nnz,), dtype=dtype)
+    dst = np.empty((nnz if return_distance else 0,), dtype=dtype)
 
-    # radius-based filtering needs same indices/indptr: do not remove 0s
-    Adj.setdiag(1.0 if set_diag else Adj.diagonal())
+    pos = indptr[:-1].copy()
+    _fill_neighbors(queries, neighs, offsets, dists, min_dist, max_dist, set_diag, pos, indices, adj, dst)
+
+    Adj = csr_matrix((adj, indices, indptr), shape=(n_obs, n_obs))
+    Adj.has_sorted_indices = True
     if return_distance:
-        Dst.setdiag(0.0)
+        Dst = csr_matrix((dst, indices, indptr), shape=(n_obs, n_obs))
+        Dst.has_sorted_indices = True
         return Adj, Dst
 
     return Adj
 
 
-@njit
-def outer(indices: NDArrayA, indptr: NDArrayA, degrees: NDArrayA) -> NDArrayA:
-    res = np.empty_like(indices, dtype=np.float64)
-    start = 0
-    for i in range(len(indptr) - 1):
-        ixs = indices[indptr[i] : indptr[i + 1]]
-        res[start : start + len(ixs)] = degrees[i] * degrees[ixs]
-        start += len(ixs)
+@njit(cache=True)
+def _edge_lengths(coords: NDArrayA, neighs: NDArrayA, offsets: NDArrayA) -> NDArrayA:
+    res = np.empty((neighs.shape[0],), dtype=np.float64)
+    for i in range(offsets.shape[0] - 1):
+        for k in range(offsets[i], offsets[i + 1]):
+            d = 0.0
+            for c in range(coords.shape[1]):
+                diff = coords[neighs[k], c] - coords[i, c]
+                d += diff * diff
+            res[k] = np.sqrt(d)
 
     return res
 
 
+@njit(cache=True)
+def _count_neighbors(
+    queries: NDArrayA,
+    neighs: NDArrayA,
+    offsets: NDArrayA,
+    dists: NDArrayA,
+    min_dist: float,
+    max_dist: float,
+    set_diag: bool,
+    counts: NDArrayA,
+) -> None:
+    for q in range(queries.shape[0]):
+        i = queries[q]
+        if set_diag:
+            counts[i] += 1
+        for k in range(offsets[q], offsets[q + 1]):
+            j = neighs[k]
+            if j != i and dists[k] >= min_dist and dists[k] <= max_dist:
+                counts[j] += 1
+
+
+@njit(cache=True)
+def _fill_neighbors(
+    queries: NDArrayA,
+    neighs: NDArrayA,
+    offsets: NDArrayA,
+    dists: NDArrayA,
+    min_dist: float,
+    max_dist: float,
+    set_diag: bool,
+    pos: NDArrayA,
+    indices: NDArrayA,
+    adj: NDArrayA,
+    dst: NDArrayA,
+) -> None:
+    fill_dst = dst.shape[0] > 0
+    # if the queries are increasing, each row receives its columns already sorted
+    for q in range(queries.shape[0]):
+        i = queries[q]
+        if set_diag:
+            p = pos[i]
+            indices[p] = i
+            adj[p] = 1.0
+            if fill_dst:
+                dst[p] = 0.0
+            pos[i] += 1
+        for k in range(offsets[q], offsets[q + 1]):
+            j = neighs[k]
+            if j != i and dists[k] >= min_dist and dists[k] <= max_dist:
+                p = pos[j]
+                indices[p] = i
+                adj[p] = 1.0
+                if fill_dst:
+                    dst[p] = dists[k]
+                pos[j] += 1
+
+
 def _transform_a_spectral(a: spmatrix) -> spmatrix:
     if not isspmatrix_csr(a):
         a = a.tocsr()
     if not a.nnz:
         return a
 
-    degrees = np.squeeze(np.array(np.sqrt(1.0 / a.sum(axis=0))))
-    a = a.multiply(outer(a.indices, a.indptr, degrees))
-    a.eliminate_zeros()
+    # D^-1/2 A D^-1/2, where D are the column sums, in place
+    degrees = np.zeros((a.shape[1],), dtype=np.float64)
+    _column_sums(np.asarray(a.indices), np.asarray(a.data), degrees)
+    with np.errstate(divide="ignore"):
+        degrees = 1.0 / np.sqrt(degrees)
+    _scale_csr(np.asarray(a.indptr), np.asarray(a.indices), np.asarray(a.data), degrees, degrees)
 
     return a
 
 
 def _transform_a_cosine(a: spmatrix) -> spmatrix:
-    return cosine_similarity(a, dense_output=False)
+    if not isspmatrix_csr(a):
+        a = a.tocsr()
+
+    # the rows are normalized in place, only the product allocates a new matrix
+    _normalize_rows(np.asarray(a.indptr), np.asarray(a.data), 2)
+    return a @ a.T
+
+
+def _transform_a_row(a: spmatrix) -> spmatrix:
+    if not isspmatrix_csr(a):
+        a = a.tocsr()
+
+    _normalize_rows(np.asarray(a.indptr), np.asarray(a.data), 1)
+    return a
+
+
+@njit(cache=True)
+def _column_sums(indices: NDArrayA, data: NDArrayA, out: NDArrayA) -> None:
+    for k in range(indices.shape[0]):
+        out[indices[k]] += data[k]
+
+
+@njit(cache=True)
+def _scale_csr(indptr: NDArrayA, indices: NDArrayA, data: NDArrayA, row_scale: NDArrayA, col_scale: NDArrayA) -> None:
+    for i in range(indptr.shape[0] - 1):
+        for k in range(indptr[i], indptr[i + 1]):
+            data[k] *= row_scale[i] * col_scale[indices[k]]
+
+
+@njit(cache=True)
+def _normalize_rows(indptr: NDArrayA, data: NDArrayA, norm: int) -> None:
+    for i in range(indptr.shape[0] - 1):
+        total = 0.0
+        for k in range(indptr[i], indptr[i + 1]):
+            total += abs(data[k]) if norm == 1 else data[k] * data[k]
+        if norm == 2:
+            total = np.sqrt(total)
+        if total > 0:
+            for k in range(indptr[i], indptr[i + 1]):
+                data[k] /= total
@@ -0,0 +1,469 @@
+"""Spatial index shared by the graph functions."""
+from __future__ import annotations
+
+from typing import Any, Mapping
+import hashlib
+
+from anndata import AnnData
+
+from numba import njit
+import numpy as np
+
+from squidpy._utils import NDArrayA
+from squidpy._constants._pkg_constants import Key
+
+__all__ = ["SpatialIndex"]
+
+_METRICS = {"euclidean": 2, "l2": 2, "manhattan": 1, "l1": 1, "cityblock": 1}
+_OBS_PER_CELL = 4
+
+
+class SpatialIndex:
+    """
+    Uniform grid hash over spatial coordinates.
+
+    The observations are bucketed into a regular grid of cells and stored in the order of the cells, so that the
+    neighbors of a point are found by scanning only the nearby cells. The index consists only of :mod:`numpy`
+    arrays and can be saved in :attr:`anndata.AnnData.uns`, which survives :meth:`anndata.AnnData.write_h5ad`.
+
+    Parameters
+    ----------
+    coords
+        Array of shape ``(n_obs, n_dims)`` containing the coordinates.
+    cell_size
+        Size of the grid cells. If `None`, it's chosen such that each cell contains a few observations on average.
+    """
+
+    def __init__(self, coords: NDArrayA, cell_size: float | None = None):
+        self._coords = np.ascontiguousarray(coords, dtype=np.float64)
+        if self._coords.ndim != 2:
+            raise ValueError(f"Expected the coordinates to be a 2-dimensional array, found `{self._coords.ndim}`.")
+        n_obs, n_dims = self._coords.shape
+
+        self._origin = self._coords.min(axis=0) if n_obs else np.zeros((n_dims,))
+        extent = self._coords.max(axis=0) - self._origin if n_obs else np.zeros((n_dims,))
+        if cell_size is None:
+            # only the non-degenerate dimensions contribute to the volume
+            spanned = extent[extent > 0]
+            if len(spanned):
+                volume = np.prod(spanned / spanned.max())
+                cell_size = spanned.max() * (_OBS_PER_CELL * volume / n_obs) ** (1.0 / len(spanned))
+            else:
+                cell_size = 1.0
+        if cell_size <= 0:
+            raise ValueError(f"Expected `cell_size` to be positive, found `{cell_size}`.")
+        self._cell_size = float(cell_size)
+        self._shape = np.floor(extent / self._cell_size).astype(np.int64) + 1
+
+        cells = _cell_ids(self._coords, self._origin, self._cell_size, self._shape)
+        n_cells = int(np.prod(self._shape))
+        idx_dtype = np.int32 if max(n_obs, n_cells) <= np.iinfo(np.int32).max else np.int64
+        self._order = np.argsort(cells, kind="stable").astype(idx_dtype)
+        self._indptr = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=n_cells))]).astype(idx_dtype)
+        self._sorted_coords: NDArrayA | None = None
+        self._fingerprint = _fingerprint(self._coords)
+
+    @property
+    def fingerprint(self) -> str:
+        """Hash of the coordinates."""
+        return self._fingerprint
+
+    @property
+    def coords(self) -> NDArrayA:
+        """Coordinates of the observations."""
+        return self._coords
+
+    def kneighbors(
+        self,
+        points: NDArrayA | None = None,
+        n_neighbors: int = 6,
+        mask: NDArrayA | None = None,
+        metric: str = "euclidean",
+    ) -> tuple[NDArrayA, NDArrayA]:
+        """
+        Query the nearest neighbors.
+
+        Parameters
+        ----------
+        points
+            Array of shape ``(n_points, n_dims)`` containing the query points. If `None`, query the indexed
+            observations, each without itself.
+        n_neighbors
+            Number of neighbors.
+        mask
+            Boolean mask of shape ``(n_obs,)`` of the observations which can be neighbors. If `None`, use all.
+        metric
+            Distance metric, either `'euclidean'` or `'manhattan'`.
+
+        Returns
+        -------
+        The distances and the indices of the neighbors, both of shape ``(n_points, n_neighbors)``,
+        sorted by the distance and then by the index.
+        """
+        points, self_ids, queries, mask, p = self._prepare(points, mask, metric)
+        n_candidates = int(mask.sum()) if len(mask) else self._coords.shape[0]
+        n_candidates -= self_ids[0] >= 0 if len(self_ids) else 0
+        if n_neighbors > n_candidates:
+            raise ValueError(f"Expected `n_neighbors` to be at most `{n_candidates}`, found `{n_neighbors}`.")
+
+        dists = np.empty((points.shape[0], n_neighbors), dtype=np.float64)
+        neighs = np.empty((points.shape[0], n_neighbors), dtype=np.int64)
+        _query_knn(*self._arrays(), points, self_ids, queries, mask, p, neighs, dists)
+
+        return dists, neighs
+
+    def radius_neighbors(
+        self,
+        points: NDArrayA | None = None,
+        radius: float = 1.0,
+        mask: NDArrayA | None = None,
+        metric: str = "euclidean",
+    ) -> tuple[NDArrayA, NDArrayA, NDArrayA]:
+        """
+        Query the neighbors within a radius.
+
+        Parameters
+        ----------
+        points
+            Array of shape ``(n_points, n_dims)`` containing the query points. If `None`, query the indexed
+            observations, each without itself.
+        radius
+            Radius, inclusive.
+        mask
+            Boolean mask of shape ``(n_obs,)`` of the observations which can be neighbors. If `None`, use all.
+        metric
+            Distance metric, either `'euclidean'` or `'manhattan'`.
+
+        Returns
+        -------
+        The distances and the indices of the neighbors of all points, concatenated, and the offsets of shape
+        ``(n_points + 1,)`` such that the neighbors of point `i` are ``neighs[offsets[i] : offsets[i + 1]]``.
+        """
+        points, self_ids, queries, mask, p = self._prepare(points, mask, metric)
+        dists, neighs, lengths = _query_radius(*self._arrays(), points, self_ids, queries, mask, p, float(radius))
+
+        # the points were queried in the order of the cells, restore their order
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        src = np.concatenate([[0], np.cumsum(lengths[queries])])[np.argsort(queries)]
+        perm = np.repeat(src - offsets[:-1], lengths) + np.arange(offsets[-1])
+
+        return dists[perm], neighs[perm], offsets
+
+    def to_dict(self) -> dict[str, Any]:
+        """Serialize the index, without the coordinates."""
+        return {
+            "fingerprint": self._fingerprint,
+            "origin": self._origin,
+            "cell_size": self._cell_size,
+            "shape": self._shape,
+            "order": self._order,
+            "indptr": self._indptr,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any], coords: NDArrayA) -> SpatialIndex:
+        """
+        Deserialize the index.
+
+        Parameters
+        ----------
+        data
+            Serialized index, see :meth:`to_dict`.
+        coords
+            Coordinates from which the index was built.
+
+        Returns
+        -------
+        The index.
+        """
+        coords = np.ascontiguousarray(coords, dtype=np.float64)
+        fingerprint = _fingerprint(coords)
+        if str(data["fingerprint"]) != fingerprint:
+            raise ValueError("Expected the coordinates to match the spatial index, found different coordinates.")
+
+        index = cls.__new__(cls)
+        index._coords = coords
+        index._origin = np.asarray(data["origin"], dtype=np.float64)
+        index._cell_size = float(data["cell_size"])
+        index._shape = np.asarray(data["shape"], dtype=np.int64)
+        index._order = np.asarray(data["order"])
+        index._indptr = np.asarray(data["indptr"])
+        index._sorted_coords = None
+        index._fingerprint = fingerprint
+
+        return index
+
+    def _arrays(self) -> tuple[NDArrayA, NDArrayA, NDArrayA, NDArrayA, float, NDArrayA]:
+        if self._sorted_coords is None:
+            # the coordinates in the order of the cells, to scan the cells contiguously
+            self._sorted_coords = self._coords[self._order]
+        return self._sorted_coords, self._order, self._indptr, self._origin, self._cell_size, self._shape
+
+    def _prepare(
+        self, points: NDArrayA | None, mask: NDArrayA | None, metric: str
+    ) -> tuple[NDArrayA, NDArrayA, NDArrayA, NDArrayA, int]:
+        if metric not in _METRICS:
+            raise NotImplementedError(f"Metric `{metric}` is not yet implemented.")
+        if points is None:
+            points, self_ids, queries = self._coords, np.arange(self._coords.shape[0]), self._order
+        else:
+            points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, self._coords.shape[1])
+            self_ids = np.full((points.shape[0],), -1, dtype=np.int64)
+            queries = np.argsort(_cell_ids(points, self._origin, self._cell_size, self._shape), kind="stable")
+        if mask is None:
+            mask = np.empty((0,), dtype=np.bool_)
+        else:
+            mask = np.asarray(mask, dtype=np.bool_)
+            if mask.shape != (self._coords.shape[0],):
+                raise ValueError(f"Expected `mask` to be of shape `({self._coords.shape[0]},)`, found `{mask.shape}`.")
+            mask = mask[self._order]
+
+        return points, self_ids, queries, mask, _METRICS[metric]
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}[n_obs={self._coords.shape[0]}, cell_size={self._cell_size:.4g}, "
+            f"shape={tuple(self._shape)}]"
+        )
+
+
+def _get_spatial_index(adata: AnnData, spatial_key: str = Key.obsm.spatial) -> SpatialIndex:
+    """Load the spatial index from :attr:`anndata.AnnData.uns` if it matches the coordinates, otherwise build it."""
+    coords = adata.obsm[spatial_key]
+    data = adata.uns.get(Key.uns.spatial_index(spatial_key), None)
+    if data is not None:
+        try:
+            return SpatialIndex.from_dict(data, coords)
+        except (KeyError, ValueError):
+            pass
+
+    return SpatialIndex(coords)
+
+
+def _fingerprint(coords: NDArrayA) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(coords.shape).encode())
+    h.update(coords.tobytes())
+
+    return h.hexdigest()
+
+
+def _cell_ids(coords: NDArrayA, origin: NDArrayA, cell_size: float, shape: NDArrayA) -> NDArrayA:
+    cells = np.clip(np.floor((coords - origin) / cell_size).astype(np.int64), 0, shape - 1)
+    return np.ravel_multi_index(cells.T, tuple(shape)) if len(cells) else np.empty((0,), dtype=np.int64)
+
+
+@njit(cache=True)
+def _distance(coords: NDArrayA, j: int, point: NDArrayA, p: int) -> float:
+    d = 0.0
+    for c in range(point.shape[0]):
+        diff = abs(coords[j, c] - point[c])
+        d += diff if p == 1 else diff * diff
+
+    return d if p == 1 else np.sqrt(d)
+
+
+@njit(cache=True)
+def _cell_box(
+    point: NDArrayA, radius: float, origin: NDArrayA, cell_size: float, shape: NDArrayA, lo: NDArrayA, hi: NDArrayA
+) -> bool:
+    # returns whether the box covers all cells
+    full = True
+    for c in range(point.shape[0]):
+        lo[c] = max(0, min(shape[c] - 1, int(np.floor((point[c] - radius - origin[c]) / cell_size))))
+        hi[c] = max(0, min(shape[c] - 1, int(np.floor((point[c] + radius - origin[c]) / cell_size))))
+        full &= lo[c] == 0 and hi[c] == shape[c] - 1
+
+    return full
+
+
+@njit(cache=True)
+def _next_cell(lo: NDArrayA, hi: NDArrayA, cur: NDArrayA) -> bool:
+    c = cur.shape[0] - 1
+    while c >= 0:
+        cur[c] += 1
+        if cur[c] <= hi[c]:
+            return True
+        cur[c] = lo[c]
+        c -= 1
+
+    return False
+
+
+@njit(cache=True)
+def _ravel(cur: NDArrayA, shape: NDArrayA) -> int:
+    cell = 0
+    for c in range(cur.shape[0]):
+        cell = cell * shape[c] + cur[c]
+
+    return cell
+
+
+@njit(cache=True)
+def _query_radius(
+    coords: NDArrayA,
+    order: NDArrayA,
+    indptr: NDArrayA,
+    origin: NDArrayA,
+    cell_size: float,
+    shape: NDArrayA,
+    points: NDArrayA,
+    self_ids: NDArrayA,
+    queries: NDArrayA,
+    mask: NDArrayA,
+    p: int,
+    radius: float,
+) -> tuple[NDArrayA, NDArrayA, NDArrayA]:
+    n_dims = points.shape[1]
+    lo, hi, cur = np.empty((n_dims,), np.int64), np.empty((n_dims,), np.int64), np.empty((n_dims,), np.int64)
+    lengths = np.zeros((points.shape[0],), dtype=np.int64)
+    neighs = np.empty((max(16, points.shape[0]),), dtype=np.int64)
+    dists = np.empty((neighs.shape[0],), dtype=np.float64)
+    use_mask = mask.shape[0] > 0
+    n = 0
+
+    for q in queries:
+        _cell_box(points[q], radius, origin, cell_size, shape, lo, hi)
+        cur[:] = lo
+        start = n
+        while True:
+            cell = _ravel(cur, shape)
+            for kk in range(indptr[cell], indptr[cell + 1]):
+                j = order[kk]
+                if j == self_ids[q] or (use_mask and not mask[kk]):
+                    continue
+                d = _distance(coords, kk, points[q], p)
+                if d <= radius:
+                    if n == neighs.shape[0]:
+                        neighs = np.concatenate((neighs, np.empty_like(neighs)))
+                        dists = np.concatenate((dists, np.empty_like(dists)))
+                    neighs[n], dists[n] = j, d
+                    n += 1
+            if not _next_cell(lo, hi, cur):
+                break
+        lengths[q] = n - start
+
+    return dists[:n], neighs[:n], lengths
+
+
+@njit(cache=True)
+def _scan_cell(
+    coords: NDArrayA,
+    order: NDArrayA,
+    indptr: NDArrayA,
+    cell: int,
+    point: NDArrayA,
+    self_id: int,
+    mask: NDArrayA,
+    p: int,
+    n: int,
+    neighs: NDArrayA,
+    dists: NDArrayA,
+) -> int:
+    # insert the observations of the cell into the sorted neighbors, the ties are broken by the index
+    k = neighs.shape[0]
+    use_mask = mask.shape[0] > 0
+    for kk in range(indptr[cell], indptr[cell + 1]):
+        j = order[kk]
+        if j == self_id or (use_mask and not mask[kk]):
+            continue
+        d = _distance(coords, kk, point, p)
+        if n == k and (d > dists[k - 1] or (d == dists[k - 1] and j > neighs[k - 1])):
+            continue
+        i = min(n, k - 1)
+        while i > 0 and (dists[i - 1] > d or (dists[i - 1] == d and neighs[i - 1] > j)):
+            dists[i], neighs[i] = dists[i - 1], neighs[i - 1]
+            i -= 1
+        dists[i], neighs[i] = d, j
+        n = min(n + 1, k)
+
+    return n
+
+
+@njit(cache=True)
+def _ring_bound(
+    point: NDArrayA,
+    center: NDArrayA,
+    ring: int,
+    origin: NDArrayA,
+    cell_size: float,
+    shape: NDArrayA,
+    gap: NDArrayA,
+    p: int,
+) -> float:
+    # lower bound of the distance to the cells outside of the rings, `inf` if there are none
+    bound = np.inf
+    for c in range(point.shape[0]):
+        for side in range(2):
+            if side == 0 and center[c] - ring > 0:
+                diff = point[c] - (origin[c] + (center[c] - ring) * cell_size)
+            elif side == 1 and center[c] + ring < shape[c] - 1:
+                diff = origin[c] + (center[c] + ring + 1) * cell_size - point[c]
+            else:
+                continue
+            # the cells on this side span the whole grid in the other dimensions
+            d = diff if p == 1 else diff * diff
+            for e in range(point.shape[0]):
+                if e != c:
+                    d += gap[e] if p == 1 else gap[e] * gap[e]
+            bound = min(bound, d if p == 1 else np.sqrt(d))
+
+    return bound
+
+
+@njit(cache=True)
+def _query_knn(
+    coords: NDArrayA,
+    order: NDArrayA,
+    indptr: NDArrayA,
+    origin: NDArrayA,
+    cell_size: float,
+    shape: NDArrayA,
+    points: NDArrayA,
+    self_ids: NDArrayA,
+    queries: NDArrayA,
+    mask: NDArrayA,
+    p: int,
+    neighs: NDArrayA,
+    dists: NDArrayA,
+) -> None:
+    n_dims, k = points.shape[1], neighs.shape[1]
+    lo, hi, cur = np.empty((n_dims,), np.int64), np.empty((n_dims,), np.int64), np.empty((n_dims,), np.int64)
+    center, gap = np.empty((n_dims,), np.int64), np.empty((n_dims,), np.float64)
+    last = n_dims - 1
+
+    for q in queries:
+        point = points[q]
+        for c in range(n_dims):
+            # the closest cell, and the distance to the grid for the points outside of it
+            center[c] = max(0, min(shape[c] - 1, int(np.floor((point[c] - origin[c]) / cell_size))))
+            gap[c] = max(0.0, origin[c] - point[c], point[c] - origin[c] - shape[c] * cell_size)
+
+        # scan the rings of cells around the closest cell, until the remaining cells are farther than the neighbors
+        n, ring = 0, 0
+        while True:
+            for c in range(n_dims):
+                lo[c], hi[c] = max(0, center[c] - ring), min(shape[c] - 1, center[c] + ring)
+            cur[:] = lo
+            while True:
+                shell = False
+                for c in range(last):
+                    shell |= cur[c] == center[c] - ring or cur[c] == center[c] + ring
+                # the rows on the ring are scanned whole, the other rows only at their ends
+                if shell or ring == 0:
+                    first, stop, step = lo[last], hi[last] + 1, 1
+                else:
+                    first, stop, step = center[last] - ring, center[last] + ring + 1, 2 * ring
+                for end in range(first, stop, step):
+                    if lo[last] <= end <= hi[last]:
+                        cur[last] = end
+                        cell = _ravel(cur, shape)
+                        n = _scan_cell(coords, order, indptr, cell, point, self_ids[q], mask, p, n, neighs[q], dists[q])
+                cur[last] = hi[last]
+                if not _next_cell(lo, hi, cur):
+                    break
+
+            bound = _ring_bound(point, center, ring, origin, cell_size, shape, gap, p)
+            if bound == np.inf or (n == k and dists[q, k - 1] < bound):
+                break
+            ring += 1
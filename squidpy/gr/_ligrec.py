@@ -3,24 +3,39 @@ from __future__ import annotations
 
 from abc import ABC
 from types import MappingProxyType
-from typing import Any, Tuple, Union, Mapping, Iterable, Sequence, TYPE_CHECKING
+from typing import (
+    Any,
+    Tuple,
+    Union,
+    Mapping,
+    Iterable,
+    Iterator,
+    Sequence,
+    TYPE_CHECKING,
+)
+from pathlib import Path
 from functools import partial
-from itertools import product
+from itertools import chain, product
 from collections import namedtuple
 from typing_extensions import Literal
+import os
+import json
+import hashlib
 
 from scanpy import logging as logg
 from anndata import AnnData
 
-from numba import njit, prange  # noqa: F401
-from scipy.sparse import csc_matrix
+from numba import njit, prange, get_num_threads, set_num_threads
+from scipy.sparse import issparse, csc_matrix, csr_matrix
 import numpy as np
 import pandas as pd
 
 from squidpy._docs import d, inject_docs
 from squidpy._utils import Signal, NDArrayA, SigQueue, parallelize, _get_n_cores
 from squidpy.gr._utils import (
+    _shuffle,
     _save_data,
+    _get_strata,
     _genesymbols,
     _assert_positive,
     _create_sparse_df,
@@ -40,28 +55,93 @@ Cluster_t = Union[StrSeq, Tuple[StrSeq, StrSeq], SeqTuple]
 SOURCE = "source"
 TARGET = "target"
 
-TempResult = namedtuple("TempResult", ["means", "pvalues"])
+TempResult = namedtuple("TempResult", ["means", "pvalues", "n_perms"], defaults=(None,))
+_N_PERMS_BLOCK = 100  # number of permutations per round if stopping early, and per chunk of the cached null
+# CSC stores 12 bytes per nonzero, a dense array 8 bytes per entry
+_MAX_SPARSE_DENSITY = 2 / 3
+
+
+@njit(parallel=True, cache=True, fastmath=False)
+def _cluster_means_csc(
+    data: NDArrayA,  # [np.float64],
+    indices: NDArrayA,  # [np.int32],
+    indptr: NDArrayA,  # [np.int32],
+    clustering: NDArrayA,  # [np.int32],
+    sizes: NDArrayA,  # [np.float64],
+) -> NDArrayA:
+    n_cls, n_genes = sizes.shape[0], indptr.shape[0] - 1
+    # every gene only writes into its own column
+    groups = np.zeros((n_cls, n_genes), dtype=np.float64)
+    for g in prange(n_genes):
+        for k in range(indptr[g], indptr[g + 1]):
+            groups[clustering[indices[k]], g] += data[k]
+        for c in range(n_cls):
+            groups[c, g] /= sizes[c]
+
+    return groups
+
+
+@njit(parallel=True, cache=True, fastmath=False)
+def _cluster_means_dense(
+    data: NDArrayA,  # [np.float64], Fortran contiguous
+    clustering: NDArrayA,  # [np.int32],
+    sizes: NDArrayA,  # [np.float64],
+) -> NDArrayA:
+    n_cls, n_genes = sizes.shape[0], data.shape[1]
+    groups = np.zeros((n_cls, n_genes), dtype=np.float64)
+    for g in prange(n_genes):
+        for row in range(data.shape[0]):
+            groups[clustering[row], g] += data[row, g]
+        for c in range(n_cls):
+            groups[c, g] /= sizes[c]
+
+    return groups
+
+
+def _cluster_means_batch(data: NDArrayA | csr_matrix, clusterings: NDArrayA, sizes: NDArrayA) -> NDArrayA:
+    """
+    Compute the cluster means of several clusterings in one sparse matrix product.
+
+    Parameters
+    ----------
+    data
+        Sparse matrix in CSR format or C contiguous array of shape `(n_cells, n_genes)`.
+    clusterings
+        Array of shape `(n_perms, n_cells)`.
+    sizes
+        Array of shape `(n_clusters,)` containing the cluster sizes.
 
-_template = """
-@njit(parallel={parallel}, cache=False, fastmath=False)
-def _test_{n_cls}_{ret_means}_{parallel}(
+    Returns
+    -------
+    Array of shape `(n_perms, n_clusters, n_genes)`. Every row of the one-hot matrix sums the cells in their order,
+    same as :func:`_cluster_means_csc` and :func:`_cluster_means_dense`, so the means are equal bit by bit.
+    """
+    n_perms, n_cells = clusterings.shape
+    n_cls = sizes.shape[0]
+    rows = (clusterings + n_cls * np.arange(n_perms)[:, None]).ravel()
+    cols = np.tile(np.arange(n_cells), n_perms)
+    onehot = csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, cols)), shape=(n_perms * n_cls, n_cells))
+
+    groups = onehot @ data
+    groups = groups.toarray() if issparse(groups) else np.asarray(groups)
+
+    return groups.reshape(n_perms, n_cls, -1) / sizes[None, :, None]  # type: ignore[no-any-return]
+
+
+@njit(parallel=True, cache=True, fastmath=False)
+def _test(
     interactions: NDArrayA,  # [np.uint32],
     interaction_clusters: NDArrayA,  # [np.uint32],
-    data: NDArrayA,  # [np.float64],
-    clustering: NDArrayA,  # [np.uint32],
+    groups: NDArrayA,  # [np.float64],
     mean: NDArrayA,  # [np.float64],
     mask: NDArrayA,  # [np.bool_],
     res: NDArrayA,  # [np.float64],
-    {args}
+    res_means: NDArrayA,  # [np.float64],
+    return_means: bool,
 ) -> None:
-
-    {init}
-    {loop}
-    {finalize}
-
     for i in prange(len(interactions)):
         rec, lig = interactions[i]
-        for j in prange(len(interaction_clusters)):
+        for j in range(len(interaction_clusters)):
             c1, c2 = interaction_clusters[j]
             m1, m2 = mean[rec, c1], mean[lig, c2]
 
@@ -69,7 +149,8 @@ def _test_{n_cls}_{ret_means}_{parallel}(
                 continue
 
             if m1 > 0 and m2 > 0:
-                {set_means}
+                if return_means:
+                    res_means[i, j] = (m1 + m2) / 2.0
                 if mask[rec, c1] and mask[lig, c2]:
                     # both rec, lig are sufficiently expressed in c1, c2
                     res[i, j] += (groups[c1, rec] + groups[c2, lig]) > (m1 + m2)
@@ -78,57 +159,6 @@ def _test_{n_cls}_{ret_means}_{parallel}(
             else:
                 # res_means is initialized with 0s
                 res[i, j] = np.nan
-"""
-
-
-def _create_template(n_cls: int, return_means: bool = False, parallel: bool = True) -> str:
-    if n_cls <= 0:
-        raise ValueError(f"Expected number of clusters to be positive, found `{n_cls}`.")
-
-    rng = range(n_cls)
-    init = "".join(
-        f"""
-    g{i} = np.zeros((data.shape[1],), dtype=np.float64); s{i} = 0"""
-        for i in rng
-    )
-
-    loop_body = """
-        if cl == 0:
-            g0 += data[row]
-            s0 += 1"""
-    loop_body = loop_body + "".join(
-        f"""
-        elif cl == {i}:
-            g{i} += data[row]
-            s{i} += 1"""
-        for i in range(1, n_cls)
-    )
-    loop = f"""
-    for row in prange(data.shape[0]):
-        cl = clustering[row]
-        {loop_body}
-        else:
-            assert False, "Unhandled case."
-    """
-    finalize = ", ".join(f"g{i} / s{i}" for i in rng)
-    finalize = f"groups = np.stack(({finalize}))"
-
-    if return_means:
-        args = "res_means: NDArrayA,  # [np.float64]"
-        set_means = "res_means[i, j] = (m1 + m2) / 2.0"
-    else:
-        args = set_means = ""
-
-    return _template.format(
-        n_cls=n_cls,
-        parallel=bool(parallel),
-        ret_means=int(return_means),
-        args=args,
-        init=init,
-        loop=loop,
-        finalize=finalize,
-        set_means=set_means,
-    )
 
 
 def _fdr_correct(
@@ -319,6 +349,10 @@ class PermutationTestABC(ABC):
         copy: bool = False,
         key_added: str | None = None,
         numba_parallel: bool | None = None,
+        library_key: str | None = None,
+        early_stopping: int | None = None,
+        batch_size: int | None = None,
+        null_cache: str | Path | None = None,
         **kwargs: Any,
     ) -> Mapping[str, pd.DataFrame] | None:
         """
@@ -348,6 +382,21 @@ class PermutationTestABC(ABC):
             Key in :attr:`anndata.AnnData.uns` where the result is stored if ``copy = False``.
             If `None`, ``'{{cluster_key}}_ligrec'`` will be used.
         %(numba_parallel)s
+        library_key
+            Key in :attr:`anndata.AnnData.obs` containing the library ids. If not `None`, the cluster labels are
+            only permuted within each library.
+        %(early_stopping)s
+        batch_size
+            Number of permutations whose cluster means are computed together, by multiplying the stacked one-hot
+            cluster matrices with the expression matrix. This trades memory, ``batch_size * n_clusters * n_genes``
+            values, for fewer passes over the data. If `None`, compute the cluster means one permutation at a time.
+            The p-values are the same in both cases.
+        null_cache
+            Path to a :mod:`zarr` store where the per-cluster means of every permutation are saved, one array per gene.
+            The permutations shuffle the cells of all clusters, such that a later test on the same data, ``n_perms``,
+            ``seed`` and ``n_jobs`` only computes the means of the genes that are not in the store yet, whichever
+            ``clusters`` are tested. This makes testing other interactions or cluster pairs cheap.
+            Requires ``seed`` and cannot be combined with ``early_stopping``.
         %(parallelize)s
 
         Returns
@@ -355,7 +404,18 @@ class PermutationTestABC(ABC):
         %(ligrec_test_returns)s
         """
         _assert_positive(n_perms, name="n_perms")
+        if early_stopping is not None:
+            _assert_positive(early_stopping, name="early_stopping")
+        if batch_size is not None:
+            _assert_positive(batch_size, name="batch_size")
+        if null_cache is not None:
+            if seed is None:
+                raise ValueError("Unable to cache the permutations without a `seed`.")
+            if early_stopping is not None:
+                raise ValueError("Unable to cache the permutations when `early_stopping` is not `None`.")
         _assert_categorical_obs(self._adata, key=cluster_key)
+        if library_key is not None:
+            _assert_categorical_obs(self._adata, key=library_key)
 
         if corr_method is not None:
             corr_axis = CorrAxis(corr_axis)
@@ -387,7 +447,10 @@ class PermutationTestABC(ABC):
         )
         clusters_flat = list({c for cs in clusters for c in cs})
 
-        data = self._filtered_data.loc[np.isin(self._filtered_data["clusters"], clusters_flat), :]
+        # the cached permutations are of all clusters, only the tested clusters are read from the cache
+        keep = self._filtered_data["clusters"].cat.categories if null_cache is not None else clusters_flat
+        mask = np.isin(self._filtered_data["clusters"], keep)
+        data = self._filtered_data.loc[mask, :]
         data["clusters"] = data["clusters"].cat.remove_unused_categories()
         cat = data["clusters"].cat
 
@@ -415,8 +478,13 @@ class PermutationTestABC(ABC):
             seed=seed,
             n_jobs=n_jobs,
             numba_parallel=numba_parallel,
+            libraries=None if library_key is None else self._adata.obs[library_key].cat.codes.values[mask],
+            early_stopping=early_stopping,
+            batch_size=batch_size,
+            null_cache=null_cache,
             **kwargs,
         )
+        n_perms_used = res.n_perms
         res = {
             "means": _create_sparse_df(
                 res.means,
@@ -433,6 +501,8 @@ class PermutationTestABC(ABC):
             "metadata": self.interactions[self.interactions.columns.difference([SOURCE, TARGET])],
         }
         res["metadata"].index = res["means"].index.copy()
+        if n_perms_used is not None:
+            res["n_perms"] = pd.DataFrame(n_perms_used, index=res["means"].index, columns=res["means"].columns)
 
         if TYPE_CHECKING:
             assert isinstance(res, dict)
@@ -566,6 +636,8 @@ class PermutationTest(PermutationTestABC):
         interactions_params: Mapping[str, Any] = MappingProxyType({}),
         transmitter_params: Mapping[str, Any] = MappingProxyType({"categories": "ligand"}),
         receiver_params: Mapping[str, Any] = MappingProxyType({"categories": "receptor"}),
+        cache_dir: str | Path | None = None,
+        offline: bool = False,
         **_: Any,
     ) -> PermutationTest:
         """
@@ -584,41 +656,139 @@ class PermutationTest(PermutationTestABC):
         receiver_params
             Keyword arguments for :func:`omnipath.interactions.import_intercell_network` defining the receiver
             side of intercellular connections.
+        cache_dir
+            Directory where the interactions from :mod:`omnipath` are cached, keyed by ``interactions_params``,
+            ``transmitter_params`` and ``receiver_params``. If `None`, don't cache the interactions.
+        offline
+            Whether to only load the interactions from ``cache_dir``, without accessing the network.
 
         Returns
         -------
         %(PT_prepare.returns)s
         """  # noqa: D400
         if interactions is None:
-            from omnipath.interactions import import_intercell_network
-
-            start = logg.info("Fetching interactions from `omnipath`")
-            interactions = import_intercell_network(
-                interactions_params=interactions_params,
-                transmitter_params=transmitter_params,
-                receiver_params=receiver_params,
-            )
-            if TYPE_CHECKING:
-                assert isinstance(interactions, pd.DataFrame)
-
-            logg.info(f"Fetched `{len(interactions)}` interactions\n    Finish", time=start)
-
-            # we don't really care about these
-            if SOURCE in interactions.columns:
-                interactions.pop(SOURCE)
-            if TARGET in interactions.columns:
-                interactions.pop(TARGET)
-            interactions.rename(
-                columns={"genesymbol_intercell_source": SOURCE, "genesymbol_intercell_target": TARGET}, inplace=True
-            )
-
-            interactions[SOURCE] = interactions[SOURCE].str.replace("^COMPLEX:", "", regex=True)
-            interactions[TARGET] = interactions[TARGET].str.replace("^COMPLEX:", "", regex=True)
+            params = (interactions_params, transmitter_params, receiver_params)
+            path = None if cache_dir is None else _interactions_cache_path(cache_dir, *params)
+            if path is not None and path.is_file():
+                interactions = _load_interactions(path)
+                logg.debug(f"Loaded `{len(interactions)}` interactions from `{path}`")
+            elif offline:
+                if path is None:
+                    raise ValueError("Unable to load the interactions offline without `cache_dir`.")
+                raise FileNotFoundError(
+                    f"No cached interactions found in `{path}`. Fetch them once with `offline=False` first."
+                )
+            else:
+                interactions = _fetch_interactions(*params)
+                if path is not None:
+                    _save_interactions(interactions, path)
+                    logg.debug(f"Saved `{len(interactions)}` interactions to `{path}`")
 
         _ = super().prepare(interactions, complex_policy=complex_policy)
         return self
 
 
+def _fetch_interactions(
+    interactions_params: Mapping[str, Any],
+    transmitter_params: Mapping[str, Any],
+    receiver_params: Mapping[str, Any],
+) -> pd.DataFrame:
+    """Fetch the interactions from :mod:`omnipath` and normalize the gene symbols."""
+    from omnipath.interactions import import_intercell_network
+
+    start = logg.info("Fetching interactions from `omnipath`")
+    interactions = import_intercell_network(
+        interactions_params=interactions_params,
+        transmitter_params=transmitter_params,
+        receiver_params=receiver_params,
+    )
+    if TYPE_CHECKING:
+        assert isinstance(interactions, pd.DataFrame)
+
+    logg.info(f"Fetched `{len(interactions)}` interactions\n    Finish", time=start)
+
+    # we don't really care about these
+    if SOURCE in interactions.columns:
+        interactions.pop(SOURCE)
+    if TARGET in interactions.columns:
+        interactions.pop(TARGET)
+    interactions.rename(
+        columns={"genesymbol_intercell_source": SOURCE, "genesymbol_intercell_target": TARGET}, inplace=True
+    )
+
+    interactions[SOURCE] = interactions[SOURCE].str.replace("^COMPLEX:", "", regex=True).str.upper()
+    interactions[TARGET] = interactions[TARGET].str.replace("^COMPLEX:", "", regex=True).str.upper()
+
+    return interactions
+
+
+def _interactions_cache_path(
+    cache_dir: str | Path,
+    interactions_params: Mapping[str, Any],
+    transmitter_params: Mapping[str, Any],
+    receiver_params: Mapping[str, Any],
+) -> Path:
+    query = json.dumps(
+        [dict(interactions_params), dict(transmitter_params), dict(receiver_params)], sort_keys=True, default=str
+    )
+    h = hashlib.blake2b(query.encode(), digest_size=16)
+
+    return Path(cache_dir) / f"omnipath_{h.hexdigest()}.npz"
+
+
+def _save_interactions(interactions: pd.DataFrame, path: str | Path) -> None:
+    """
+    Save the interactions column by column to a :func:`numpy.savez` file.
+
+    The numeric and boolean columns are stored as is. The other columns are stored with their data type: the values
+    of the boolean and numeric ones, e.g. :class:`object` columns of booleans and `NaN`, with a mask of the missing
+    values, the rest as categorical codes and string categories.
+    """
+    arrays = {"columns": np.asarray([str(c) for c in interactions.columns], dtype=str)}
+    for i, (_, col) in enumerate(interactions.items()):
+        if isinstance(col.dtype, np.dtype) and col.dtype.kind in "biuf":
+            arrays[f"c{i}"] = col.values
+            continue
+
+        arrays[f"c{i}_dtype"] = np.asarray(str(col.dtype))
+        na, obj = col.isna().values, col.astype(object)
+        kind = pd.api.types.infer_dtype(obj, skipna=True)
+        if kind in ("boolean", "integer", "floating", "mixed-integer-float"):
+            dtype = {"boolean": np.bool_, "integer": np.int64}.get(kind, np.float64)
+            arrays[f"c{i}"] = np.asarray(obj.where(~na, 0).tolist(), dtype=dtype)
+            arrays[f"c{i}_na"] = na
+        else:
+            cat = pd.Categorical(obj.where(na, obj.astype(str)))
+            arrays[f"c{i}"] = cat.codes
+            arrays[f"c{i}_categories"] = np.asarray(cat.categories, dtype=str)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as fout:
+        np.savez(fout, **arrays)
+    os.replace(tmp, path)
+
+
+def _load_interactions(path: str | Path) -> pd.DataFrame:
+    """Load the interactions saved by :func:`_save_interactions`."""
+    with np.load(path, allow_pickle=False) as data:
+        columns = {}
+        for i, name in enumerate(data["columns"]):
+            if f"c{i}_categories" in data.files:
+                cat = pd.Categorical.from_codes(data[f"c{i}"], categories=data[f"c{i}_categories"])
+                columns[name] = np.asarray(cat, dtype=object)
+            elif f"c{i}_na" in data.files:
+                columns[name] = data[f"c{i}"].astype(object)
+                columns[name][data[f"c{i}_na"]] = np.nan
+            else:
+                columns[name] = data[f"c{i}"]
+            if f"c{i}_dtype" in data.files:
+                columns[name] = pd.Series(columns[name]).astype(str(data[f"c{i}_dtype"]))
+
+    return pd.DataFrame(columns, columns=list(columns))
+
+
 @d.dedent
 def ligrec(
     adata: AnnData,
@@ -675,6 +845,10 @@ def _analysis(
     seed: int | None = None,
     n_jobs: int = 1,
     numba_parallel: bool | None = None,
+    libraries: NDArrayA | None = None,
+    early_stopping: int | None = None,
+    batch_size: int | None = None,
+    null_cache: str | Path | None = None,
     **kwargs: Any,
 ) -> TempResult:
     """
@@ -685,7 +859,7 @@ def _analysis(
     Parameters
     ----------
     data
-        Array of shape `(n_cells, n_genes)`.
+        Data frame of shape `(n_cells, n_genes + 1)` with sparse gene columns and the `'clusters'` column.
     interactions
         Array of shape `(n_interactions, 2)`.
     interaction_clusters
@@ -698,6 +872,15 @@ def _analysis(
         Number of parallel jobs to launch.
     numba_parallel
         Whether to use :class:`numba.prange` or not. If `None`, it's determined automatically.
+    libraries
+        Array of shape `(n_cells,)` containing the library codes. If not `None`, the clusters are only permuted
+        within each library.
+    %(early_stopping)s
+    batch_size
+        Number of permutations whose cluster means are computed in one sparse matrix product.
+        If `None`, use the :mod:`numba` kernels.
+    null_cache
+        Path to a :mod:`zarr` store with the per-cluster means of the permutations, see :func:`_load_null`.
     kwargs
         Keyword arguments for :func:`squidpy._utils.parallelize`, such as ``n_jobs`` or ``backend``.
 
@@ -707,60 +890,147 @@ def _analysis(
 
         - `'means'` - array of shape `(n_interactions, n_interaction_clusters)` containing the means.
         - `'pvalues'` - array of shape `(n_interactions, n_interaction_clusters)` containing the p-values.
+        - `'n_perms'` - array of shape `(n_interactions, n_interaction_clusters)` containing the number of
+          permutations used for each p-value, `None` if ``early_stopping = None``.
     """
 
     def extractor(res: Sequence[TempResult]) -> TempResult:
-        assert len(res) == n_jobs, f"Expected to find `{n_jobs}` results, found `{len(res)}`."
-
         meanss: list[NDArrayA] = [r.means for r in res if r.means is not None]
-        assert len(meanss) == 1, f"Only `1` job should've calculated the means, but found `{len(meanss)}`."
-        means = meanss[0]
-        if TYPE_CHECKING:
-            assert isinstance(means, np.ndarray)
+        assert len(meanss) <= 1, f"Only `1` job should've calculated the means, but found `{len(meanss)}`."
+        # the counts of `T0 > T`, the means are only calculated in the job with the first permutation
+        counts = np.sum([r.pvalues for r in res if r.pvalues is not None], axis=0)
 
-        pvalues = np.sum([r.pvalues for r in res if r.pvalues is not None], axis=0) / float(n_perms)
-        assert means.shape == pvalues.shape, f"Means and p-values differ in shape: `{means.shape}`, `{pvalues.shape}`."
+        return TempResult(means=meanss[0] if len(meanss) else None, pvalues=counts)
 
-        return TempResult(means=means, pvalues=pvalues)
-
-    groups = data.groupby("clusters")
     clustering = np.array(data["clusters"].values, dtype=np.int32)
-
-    mean = groups.mean().values.T  # (n_genes, n_clusters)
-    mask = groups.apply(lambda c: ((c > 0).sum() / len(c)) >= threshold).values.T  # (n_genes, n_clusters)
-    # (n_cells, n_genes)
-    data = np.array(data[data.columns.difference(["clusters"])].values, dtype=np.float64, order="C")
-    # all 3 should be C contiguous
-
-    return parallelize(  # type: ignore[no-any-return]
-        _analysis_helper,
-        np.arange(n_perms, dtype=np.int32),
-        n_jobs=n_jobs,
-        unit="permutation",
-        extractor=extractor,
-        **kwargs,
-    )(
-        data,
-        mean,
-        mask,
-        interactions,
-        interaction_clusters=interaction_clusters,
-        clustering=clustering,
-        seed=seed,
-        numba_parallel=numba_parallel,
+    n_cls = len(data["clusters"].cat.categories)
+    # (n_cells, n_genes), only the nonzeros are stored
+    data = csc_matrix(data.drop(columns="clusters").sparse.to_coo(), dtype=np.float64)
+
+    # (n_clusters, n_cells) one-hot matrix, the per-cluster statistics are sums over the nonzeros
+    onehot = csr_matrix(
+        (np.ones_like(clustering, dtype=np.float64), (clustering, np.arange(len(clustering)))),
+        shape=(n_cls, len(clustering)),
     )
+    sizes = np.bincount(clustering, minlength=n_cls)
+    mean = np.asarray((onehot @ data).todense()).T / sizes  # (n_genes, n_clusters)
+    expressed = onehot @ csc_matrix((data.data > 0, data.indices, data.indptr), shape=data.shape, dtype=np.float64)
+    mask = (np.asarray(expressed.todense()).T / sizes) >= threshold  # (n_genes, n_clusters)
+    # `_test` is compiled for C-contiguous arrays, other layouts or dtypes would each compile a new signature
+    mean, mask = np.ascontiguousarray(mean), np.ascontiguousarray(mask)
+    interactions = np.ascontiguousarray(interactions, dtype=np.uint32)
+    interaction_clusters = np.ascontiguousarray(interaction_clusters, dtype=np.uint32)
+    if null_cache is not None:
+        clusters, ixs = np.unique(interaction_clusters, return_inverse=True)
+        null = _load_null(
+            null_cache,
+            data,
+            clustering,
+            libraries,
+            clusters=clusters,
+            n_perms=n_perms,
+            seed=seed,
+            n_jobs=n_jobs,
+            batch_size=batch_size,
+            **kwargs,
+        )
+        # the blocks of the null only contain the tested clusters
+        interaction_clusters = np.ascontiguousarray(ixs.reshape(-1, 2), dtype=np.uint32)
+        mean, mask = np.ascontiguousarray(mean[:, clusters]), np.ascontiguousarray(mask[:, clusters])
+        res = np.zeros((len(interactions), len(interaction_clusters)), dtype=np.float64)
+        means = np.zeros_like(res)
+        for i, groups in enumerate(chain.from_iterable(null)):
+            _test(interactions, interaction_clusters, groups, mean, mask, res, means, i == 0)
+
+        return TempResult(means=means, pvalues=res / float(n_perms))
+
+    if data.nnz >= _MAX_SPARSE_DENSITY * np.prod(data.shape):
+        # the dense array is smaller than the sparse one
+        data = data.toarray(order="F")
+
+    strata = None if libraries is None else _get_strata(libraries)
+
+    if early_stopping is None:
+        res = parallelize(
+            _analysis_helper,
+            np.arange(n_perms, dtype=np.int32),
+            n_jobs=n_jobs,
+            unit="permutation",
+            extractor=extractor,
+            **kwargs,
+        )(
+            data,
+            mean,
+            mask,
+            interactions,
+            interaction_clusters=interaction_clusters,
+            clustering=clustering,
+            strata=strata,
+            seed=seed,
+            numba_parallel=numba_parallel,
+            batch_size=batch_size,
+        )
+        assert (
+            res.means.shape == res.pvalues.shape
+        ), f"Means and p-values differ in shape: `{res.means.shape}`, `{res.pvalues.shape}`."
+
+        return TempResult(means=res.means, pvalues=res.pvalues / float(n_perms))
+
+    # sequential test: permute in rounds, only the interactions with any undecided cluster pair are tested again
+    counts = np.zeros((len(interactions), len(interaction_clusters)), dtype=np.float64)
+    n_used = np.zeros(counts.shape, dtype=np.int64)
+    undecided = np.ones(counts.shape, dtype=bool)
+    means = None
+    block = max(_N_PERMS_BLOCK, n_jobs)
+    for start in range(0, n_perms, block):
+        rows = np.flatnonzero(undecided.any(axis=1))
+        if not len(rows):
+            break
+        perms = np.arange(start, min(start + block, n_perms), dtype=np.int32)
+        genes, ixs = np.unique(interactions[rows], return_inverse=True)
+
+        res = parallelize(
+            _analysis_helper,
+            perms,
+            n_jobs=min(n_jobs, len(perms)),
+            unit="permutation",
+            extractor=extractor,
+            **kwargs,
+        )(
+            data[:, genes] if issparse(data) else np.asfortranarray(data[:, genes]),
+            np.ascontiguousarray(mean[genes]),
+            np.ascontiguousarray(mask[genes]),
+            np.ascontiguousarray(ixs.reshape(-1, 2), dtype=np.uint32),
+            interaction_clusters=interaction_clusters,
+            clustering=clustering,
+            strata=strata,
+            seed=seed,
+            numba_parallel=numba_parallel,
+            batch_size=batch_size,
+        )
+        if means is None:
+            means = res.means
+
+        # the untested combinations are `NaN` in every permutation
+        counts[rows] += np.where(undecided[rows], res.pvalues, 0)
+        n_used[rows] += undecided[rows] * len(perms)
+        undecided &= counts < early_stopping
+
+    return TempResult(means=means, pvalues=counts / n_used, n_perms=n_used)
 
 
 def _analysis_helper(
     perms: NDArrayA,
-    data: NDArrayA,
+    data: NDArrayA | csc_matrix,
     mean: NDArrayA,
     mask: NDArrayA,
     interactions: NDArrayA,
     interaction_clusters: NDArrayA,
     clustering: NDArrayA,
+    strata: Sequence[NDArrayA] | None = None,
     seed: int | None = None,
     numba_parallel: bool | None = None,
+    batch_size: int | None = None,
     queue: SigQueue | None = None,
 ) -> TempResult:
     """
@@ -771,7 +1041,7 @@ def _analysis_helper(
     perms
         Permutation indices. Only used to set the ``seed``.
     data
-        Array of shape `(n_cells, n_genes)`.
+        Sparse matrix in CSC format or Fortran contiguous array of shape `(n_cells, n_genes)`.
     mean
         Array of shape `(n_genes, n_clusters)` representing mean expression per cluster.
     mask
@@ -783,10 +1053,15 @@ def _analysis_helper(
         Array of shape `(n_interaction_clusters, 2)`.
     clustering
         Array of shape `(n_cells,)` containing the original clustering.
+    strata
+        Indices of the cells of each library, within which the clustering is permuted. If `None`, permute all cells.
     seed
         Random seed for :class:`numpy.random.RandomState`.
     numba_parallel
         Whether to use :class:`numba.prange` or not. If `None`, it's determined automatically.
+    batch_size
+        Number of permutations whose cluster means are computed in one sparse matrix product.
+        If `None`, use the :mod:`numba` kernels.
     queue
         Signalling queue to update progress bar.
 
@@ -799,36 +1074,71 @@ def _analysis_helper(
         - `'pvalues'` - array of shape `(n_interactions, n_interaction_clusters)`  containing `np.sum(T0 > T)`
           where `T0` is the test statistic under null hypothesis and `T` is the true test statistic.
     """
-    rs = np.random.RandomState(None if seed is None else perms[0] + seed)
-
-    clustering = clustering.copy()
-    n_cls = mean.shape[1]
     return_means = np.min(perms) == 0
 
     # ideally, these would be both sparse array, but there is no numba impl. (sparse.COO is read-only and very limited)
     # keep it f64, because we're setting NaN
     res = np.zeros((len(interactions), len(interaction_clusters)), dtype=np.float64)
+    res_means = np.zeros(res.shape if return_means else (0, 0), dtype=np.float64)
     numba_parallel = (
         (np.prod(res.shape) >= 2**20 or clustering.shape[0] >= 2**15) if numba_parallel is None else numba_parallel
     )
 
-    fn_key = f"_test_{n_cls}_{int(return_means)}_{bool(numba_parallel)}"
-    if fn_key not in globals():
-        exec(
-            compile(_create_template(n_cls, return_means=return_means, parallel=numba_parallel), "", "exec"), globals()
-        )
-    _test = globals()[fn_key]
+    n_threads = get_num_threads()
+    try:
+        set_num_threads(n_threads if numba_parallel else 1)
+        for groups in _permuted_means(perms, data, clustering, strata=strata, seed=seed, batch_size=batch_size):
+            _test(interactions, interaction_clusters, groups, mean, mask, res, res_means, return_means)
 
-    if return_means:
-        res_means: NDArrayA | None = np.zeros((len(interactions), len(interaction_clusters)), dtype=np.float64)
-        test = partial(_test, res_means=res_means)
-    else:
-        res_means = None
-        test = _test
+            if queue is not None:
+                queue.put(Signal.UPDATE)
+    finally:
+        set_num_threads(n_threads)
 
-    for _ in perms:
-        rs.shuffle(clustering)
-        test(interactions, interaction_clusters, data, clustering, mean, mask, res=res)
+    if queue is not None:
+        queue.put(Signal.FINISH)
+
+    return TempResult(means=res_means if return_means else None, pvalues=res)
+
+
+def _null_helper(
+    perms: NDArrayA,
+    data: csc_matrix,
+    clustering: NDArrayA,
+    strata: Sequence[NDArrayA] | None = None,
+    seed: int | None = None,
+    batch_size: int | None = None,
+    queue: SigQueue | None = None,
+) -> NDArrayA:
+    """
+    Compute the per-cluster means of the permutations.
+
+    Parameters
+    ----------
+    perms
+        Permutation indices. Only used to set the ``seed``.
+    data
+        Sparse matrix in CSC format of shape `(n_cells, n_genes)`.
+    clustering
+        Array of shape `(n_cells,)` containing the original clustering.
+    strata
+        Indices of the cells of each library, within which the clustering is permuted. If `None`, permute all cells.
+    seed
+        Random seed for :class:`numpy.random.RandomState`.
+    batch_size
+        Number of permutations whose cluster means are computed in one sparse matrix product.
+        If `None`, use the :mod:`numba` kernels.
+    queue
+        Signalling queue to update progress bar.
+
+    Returns
+    -------
+    Array of shape `(n_perms, n_clusters, n_genes)`.
+    """
+    res = np.empty((len(perms), np.max(clustering) + 1, data.shape[1]), dtype=np.float64)
+    means = _permuted_means(perms, data, clustering, strata=strata, seed=seed, batch_size=batch_size)
+    for i, groups in enumerate(means):
+        res[i] = groups
 
         if queue is not None:
             queue.put(Signal.UPDATE)
@@ -836,4 +1146,105 @@ def _analysis_helper(
     if queue is not None:
         queue.put(Signal.FINISH)
 
-    return TempResult(means=res_means, pvalues=res)
+    return res
+
+
+def _permuted_means(
+    perms: NDArrayA,
+    data: NDArrayA | csc_matrix,
+    clustering: NDArrayA,
+    strata: Sequence[NDArrayA] | None = None,
+    seed: int | None = None,
+    batch_size: int | None = None,
+) -> Iterator[NDArrayA]:
+    """Yield the cluster means of shape `(n_clusters, n_genes)` of each permutation in ``perms``."""
+    rs = np.random.RandomState(None if seed is None else perms[0] + seed)
+    clustering = clustering.copy()
+    sizes = np.bincount(clustering).astype(np.float64)
+
+    if batch_size is not None:
+        data = data.tocsr() if issparse(data) else np.ascontiguousarray(data)
+        for start in range(0, len(perms), batch_size):
+            clusterings = []
+            for _ in perms[start : start + batch_size]:
+                _shuffle(rs, clustering, strata)
+                clusterings.append(clustering.copy())
+
+            yield from _cluster_means_batch(data, np.stack(clusterings), sizes)
+        return
+
+    if issparse(data):
+        cluster_means = partial(_cluster_means_csc, data.data, data.indices, data.indptr)
+    else:
+        cluster_means = partial(_cluster_means_dense, data)
+    for _ in perms:
+        _shuffle(rs, clustering, strata)
+        yield cluster_means(clustering, sizes)
+
+
+def _load_null(
+    path: str | Path,
+    data: csc_matrix,
+    clustering: NDArrayA,
+    libraries: NDArrayA | None = None,
+    clusters: NDArrayA | None = None,
+    n_perms: int = 1000,
+    seed: int | None = None,
+    n_jobs: int = 1,
+    batch_size: int | None = None,
+    **kwargs: Any,
+) -> Iterator[NDArrayA]:
+    """
+    Load the per-cluster means of the permutations from a :mod:`zarr` store.
+
+    The store contains a group per clustering, libraries, ``n_perms``, ``seed`` and ``n_jobs``, which determine the
+    permutations, and an array of shape `(n_perms, n_clusters)` per gene, keyed by its expression.
+    The arrays of the missing genes are computed and saved. The arrays are read in chunks of permutations.
+
+    Yields
+    ------
+    Arrays of shape `(n_block_perms, n_clusters, n_genes)` of the consecutive permutations, with only the
+    ``clusters`` if not `None`.
+    """
+    import zarr
+
+    h = hashlib.blake2b(digest_size=16)
+    for arr in (clustering, np.empty((0,), dtype=np.int32) if libraries is None else np.asarray(libraries)):
+        h.update(str(arr.shape).encode())
+        h.update(np.ascontiguousarray(arr).tobytes())
+    h.update(f"{n_perms}_{seed}_{n_jobs}".encode())
+    group = zarr.open_group(str(path), mode="a").require_group(h.hexdigest())
+
+    keys = []
+    for g in range(data.shape[1]):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(str(data.shape[0]).encode())
+        h.update(data.indices[data.indptr[g] : data.indptr[g + 1]].tobytes())
+        h.update(data.data[data.indptr[g] : data.indptr[g + 1]].tobytes())
+        keys.append(h.hexdigest())
+
+    missing = [g for g, key in enumerate(keys) if key not in group]
+    if missing:
+        null = parallelize(
+            _null_helper,
+            np.arange(n_perms, dtype=np.int32),
+            n_jobs=n_jobs,
+            unit="permutation",
+            extractor=partial(np.concatenate, axis=0),
+            **kwargs,
+        )(
+            data[:, missing],
+            clustering,
+            strata=None if libraries is None else _get_strata(libraries),
+            seed=seed,
+            batch_size=batch_size,
+        )
+        for i, g in enumerate(missing):
+            group.create_dataset(keys[g], data=null[..., i], chunks=(_N_PERMS_BLOCK, None), overwrite=True)
+        logg.debug(f"Saved the permutations of `{len(missing)}` gene(s) to `{path}`")
+        del null
+
+    clusters = slice(None) if clusters is None else np.asarray(clusters)
+    for start in range(0, n_perms, _N_PERMS_BLOCK):
+        perms = slice(start, min(start + _N_PERMS_BLOCK, n_perms))
+        yield np.stack([group[key].get_orthogonal_selection((perms, clusters)) for key in keys], axis=-1)
@@ -8,32 +8,35 @@ from functools import partial
 from scanpy import logging as logg
 from anndata import AnnData
 
-from numba import njit, prange  # noqa: F401
+from numba import njit, prange, get_num_threads
+from scipy.sparse import hstack, vstack, spmatrix, csr_matrix
 import numpy as np
 import pandas as pd
 import numba.types as nt
 
-import networkx as nx
-
 from squidpy._docs import d, inject_docs
 from squidpy._utils import Signal, NDArrayA, SigQueue, parallelize, _get_n_cores
 from squidpy.gr._utils import (
     _save_data,
+    _get_strata,
     _assert_positive,
+    _combine_moments,
     _assert_categorical_obs,
     _assert_connectivity_key,
 )
 from squidpy._constants._constants import Centrality
 from squidpy._constants._pkg_constants import Key
 
-__all__ = ["nhood_enrichment", "centrality_scores", "interaction_matrix"]
+__all__ = ["nhood_enrichment", "centrality_scores", "interaction_matrix", "nhood_composition"]
 
 dt = nt.uint32  # data type aliases (both for numpy and numba should match)
 ndt = np.uint32
-_template = """
-@njit(dt[:, :](dt[:], dt[:], dt[:]), parallel={parallel}, fastmath=True)
-def _nenrich_{n_cls}_{parallel}(indices: NDArrayA, indptr: NDArrayA, clustering: NDArrayA) -> np.ndarray:
-    '''
+_N_PERMS_BLOCK = 100  # number of permutations per compiled call, between the progress bar updates
+
+
+@njit(dt[:, :](dt[:], dt[:], dt[:], nt.int64), fastmath=True, cache=True)
+def _nenrich(indices: NDArrayA, indptr: NDArrayA, clustering: NDArrayA, n_cls: int) -> NDArrayA:
+    """
     Count how many times clusters :math:`i` and :math:`j` are connected.
 
     Parameters
@@ -44,75 +47,238 @@ def _nenrich_{n_cls}_{parallel}(indices: NDArrayA, indptr: NDArrayA, clustering:
         :attr:`scipy.sparse.csr_matrix.indptr`.
     clustering
         Array of shape ``(n_cells,)`` containig cluster labels ranging from `0` to `n_clusters - 1` inclusive.
+    n_cls
+        Number of clusters.
 
     Returns
     -------
     :class:`numpy.ndarray`
         Array of shape ``(n_clusters, n_clusters)`` containing the pairwise counts.
-    '''
-    res = np.zeros((indptr.shape[0] - 1, {n_cls}), dtype=ndt)
+    """
+    res = np.zeros((n_cls, n_cls), dtype=ndt)
+
+    for i in range(indptr.shape[0] - 1):
+        cl = clustering[i]
+        for k in range(indptr[i], indptr[i + 1]):
+            res[cl, clustering[indices[k]]] += 1
+
+    return res
 
-    for i in prange(res.shape[0]):
-        xs, xe = indptr[i], indptr[i + 1]
-        cols = indices[xs:xe]
-        for c in cols:
-            res[i, clustering[c]] += 1
-    {init}
-    {loop}
-    {finalize}
-"""
 
+@njit(dt[:, :](dt[:], dt[:], dt[:], nt.int64, nt.int64), parallel=True, fastmath=True, cache=True)
+def _nenrich_parallel(indices: NDArrayA, indptr: NDArrayA, clustering: NDArrayA, n_cls: int, n_blocks: int) -> NDArrayA:
+    """Parallel version of :func:`_nenrich`, each of the ``n_blocks`` blocks of rows is counted separately."""
+    n_obs = indptr.shape[0] - 1
+    n_blocks = max(min(n_blocks, n_obs), 1)
+    counts = np.zeros((n_blocks, n_cls, n_cls), dtype=ndt)
 
-def _create_function(n_cls: int, parallel: bool = False) -> Callable[[NDArrayA, NDArrayA, NDArrayA], NDArrayA]:
+    for b in prange(n_blocks):
+        for i in range(b * n_obs // n_blocks, (b + 1) * n_obs // n_blocks):
+            cl = clustering[i]
+            for k in range(indptr[i], indptr[i + 1]):
+                counts[b, cl, clustering[indices[k]]] += 1
+
+    res = counts[0]
+    for b in range(1, n_blocks):
+        res += counts[b]
+
+    return res
+
+
+@njit(nogil=True, cache=True)
+def _shuffle_strata(x: NDArrayA, order: NDArrayA, offsets: NDArrayA) -> None:
+    # Fisher-Yates shuffle of `x[order[offsets[s] : offsets[s + 1]]]` for each stratum `s`
+    for s in range(offsets.shape[0] - 1):
+        for i in range(offsets[s + 1] - 1, offsets[s], -1):
+            j, k = order[np.random.randint(offsets[s], i + 1)], order[i]
+            x[j], x[k] = x[k], x[j]
+
+
+@njit(nogil=True, cache=True)
+def _nenrich_perms(
+    rows: NDArrayA,
+    cols: NDArrayA,
+    clustering: NDArrayA,
+    n_cls: int,
+    n_perms: int,
+    seed: int,
+    order: NDArrayA,
+    offsets: NDArrayA,
+    edge_libs: NDArrayA,
+    n_libs: int,
+) -> tuple[NDArrayA, NDArrayA]:
     """
-    Create a :mod:`numba` function which counts the number of connections between clusters.
+    Count the connected clusters for a block of permutations of the cluster labels.
 
     Parameters
     ----------
+    rows
+        Array of shape ``(n_edges,)`` containing the source cell of each edge.
+    cols
+        Array of shape ``(n_edges,)`` containing the target cell of each edge.
+    clustering
+        Array of shape ``(n_cells,)`` containig cluster labels ranging from `0` to `n_clusters - 1` inclusive.
+        It is shuffled in place.
     n_cls
-        Number of clusters. We're assuming that cluster labels are `0`, `1`, ..., `n_cls - 1`.
-    parallel
-        Whether to enable :mod:`numba` parallelization.
+        Number of clusters.
+    n_perms
+        Number of permutations.
+    seed
+        Random seed. The random state of :mod:`numba` is local to each thread.
+    order
+        Array of shape ``(n_permuted_cells,)`` containing the cells sorted by their library.
+    offsets
+        Array of shape ``(n_strata + 1,)`` such that the labels of the cells ``order[offsets[s] : offsets[s + 1]]``
+        are only permuted among themselves.
+    edge_libs
+        Array of shape ``(n_edges,)`` containing the library of the source cell of each edge, `-1` if none.
+        Only used when ``n_libs > 0``.
+    n_libs
+        Number of libraries for which to also count the edges separately.
 
     Returns
     -------
-    The aforementioned function.
+    The mean and the sum of squared deviations from the mean of the counts over the permutations,
+    each of shape ``(1 + n_libs, n_clusters, n_clusters)``. The first entry contains the counts over all edges.
     """
-    if n_cls <= 1:
-        raise ValueError(f"Expected at least `2` clusters, found `{n_cls}`.")
+    np.random.seed(seed)
+    count = np.empty((1 + n_libs, n_cls, n_cls), dtype=ndt)
+    mean = np.zeros((1 + n_libs, n_cls, n_cls), dtype=np.float64)
+    m2 = np.zeros((1 + n_libs, n_cls, n_cls), dtype=np.float64)
+
+    for p in range(n_perms):
+        _shuffle_strata(clustering, order, offsets)
+        count[:] = 0
+        for e in range(rows.shape[0]):
+            a, b = clustering[rows[e]], clustering[cols[e]]
+            count[0, a, b] += 1
+            if n_libs and edge_libs[e] >= 0:
+                count[1 + edge_libs[e], a, b] += 1
+        # Welford's update, the counts over all permutations are never kept
+        for lib in range(1 + n_libs):
+            for i in range(n_cls):
+                for j in range(n_cls):
+                    delta = count[lib, i, j] - mean[lib, i, j]
+                    mean[lib, i, j] += delta / (p + 1)
+                    m2[lib, i, j] += delta * (count[lib, i, j] - mean[lib, i, j])
+
+    return mean, m2
+
+
+def _falling(n: NDArrayA | int, k: int) -> NDArrayA:
+    """Falling factorial ``n * (n - 1) * ... * (n - k + 1)``."""
+    res = np.ones_like(n, dtype=np.float64)
+    for i in range(k):
+        res = res * np.maximum(np.asarray(n, dtype=np.float64) - i, 0)
+    return res
+
+
+def _nhood_enrichment_analytical(
+    indices: NDArrayA, indptr: NDArrayA, int_clust: NDArrayA, n_cls: int
+) -> tuple[NDArrayA, NDArrayA]:
+    """
+    Compute the exact mean and variance of the cluster counts under the permutations of the cluster labels.
 
-    rng = range(n_cls)
-    init = "".join(
-        f"""
-    g{i} = np.zeros(({n_cls},), dtype=ndt)"""
-        for i in rng
-    )
+    The count of clusters :math:`(a, b)` is a sum of indicators over the edges, so its second moment is a sum
+    over the pairs of edges. The probability that a pair of edges has the required labels only depends on how
+    many distinct cells the two edges span and how many of them need to be in each cluster, i.e. on whether
+    the edges are equal, reversed, share their source, target or one cell in the opposite roles, or are disjoint.
+    These pairs are counted from the degrees.
 
-    loop_body = """
-        if cl == 0:
-            g0 += res[row]"""
-    loop_body = loop_body + "".join(
-        f"""
-        elif cl == {i}:
-            g{i} += res[row]"""
-        for i in range(1, n_cls)
-    )
-    loop = f"""
-    for row in prange(res.shape[0]):
-        cl = clustering[row]
-        {loop_body}
-        else:
-            assert False, "Unhandled case."
+    Parameters
+    ----------
+    indices
+        :attr:`scipy.sparse.csr_matrix.indices`.
+    indptr
+        :attr:`scipy.sparse.csr_matrix.indptr`.
+    int_clust
+        Array of shape ``(n_cells,)`` containig cluster labels ranging from `0` to `n_clusters - 1` inclusive.
+    n_cls
+        Number of clusters.
+
+    Returns
+    -------
+    The mean and the variance, each of shape ``(n_clusters, n_clusters)``.
+    """
+    n_obs = len(int_clust)
+    rows = np.repeat(np.arange(n_obs, dtype=np.int64), np.diff(indptr).astype(np.int64))
+    cols = indices.astype(np.int64)
+    loops = rows == cols
+    n_loops = int(loops.sum())
+    if 0 < n_loops < n_obs:
+        raise NotImplementedError(
+            f"Analytical z-scores are only available if either all or none of the cells are connected to themselves, "
+            f"found `{n_loops}` out of `{n_obs}`."
+        )
+    rows, cols = rows[~loops], cols[~loops]
+
+    # pairs of edges `(e, f)` by the cells they share
+    n_edges = float(len(rows))
+    out_deg = np.bincount(rows, minlength=n_obs).astype(np.float64)
+    in_deg = np.bincount(cols, minlength=n_obs).astype(np.float64)
+    n_reversed = float(np.isin(cols * n_obs + rows, rows * n_obs + cols).sum())
+    n_source = (out_deg**2).sum() - n_edges
+    n_target = (in_deg**2).sum() - n_edges
+    n_opposite = 2 * ((out_deg * in_deg).sum() - n_reversed)
+    n_disjoint = n_edges**2 - n_edges - n_reversed - n_source - n_target - n_opposite
+
+    # probabilities that `k` distinct cells have the required labels, the numerators are `0` if `n_obs < k`
+    sizes = np.bincount(int_clust, minlength=n_cls).astype(np.float64)
+    total = {k: max(_falling(n_obs, k), 1.0) for k in (2, 3, 4)}
+    p2 = np.outer(sizes, sizes) / total[2]
+    p3_source = np.outer(sizes, _falling(sizes, 2)) / total[3]
+    p4 = np.outer(_falling(sizes, 2), _falling(sizes, 2)) / total[4]
+
+    mean = n_edges * p2
+    second = n_edges * p2 + n_source * p3_source + n_target * p3_source.T + n_disjoint * p4
+    # the same cluster, any cells can coincide
+    diag = np.diag_indices(n_cls)
+    p2, p3, p4 = (_falling(sizes, k) / total[k] for k in (2, 3, 4))
+    mean[diag] = n_edges * p2
+    second[diag] = (n_edges + n_reversed) * p2 + (n_source + n_target + n_opposite) * p3 + n_disjoint * p4
+
+    var = np.maximum(second - mean**2, 0)
+    if n_loops:
+        # each cell is always connected to itself, regardless of its label
+        mean[diag] += sizes
+
+    return mean, var
+
+
+def _nhood_enrichment_analytical_libraries(
+    adj: spmatrix, int_clust: NDArrayA, n_cls: int, libs: NDArrayA, strata: Sequence[NDArrayA]
+) -> tuple[NDArrayA, NDArrayA]:
     """
-    finalize = ", ".join(f"g{i}" for i in rng)
-    finalize = f"return np.stack(({finalize}))"  # must really be a tuple
+    Compute the exact mean and variance of the cluster counts when the labels are only permuted within libraries.
 
-    fn_key = f"_nenrich_{n_cls}_{parallel}"
-    if fn_key not in globals():
-        template = _template.format(init=init, loop=loop, finalize=finalize, n_cls=n_cls, parallel=parallel)
-        exec(compile(template, "", "exec"), globals())
+    The labels of different libraries are permuted independently, so the moments of the pooled counts
+    are the sums of the moments of the libraries, as long as no edge connects different libraries.
+
+    Returns
+    -------
+    The mean and the variance, each of shape ``(1 + n_libraries, n_clusters, n_clusters)``.
+    The first entry contains the moments of the counts over all edges.
+    """
+    adj = csr_matrix(adj)
+    rows = np.repeat(np.arange(adj.shape[0]), np.diff(adj.indptr))
+    if np.any(libs[rows] != libs[adj.indices]):
+        raise NotImplementedError(
+            "Analytical z-scores with `library_key` are only available if no edge connects different libraries."
+        )
 
-    return globals()[fn_key]  # type: ignore[no-any-return]
+    mean = np.zeros((1 + len(strata), n_cls, n_cls), dtype=np.float64)
+    var = np.zeros_like(mean)
+    for i, ix in enumerate(strata):
+        sub = adj[ix][:, ix]
+        mean[1 + i], var[1 + i] = _nhood_enrichment_analytical(sub.indices, sub.indptr, int_clust[ix], n_cls)
+
+    # the labels of the cells without a library are fixed
+    fixed = libs[rows] < 0
+    np.add.at(mean[0], (int_clust[rows[fixed]], int_clust[adj.indices[fixed]]), 1)
+    mean[0] += mean[1:].sum(axis=0)
+    var[0] = var[1:].sum(axis=0)
+
+    return mean, var
 
 
 @d.get_sections(base="nhood_ench", sections=["Parameters"])
@@ -124,11 +290,13 @@ def nhood_enrichment(
     n_perms: int = 1000,
     numba_parallel: bool = False,
     seed: int | None = None,
+    analytical: bool = False,
+    library_key: str | None = None,
     copy: bool = False,
     n_jobs: int | None = None,
     backend: str = "loky",
     show_progress_bar: bool = True,
-) -> tuple[NDArrayA, NDArrayA] | None:
+) -> tuple[NDArrayA, NDArrayA] | tuple[NDArrayA, NDArrayA, NDArrayA, NDArrayA] | None:
     """
     Compute neighborhood enrichment by permutation test.
 
@@ -140,17 +308,35 @@ def nhood_enrichment(
     %(n_perms)s
     %(numba_parallel)s
     %(seed)s
+    analytical
+        Whether to compute the z-score from the exact mean and variance of the counts under the permutations
+        of the cluster labels, instead of estimating them from ``n_perms`` permutations. This takes
+        `O(nnz + n_clusters^2)` time. Only available if either all or none of the cells are connected to themselves.
+    library_key
+        Key in :attr:`anndata.AnnData.obs` containing the library ids. If not `None`, the cluster labels are only
+        permuted within each library and the z-scores are also computed for the edges of each library separately.
+        The edges are assigned to the library of their source cell. The pooled and the per-library statistics
+        use the same permutations. If ``analytical = True``, the graph must not connect different libraries.
     %(copy)s
     %(parallelize)s
 
     Returns
     -------
-    If ``copy = True``, returns a :class:`tuple` with the z-score and the enrichment count.
+    If ``copy = True``, returns a :class:`tuple` with the z-score and the enrichment count. If ``library_key != None``,
+    the tuple additionally contains the z-scores and the counts of each library, of shape
+    ``(n_libraries, n_clusters, n_clusters)``.
 
     Otherwise, modifies the ``adata`` with the following keys:
 
         - :attr:`anndata.AnnData.uns` ``['{cluster_key}_nhood_enrichment']['zscore']`` - the enrichment z-score.
         - :attr:`anndata.AnnData.uns` ``['{cluster_key}_nhood_enrichment']['count']`` - the enrichment count.
+
+    If ``library_key != None``, additionally:
+
+        - :attr:`anndata.AnnData.uns` ``['{cluster_key}_nhood_enrichment']['library_zscore']`` - the enrichment
+          z-score of each library.
+        - :attr:`anndata.AnnData.uns` ``['{cluster_key}_nhood_enrichment']['library_count']`` - the enrichment
+          count of each library.
     """
     connectivity_key = Key.obsp.spatial_conn(connectivity_key)
     _assert_categorical_obs(adata, cluster_key)
@@ -164,33 +350,205 @@ def nhood_enrichment(
 
     indices, indptr = (adj.indices.astype(ndt), adj.indptr.astype(ndt))
     n_cls = len(clust_map)
+    if n_cls <= 1:
+        raise ValueError(f"Expected at least `2` clusters, found `{n_cls}`.")
 
-    _test = _create_function(n_cls, parallel=numba_parallel)
-    count = _test(indices, indptr, int_clust)
-
-    n_jobs = _get_n_cores(n_jobs)
-    start = logg.info(f"Calculating neighborhood enrichment using `{n_jobs}` core(s)")
-
-    perms = parallelize(
-        _nhood_enrichment_helper,
-        collection=np.arange(n_perms),
-        extractor=np.vstack,
-        n_jobs=n_jobs,
-        backend=backend,
-        show_progress_bar=show_progress_bar,
-    )(callback=_test, indices=indices, indptr=indptr, int_clust=int_clust, n_cls=n_cls, seed=seed)
-    zscore = (count - perms.mean(axis=0)) / perms.std(axis=0)
+    _test = partial(_nenrich_parallel, n_blocks=get_num_threads()) if numba_parallel else _nenrich
+    count = _test(indices, indptr, int_clust, n_cls)
+
+    # edge list, such that the permutations count the `(clustering[row], clustering[col])` pairs directly
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=ndt), np.diff(indptr).astype(np.int64))
+    if library_key is not None:
+        _assert_categorical_obs(adata, library_key)
+        libs = adata.obs[library_key].cat.codes.values
+        n_libs = len(adata.obs[library_key].cat.categories)
+        strata = _get_strata(libs, n_strata=n_libs)
+        edge_libs = libs[rows].astype(np.int64)
+        # counts of each library, the edges without a library are only in the pooled counts
+        valid = edge_libs >= 0
+        lib_count = np.bincount(
+            (edge_libs[valid] * n_cls + int_clust[rows[valid]]) * n_cls + int_clust[indices[valid]],
+            minlength=n_libs * n_cls * n_cls,
+        )
+        lib_count = lib_count.reshape(n_libs, n_cls, n_cls).astype(ndt)
+    else:
+        n_libs, strata, edge_libs = 0, [np.arange(adata.n_obs)], np.empty((0,), dtype=np.int64)
+
+    if analytical:
+        start = logg.info("Calculating analytical neighborhood enrichment")
+        if library_key is None:
+            mean, var = _nhood_enrichment_analytical(indices, indptr, int_clust, n_cls)
+        else:
+            mean, var = _nhood_enrichment_analytical_libraries(adj, int_clust, n_cls, libs, strata)
+    else:
+        n_jobs = _get_n_cores(n_jobs)
+        start = logg.info(f"Calculating neighborhood enrichment using `{n_jobs}` core(s)")
+
+        order = np.concatenate(strata).astype(np.int64)
+        offsets = np.cumsum([0] + [len(ix) for ix in strata]).astype(np.int64)
+        n, mean, m2 = parallelize(
+            _nhood_enrichment_helper,
+            collection=np.arange(n_perms),
+            extractor=_combine_moments,
+            n_jobs=n_jobs,
+            backend=backend,
+            show_progress_bar=show_progress_bar,
+        )(
+            rows=rows,
+            cols=indices,
+            int_clust=int_clust,
+            n_cls=n_cls,
+            order=order,
+            offsets=offsets,
+            edge_libs=edge_libs,
+            n_libs=n_libs,
+            seed=seed,
+        )
+        var = m2 / n
+
+    counts = np.concatenate([count[None], lib_count]) if n_libs else count[None]
+    zscores = (counts - mean) / np.sqrt(var)
+    zscore = zscores[0]
 
     if copy:
-        return zscore, count
-
-    _save_data(
-        adata,
-        attr="uns",
-        key=Key.uns.nhood_enrichment(cluster_key),
-        data={"zscore": zscore, "count": count},
-        time=start,
-    )
+        return (zscore, count) if library_key is None else (zscore, count, zscores[1:], lib_count)
+
+    data = {"zscore": zscore, "count": count}
+    if library_key is not None:
+        data.update({"library_zscore": zscores[1:], "library_count": lib_count})
+    _save_data(adata, attr="uns", key=Key.uns.nhood_enrichment(cluster_key), data=data, time=start)
+
+
+def _undirected_graph(adj: spmatrix) -> tuple[NDArrayA, NDArrayA]:
+    """Return the sorted CSR ``indices`` and ``indptr`` of the symmetrized graph without self-loops."""
+    adj = adj.tocoo()
+    keep = adj.row != adj.col
+    g = csr_matrix((np.ones(keep.sum(), dtype=bool), (adj.row[keep], adj.col[keep])), shape=adj.shape)
+    g = (g + g.T).tocsr()
+    g.sort_indices()
+
+    return g.indices.astype(np.int64), g.indptr.astype(np.int64)
+
+
+@njit(nogil=True, cache=True)
+def _group_closeness(indices: NDArrayA, indptr: NDArrayA, group: NDArrayA) -> float:
+    """Group closeness centrality by a multi-source breadth-first search from the ``group``."""
+    n = indptr.shape[0] - 1
+    dist = np.full(n, -1, dtype=np.int64)
+    queue = np.empty(n, dtype=np.int64)
+    head, tail = 0, 0
+    for s in group:
+        dist[s] = 0
+        queue[tail] = s
+        tail += 1
+
+    total = 0
+    while head < tail:
+        v = queue[head]
+        head += 1
+        for k in range(indptr[v], indptr[v + 1]):
+            w = indices[k]
+            if dist[w] < 0:
+                dist[w] = dist[v] + 1
+                total += dist[w]
+                queue[tail] = w
+                tail += 1
+
+    # the unreachable cells do not contribute to the distances, as in :mod:`networkx`
+    return (n - group.shape[0]) / total if total else 0.0
+
+
+@njit(nogil=True, cache=True)
+def _group_closeness_sampled(indices: NDArrayA, indptr: NDArrayA, sources: NDArrayA, group: NDArrayA) -> float:
+    """Estimate the group closeness centrality from the distances of the ``sources`` to the ``group``."""
+    n = indptr.shape[0] - 1
+    in_group = np.zeros(n, dtype=np.bool_)
+    in_group[group] = True
+    # index of the last search which visited the cell, avoids resetting the arrays for each source
+    seen = np.full(n, -1, dtype=np.int64)
+    dist = np.empty(n, dtype=np.int64)
+    queue = np.empty(n, dtype=np.int64)
+
+    total, n_sources = 0, 0
+    for i in range(sources.shape[0]):
+        s = sources[i]
+        if in_group[s]:
+            continue
+        n_sources += 1
+        seen[s] = i
+        dist[s] = 0
+        queue[0] = s
+        head, tail, found = 0, 1, False
+        while head < tail and not found:
+            v = queue[head]
+            head += 1
+            for k in range(indptr[v], indptr[v + 1]):
+                w = indices[k]
+                if seen[w] == i:
+                    continue
+                if in_group[w]:
+                    total += dist[v] + 1
+                    found = True
+                    break
+                seen[w] = i
+                dist[w] = dist[v] + 1
+                queue[tail] = w
+                tail += 1
+
+    return n_sources / total if total else 0.0
+
+
+@njit(nogil=True, cache=True)
+def _group_degree(indices: NDArrayA, indptr: NDArrayA, group: NDArrayA) -> float:
+    """Fraction of the cells outside of the ``group`` which are connected to it."""
+    n = indptr.shape[0] - 1
+    if n == group.shape[0]:
+        return 0.0
+    mark = np.zeros(n, dtype=np.bool_)
+    mark[group] = True
+
+    n_neighbors = 0
+    for s in group:
+        for k in range(indptr[s], indptr[s + 1]):
+            w = indices[k]
+            if not mark[w]:
+                mark[w] = True
+                n_neighbors += 1
+
+    return n_neighbors / (n - group.shape[0])
+
+
+@njit(parallel=True, cache=True)
+def _local_clustering(indices: NDArrayA, indptr: NDArrayA) -> NDArrayA:
+    """Clustering coefficient of each cell, counting the triangles by merging the sorted neighborhoods."""
+    n = indptr.shape[0] - 1
+    res = np.zeros(n, dtype=np.float64)
+
+    for v in prange(n):
+        deg = indptr[v + 1] - indptr[v]
+        if deg < 2:
+            continue
+        # each triangle is counted twice
+        n_triangles = 0
+        for k in range(indptr[v], indptr[v + 1]):
+            w = indices[k]
+            i, j = indptr[v], indptr[w]
+            while i < indptr[v + 1] and j < indptr[w + 1]:
+                if indices[i] < indices[j]:
+                    i += 1
+                elif indices[i] > indices[j]:
+                    j += 1
+                else:
+                    n_triangles += 1
+                    i += 1
+                    j += 1
+        res[v] = n_triangles / (deg * (deg - 1))
+
+    return res
+
+
+def _average_clustering(clustering: NDArrayA, group: NDArrayA) -> float:
+    return float(clustering[group].mean()) if len(group) else np.nan
 
 
 @d.dedent
@@ -200,6 +558,8 @@ def centrality_scores(
     cluster_key: str,
     score: str | Iterable[str] | None = None,
     connectivity_key: str | None = None,
+    n_samples: int | None = None,
+    seed: int | None = None,
     copy: bool = False,
     n_jobs: int | None = None,
     backend: str = "loky",
@@ -215,14 +575,20 @@ def centrality_scores(
     %(adata)s
     %(cluster_key)s
     score
-        Centrality measures as described in :mod:`networkx.algorithms.centrality` :cite:`networkx`.
-        If `None`, use all the options below. Valid options are:
+        Centrality measures as described in :mod:`networkx.algorithms.centrality` :cite:`networkx`,
+        computed on the undirected, unweighted connectivity graph. If `None`, use all the options below.
+        Valid options are:
 
             - `{c.CLOSENESS.s!r}` - measure of how close the group is to other nodes.
             - `{c.CLUSTERING.s!r}` - measure of the degree to which nodes cluster together.
             - `{c.DEGREE.s!r}` - fraction of non-group members connected to group members.
 
     %(conn_key)s
+    n_samples
+        Number of randomly sampled cells from which to estimate the `{c.CLOSENESS.s!r}`, by searching the
+        shortest path from each sampled cell to the group. If `None`, compute it exactly by a breadth-first search
+        from the whole group, which takes `O(nnz)` time per cluster.
+    %(seed)s
     %(copy)s
     %(parallelize)s
 
@@ -243,8 +609,10 @@ def centrality_scores(
         centrality = [c.s for c in Centrality]
 
     centralities = [Centrality(c) for c in centrality]
+    if n_samples is not None:
+        _assert_positive(n_samples, name="n_samples")
 
-    graph = nx.Graph(adata.obsp[connectivity_key])
+    indices, indptr = _undirected_graph(adata.obsp[connectivity_key])
 
     cat = adata.obs[cluster_key].cat.categories.values
     clusters = adata.obs[cluster_key].values
@@ -252,11 +620,16 @@ def centrality_scores(
     fun_dict = {}
     for c in centralities:
         if c == Centrality.CLOSENESS:
-            fun_dict[c.s] = partial(nx.algorithms.centrality.group_closeness_centrality, graph)
+            if n_samples is None:
+                fun_dict[c.s] = partial(_group_closeness, indices, indptr)
+            else:
+                rs = np.random.RandomState(seed)
+                sources = rs.choice(adata.n_obs, size=min(n_samples, adata.n_obs), replace=False)
+                fun_dict[c.s] = partial(_group_closeness_sampled, indices, indptr, sources)
         elif c == Centrality.DEGREE:
-            fun_dict[c.s] = partial(nx.algorithms.centrality.group_degree_centrality, graph)
+            fun_dict[c.s] = partial(_group_degree, indices, indptr)
         elif c == Centrality.CLUSTERING:
-            fun_dict[c.s] = partial(nx.algorithms.cluster.average_clustering, graph)
+            fun_dict[c.s] = partial(_average_clustering, _local_clustering(indices, indptr))
         else:
             raise NotImplementedError(f"Centrality `{c}` is not yet implemented.")
 
@@ -285,79 +658,259 @@ def centrality_scores(
 @d.dedent
 def interaction_matrix(
     adata: AnnData,
-    cluster_key: str,
+    cluster_key: str | Sequence[str],
     connectivity_key: str | None = None,
     normalized: bool = False,
     copy: bool = False,
     weights: bool = False,
-) -> NDArrayA | None:
+    library_key: str | None = None,
+) -> NDArrayA | tuple[NDArrayA, NDArrayA] | dict[str, NDArrayA | tuple[NDArrayA, NDArrayA]] | None:
     """
     Compute interaction matrix for clusters.
 
     Parameters
     ----------
     %(adata)s
-    %(cluster_key)s
+    cluster_key
+        Key(s) in :attr:`anndata.AnnData.obs` where clustering is stored. The matrices of all keys are computed
+        in a single pass over the graph.
     %(conn_key)s
     normalized
         If `True`, each row is normalized to sum to 1.
     %(copy)s
     weights
         Whether to use edge weights or binarize.
+    library_key
+        Key in :attr:`anndata.AnnData.obs` containing the library ids. If not `None`, also compute the interaction
+        matrix of each library. The edges are assigned to the library of their source cell.
 
     Returns
     -------
-    If ``copy = True``, returns the interaction matrix.
+    If ``copy = True``, returns the interaction matrix. If ``library_key != None``, returns a :class:`tuple`
+    with the interaction matrix and the matrices of each library, of shape ``(n_libraries, n_clusters, n_clusters)``.
+    If ``cluster_key`` is a sequence, returns a :class:`dict` with the above for each key.
 
-    Otherwise, modifies the ``adata`` with the following key:
+    Otherwise, modifies the ``adata`` with the following keys, for each ``cluster_key``:
 
         - :attr:`anndata.AnnData.uns` ``['{cluster_key}_interactions']`` - the interaction matrix.
+        - :attr:`anndata.AnnData.uns` ``['{cluster_key}_interactions_{library_key}']`` - the interaction
+          matrices of each library, if ``library_key != None``.
     """
     connectivity_key = Key.obsp.spatial_conn(connectivity_key)
-    _assert_categorical_obs(adata, cluster_key)
+    keys = [cluster_key] if isinstance(cluster_key, str) else list(cluster_key)
+    for key in keys:
+        _assert_categorical_obs(adata, key)
+        if np.all(adata.obs[key].cat.codes.values < 0):
+            raise RuntimeError(f"After removing NaNs in `adata.obs[{key!r}]`, none remain.")
     _assert_connectivity_key(adata, connectivity_key)
+    if library_key is not None:
+        _assert_categorical_obs(adata, library_key)
+        libs = adata.obs[library_key].cat.codes.values.astype(np.int64)
+        n_libs = len(adata.obs[library_key].cat.categories)
+    else:
+        libs, n_libs = np.full(adata.n_obs, -1, dtype=np.int64), 0
+
+    g = csr_matrix(adata.obsp[connectivity_key])
+    # NaN labels have the code `-1`, their edges are skipped instead of removed from the graph
+    codes = np.stack([adata.obs[key].cat.codes.values for key in keys]).astype(np.int64)
+    n_cls = np.array([len(adata.obs[key].cat.categories) for key in keys], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum((1 + n_libs) * n_cls**2)]).astype(np.int64)
 
-    cats = adata.obs[cluster_key]
-    mask = ~pd.isnull(cats).values
-    cats = cats.loc[mask]
-    if not len(cats):
-        raise RuntimeError(f"After removing NaNs in `adata.obs[{cluster_key!r}]`, none remain.")
-
-    g = adata.obsp[connectivity_key]
-    g = g[mask, :][:, mask]
-    n_cats = len(cats.cat.categories)
-
-    g_data = g.data if weights else np.broadcast_to(1, shape=len(g.data))
     dtype = int if pd.api.types.is_bool_dtype(g.dtype) or pd.api.types.is_integer_dtype(g.dtype) else float
-    output = np.zeros((n_cats, n_cats), dtype=dtype)
+    output = np.zeros(offsets[-1], dtype=dtype)
+    data = g.data.astype(dtype, copy=False)
+    _interaction_matrix(data, g.indices, g.indptr, codes, n_cls, offsets, libs, n_libs, weights, output)
 
-    _interaction_matrix(g_data, g.indices, g.indptr, cats.cat.codes.to_numpy(), output)
-
-    if normalized:
-        output = output / output.sum(axis=1).reshape((-1, 1))
+    res = {}
+    for i, key in enumerate(keys):
+        out = output[offsets[i] : offsets[i + 1]].reshape(1 + n_libs, n_cls[i], n_cls[i])
+        if normalized:
+            out = out / out.sum(axis=-1, keepdims=True)
+        res[key] = out[0] if library_key is None else (out[0], out[1:])
 
     if copy:
-        return output
+        return res[cluster_key] if isinstance(cluster_key, str) else res
 
-    _save_data(adata, attr="uns", key=Key.uns.interaction_matrix(cluster_key), data=output)
+    for key, out in res.items():
+        if library_key is None:
+            _save_data(adata, attr="uns", key=Key.uns.interaction_matrix(key), data=out)
+        else:
+            _save_data(adata, attr="uns", key=Key.uns.interaction_matrix(key), data=out[0])
+            _save_data(adata, attr="uns", key=Key.uns.interaction_matrix(key, library_key), data=out[1])
 
 
-@njit
+@njit(nogil=True, cache=True)
 def _interaction_matrix(
-    data: NDArrayA, indices: NDArrayA, indptr: NDArrayA, cats: NDArrayA, output: NDArrayA
+    data: NDArrayA,
+    indices: NDArrayA,
+    indptr: NDArrayA,
+    codes: NDArrayA,
+    n_cls: NDArrayA,
+    offsets: NDArrayA,
+    libs: NDArrayA,
+    n_libs: int,
+    weights: bool,
+    output: NDArrayA,
 ) -> NDArrayA:
-    indices_list = np.split(indices, indptr[1:-1])
-    data_list = np.split(data, indptr[1:-1])
-    for i in range(len(data_list)):
-        cur_row = cats[i]
-        cur_indices = indices_list[i]
-        cur_data = data_list[i]
-        for j, val in zip(cur_indices, cur_data):
-            cur_col = cats[j]
-            output[cur_row, cur_col] += val
+    """
+    Count the edges between the clusters of several keys in one pass over the graph.
+
+    Parameters
+    ----------
+    data
+        :attr:`scipy.sparse.csr_matrix.data`.
+    indices
+        :attr:`scipy.sparse.csr_matrix.indices`.
+    indptr
+        :attr:`scipy.sparse.csr_matrix.indptr`.
+    codes
+        Array of shape ``(n_keys, n_cells)`` containing the cluster labels of each key, `-1` if missing.
+    n_cls
+        Array of shape ``(n_keys,)`` containing the number of clusters of each key.
+    offsets
+        Array of shape ``(n_keys + 1,)`` containing the offsets of the matrices of each key in ``output``.
+    libs
+        Array of shape ``(n_cells,)`` containing the libraries, `-1` if missing.
+    n_libs
+        Number of libraries.
+    weights
+        Whether to count the edge weights instead of `1`.
+    output
+        Array where the matrices of shape ``(1 + n_libs, n_clusters, n_clusters)`` of each key are flattened.
+        The first matrix counts all the edges, the others the edges of each library.
+
+    Returns
+    -------
+    The ``output``.
+    """
+    for i in range(indptr.shape[0] - 1):
+        lib = libs[i]
+        for k in range(indptr[i], indptr[i + 1]):
+            j = indices[k]
+            val = data[k] if weights else 1
+            for key in range(codes.shape[0]):
+                a, b = codes[key, i], codes[key, j]
+                if a < 0 or b < 0:
+                    continue
+                n = n_cls[key]
+                output[offsets[key] + a * n + b] += val
+                if lib >= 0:
+                    output[offsets[key] + ((1 + lib) * n + a) * n + b] += val
+
     return output
 
 
+@d.dedent
+def nhood_composition(
+    adata: AnnData,
+    cluster_key: str,
+    connectivity_key: str | Sequence[str] | None = None,
+    weights: bool = False,
+    bandwidth: float | None = None,
+    normalized: bool = False,
+    sparse: bool = False,
+    batch_size: int | None = None,
+    key_added: str | None = None,
+    copy: bool = False,
+) -> NDArrayA | csr_matrix | None:
+    r"""
+    Compute the cluster composition of the neighborhood of each cell.
+
+    Parameters
+    ----------
+    %(adata)s
+    %(cluster_key)s
+    connectivity_key
+        Key(s) in :attr:`anndata.AnnData.obsp` where spatial connectivities are stored, e.g. the graphs at several
+        scales built by :func:`squidpy.gr.spatial_neighbors`.
+    weights
+        Whether to use edge weights or binarize.
+    bandwidth
+        If not `None`, weight each edge by the Gaussian kernel :math:`\exp(-d^2 / (2 bandwidth^2))` of its length
+        :math:`d`, read from the matching spatial distances in :attr:`anndata.AnnData.obsp`.
+        Takes precedence over ``weights``.
+    normalized
+        If `True`, each row of each graph is normalized to sum to 1.
+    sparse
+        Whether to return a :class:`scipy.sparse.csr_matrix` instead of a dense array.
+    batch_size
+        Number of cells whose neighborhoods are counted at once. If `None`, count all cells at once.
+    key_added
+        Key in :attr:`anndata.AnnData.obsm` where the result is stored if ``copy = False``.
+        If `None`, ``'{cluster_key}_nhood_composition'`` will be used.
+    %(copy)s
+
+    Returns
+    -------
+    If ``copy = True``, returns the composition of shape ``(n_cells, n_graphs * n_clusters)`` with `float32` values,
+    containing one block of columns per graph in ``connectivity_key``, ordered as the cluster categories.
+    Cells with a missing cluster label are not counted as neighbors.
+
+    Otherwise, modifies the ``adata`` with the following key:
+
+        - :attr:`anndata.AnnData.obsm` ``['{key_added}']`` - the neighborhood composition.
+    """
+    _assert_categorical_obs(adata, cluster_key)
+    if batch_size is not None:
+        _assert_positive(batch_size, name="batch_size")
+    if bandwidth is not None:
+        _assert_positive(bandwidth, name="bandwidth")
+    keys = [connectivity_key] if connectivity_key is None or isinstance(connectivity_key, str) else connectivity_key
+    for key in keys:
+        _assert_connectivity_key(adata, Key.obsp.spatial_conn(key))
+        if bandwidth is not None and Key.obsp.spatial_dist(key) not in adata.obsp:
+            raise KeyError(f"Spatial distances key `{Key.obsp.spatial_dist(key)}` not found in `adata.obsp`.")
+
+    start = logg.info(f"Calculating neighborhood composition of `{len(keys)}` graph(s)")
+    codes = adata.obs[cluster_key].cat.codes.values
+    n_cls = len(adata.obs[cluster_key].cat.categories)
+    valid = np.flatnonzero(codes >= 0)
+    onehot = csr_matrix(
+        (np.ones(len(valid), dtype=np.float32), (valid, codes[valid])), shape=(adata.n_obs, n_cls), dtype=np.float32
+    )
+
+    batch_size = adata.n_obs if batch_size is None else batch_size
+    batches = []
+    for i in range(0, adata.n_obs, batch_size):
+        # only the rows of the batch are read from the graphs
+        rows = slice(i, i + batch_size)
+        batch = [
+            _nhood_composition(_composition_graph(adata, key, rows, weights, bandwidth), onehot, normalized=normalized)
+            for key in keys
+        ]
+        batches.append(hstack(batch, format="csr") if sparse else np.hstack([comp.toarray() for comp in batch]))
+    res = vstack(batches, format="csr") if sparse else np.concatenate(batches)
+
+    if copy:
+        return res
+
+    _save_data(adata, attr="obsm", key=Key.obsm.nhood_composition(cluster_key, key_added), data=res, time=start)
+
+
+def _composition_graph(
+    adata: AnnData, key: str | None, rows: slice, weights: bool = False, bandwidth: float | None = None
+) -> csr_matrix:
+    g = csr_matrix(adata.obsp[Key.obsp.spatial_conn(key)][rows], dtype=np.float32)
+    if bandwidth is not None:
+        # the distances of the self-loops are not stored, these are read as `0`
+        dist = adata.obsp[Key.obsp.spatial_dist(key)][rows]
+        dist = np.asarray(dist[np.repeat(np.arange(g.shape[0]), np.diff(g.indptr)), g.indices], dtype=np.float32)
+        g.data = np.exp(-((dist.ravel() / bandwidth) ** 2) / 2)
+    elif not weights:
+        g.data = np.ones_like(g.data)
+
+    return g
+
+
+def _nhood_composition(g: csr_matrix, onehot: csr_matrix, normalized: bool = False) -> csr_matrix:
+    comp = g @ onehot
+    if normalized:
+        sums = np.asarray(comp.sum(axis=1), dtype=np.float32)
+        comp = csr_matrix(comp.multiply(np.divide(1, sums, out=np.zeros_like(sums), where=sums > 0)))
+
+    return comp
+
+
 def _centrality_scores_helper(
     cat: Iterable[Any],
     clusters: Sequence[str],
@@ -382,26 +935,31 @@ def _centrality_scores_helper(
 
 def _nhood_enrichment_helper(
     ixs: NDArrayA,
-    callback: Callable[[NDArrayA, NDArrayA, NDArrayA], NDArrayA],
-    indices: NDArrayA,
-    indptr: NDArrayA,
+    rows: NDArrayA,
+    cols: NDArrayA,
     int_clust: NDArrayA,
     n_cls: int,
+    order: NDArrayA,
+    offsets: NDArrayA,
+    edge_libs: NDArrayA,
+    n_libs: int = 0,
     seed: int | None = None,
     queue: SigQueue | None = None,
-) -> NDArrayA:
-    perms = np.empty((len(ixs), n_cls, n_cls), dtype=np.float64)
+) -> tuple[int, NDArrayA, NDArrayA]:
     int_clust = int_clust.copy()  # threading
-    rs = np.random.RandomState(seed=None if seed is None else seed + ixs[0])
+    seed = np.random.RandomState().randint(np.iinfo(np.int32).max) if seed is None else seed + ixs[0]
 
-    for i in range(len(ixs)):
-        rs.shuffle(int_clust)
-        perms[i, ...] = callback(indices, indptr, int_clust)
+    moments = []
+    for i, block in enumerate(range(0, len(ixs), _N_PERMS_BLOCK)):
+        n_perms = min(_N_PERMS_BLOCK, len(ixs) - block)
+        mean, m2 = _nenrich_perms(rows, cols, int_clust, n_cls, n_perms, seed + i, order, offsets, edge_libs, n_libs)
+        moments.append((n_perms, mean, m2))
 
         if queue is not None:
-            queue.put(Signal.UPDATE)
+            for _ in range(n_perms):
+                queue.put(Signal.UPDATE)
 
     if queue is not None:
         queue.put(Signal.FINISH)
 
-    return perms
+    return _combine_moments(moments)
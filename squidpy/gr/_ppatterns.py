@@ -16,7 +16,6 @@ from numba import njit
 from scipy import stats
 from numpy.random import default_rng
 from scipy.sparse import spmatrix
-from sklearn.metrics import pairwise_distances
 from sklearn.preprocessing import normalize
 from statsmodels.stats.multitest import multipletests
 import numpy as np
@@ -25,9 +24,21 @@ import numba.types as nt
 
 from squidpy._docs import d, inject_docs
 from squidpy._utils import Signal, NDArrayA, SigQueue, parallelize, _get_n_cores
+from squidpy.gr._index import (
+    _ravel,
+    _cell_box,
+    _distance,
+    _next_cell,
+    SpatialIndex,
+    _get_spatial_index,
+)
 from squidpy.gr._utils import (
     _save_data,
+    _get_strata,
+    _permutation,
     _assert_positive,
+    _combine_moments,
+    _is_row_normalized,
     _assert_spatial_basis,
     _assert_categorical_obs,
     _assert_connectivity_key,
@@ -41,9 +52,9 @@ __all__ = ["spatial_autocorr", "co_occurrence"]
 
 it = nt.int32
 ft = nt.float32
-tt = nt.UniTuple
 ip = np.int32
 fp = np.float32
+_N_PERMS_BLOCK = 100  # number of permutations per round if stopping early
 
 
 @d.dedent
@@ -60,6 +71,8 @@ def spatial_autocorr(
     layer: str | None = None,
     seed: int | None = None,
     use_raw: bool = False,
+    library_key: str | None = None,
+    early_stopping: int | None = None,
     copy: bool = False,
     n_jobs: int | None = None,
     backend: str = "loky",
@@ -97,6 +110,11 @@ def spatial_autocorr(
     layer
         Layer in :attr:`anndata.AnnData.layers` to use. If `None`, use :attr:`anndata.AnnData.X`.
     %(seed)s
+    library_key
+        Key in :attr:`anndata.AnnData.obs` containing the library ids. If not `None`, the observations are only
+        permuted within each library. Only used when ``n_perms != None``.
+    %(early_stopping)s
+        Only used when ``n_perms != None``.
     %(copy)s
     %(parallelize)s
 
@@ -114,6 +132,7 @@ def spatial_autocorr(
         - `'pval_z_sim'` - p-value based on standard normal approximation from permutations.
         - `'pval_sim'` - p-value based on permutations.
         - `'var_sim'` - variance of `'score'` from permutations.
+        - `'n_perms'` - number of permutations used for each gene, if ``early_stopping != None``.
 
     Otherwise, modifies the ``adata`` with the following key:
 
@@ -140,7 +159,7 @@ def spatial_autocorr(
     mode = SpatialAutocorr(mode)  # type: ignore[assignment]
     if TYPE_CHECKING:
         assert isinstance(mode, SpatialAutocorr)
-    params = {"mode": mode.s, "transformation": transformation, "two_tailed": two_tailed}
+    params = {"mode": mode.s, "transformation": transformation, "two_tailed": two_tailed, "early_stopping": None}
 
     if mode == SpatialAutocorr.MORAN:
         params["func"] = _morans_i
@@ -155,9 +174,9 @@ def spatial_autocorr(
     else:
         raise NotImplementedError(f"Mode `{mode}` is not yet implemented.")
 
-    g = adata.obsp[connectivity_key].copy()
-    if transformation:  # row-normalize
-        normalize(g, norm="l1", axis=1, copy=False)
+    g = adata.obsp[connectivity_key]
+    if transformation and not _is_row_normalized(g):  # row-normalize
+        g = normalize(g, norm="l1", axis=1, copy=True)
 
     score = params["func"](g, vals)
 
@@ -166,16 +185,49 @@ def spatial_autocorr(
     if n_perms is not None:
         _assert_positive(n_perms, name="n_perms")
         perms = np.arange(n_perms)
+        if library_key is not None:
+            _assert_categorical_obs(adata, key=library_key)
+            strata = _get_strata(adata.obs[library_key].cat.codes.values)
+        else:
+            strata = None
 
-        score_perms = parallelize(
-            _score_helper,
-            collection=perms,
-            extractor=np.concatenate,
-            use_ixs=True,
-            n_jobs=n_jobs,
-            backend=backend,
-            show_progress_bar=show_progress_bar,
-        )(mode=mode, g=g, vals=vals, seed=seed)
+        kwargs = {"use_ixs": True, "backend": backend, "show_progress_bar": show_progress_bar}
+        if early_stopping is None:
+            score_perms = parallelize(
+                _score_helper, collection=perms, extractor=_combine_score_stats, n_jobs=n_jobs, **kwargs
+            )(mode=mode, g=g, vals=vals, score=score, strata=strata, seed=seed)
+        else:
+            _assert_positive(early_stopping, name="early_stopping")
+            params["early_stopping"] = early_stopping
+            # sequential test: permute in rounds, only the undecided genes are permuted again
+            n, mean, m2 = np.zeros(len(score), dtype=np.int64), np.zeros(len(score)), np.zeros(len(score))
+            n_large = np.zeros(len(score), dtype=np.int64)
+            undecided = np.ones(len(score), dtype=bool)
+            block = max(_N_PERMS_BLOCK, n_jobs)
+            for first in range(0, n_perms, block):
+                stop = min(first + block, n_perms)
+                n_b, mean_b, m2_b, n_large_b = parallelize(
+                    _score_helper,
+                    collection=perms[first:stop],
+                    extractor=_combine_score_stats,
+                    n_jobs=min(n_jobs, stop - first),
+                    **kwargs,
+                )(
+                    mode=mode,
+                    g=g,
+                    vals=vals[undecided],
+                    score=score[undecided],
+                    strata=strata,
+                    seed=None if seed is None else seed + first,
+                )
+                stats = _combine_moments([(n[undecided], mean[undecided], m2[undecided]), (n_b, mean_b, m2_b)])
+                n[undecided], mean[undecided], m2[undecided] = stats
+                n_large[undecided] += n_large_b
+
+                undecided &= np.minimum(n_large, n - n_large) < early_stopping
+                if not undecided.any():
+                    break
+            score_perms = (n, mean, m2, n_large)
     else:
         score_perms = None
 
@@ -204,16 +256,32 @@ def _score_helper(
     mode: SpatialAutocorr,
     g: spmatrix,
     vals: NDArrayA,
+    score: NDArrayA,
+    strata: Sequence[NDArrayA] | None = None,
     seed: int | None = None,
     queue: SigQueue | None = None,
-) -> pd.DataFrame:
-    score_perms = np.empty((len(perms), vals.shape[0]))
+) -> tuple[int, NDArrayA, NDArrayA, NDArrayA]:
+    """
+    Score the permutations and accumulate their statistics.
+
+    Returns
+    -------
+    The number of permutations, the mean and the sum of squared deviations from the mean of the permuted scores
+    and the number of permuted scores greater or equal to ``score``, each of shape ``(n_genes,)``.
+    """
+    mean, m2 = np.zeros(vals.shape[0]), np.zeros(vals.shape[0])
+    n_large = np.zeros(vals.shape[0], dtype=np.int64)
     rng = default_rng(None if seed is None else ix + seed)
     func = _morans_i if mode == SpatialAutocorr.MORAN else _gearys_c
 
     for i in range(len(perms)):
-        idx_shuffle = rng.permutation(g.shape[0])
-        score_perms[i, :] = func(g[idx_shuffle, :], vals)
+        idx_shuffle = _permutation(rng, g.shape[0], strata)
+        score_perm = func(g[idx_shuffle, :], vals)
+        n_large += score_perm >= score
+        # Welford's update, the permuted scores are never kept
+        delta = score_perm - mean
+        mean += delta / (i + 1)
+        m2 += delta * (score_perm - mean)
 
         if queue is not None:
             queue.put(Signal.UPDATE)
@@ -221,37 +289,76 @@ def _score_helper(
     if queue is not None:
         queue.put(Signal.FINISH)
 
-    return score_perms
+    return len(perms), mean, m2, n_large
+
+
+def _combine_score_stats(
+    stats: Sequence[tuple[int, NDArrayA, NDArrayA, NDArrayA]]
+) -> tuple[int, NDArrayA, NDArrayA, NDArrayA]:
+    n, mean, m2 = _combine_moments([s[:3] for s in stats])
+
+    return n, mean, m2, np.sum([s[3] for s in stats], axis=0)
+
+
+@njit(cache=True)
+def _occur_count(
+    coords: NDArrayA,
+    order: NDArrayA,
+    indptr: NDArrayA,
+    origin: NDArrayA,
+    cell_size: float,
+    shape: NDArrayA,
+    points: NDArrayA,
+    queries: NDArrayA,
+    splits: NDArrayA,
+    split: int,
+    n_splits: int,
+    labs: NDArrayA,
+    n_labs: int,
+    interval: NDArrayA,
+) -> NDArrayA:
+    # count the pairs of the split with each later split, in the cells within the largest threshold
+    n_dims = points.shape[1]
+    lo, hi, cur = np.empty((n_dims,), np.int64), np.empty((n_dims,), np.int64), np.empty((n_dims,), np.int64)
+    out = np.zeros((n_splits - split, n_labs, n_labs, interval.shape[0] - 1), dtype=np.int64)
+
+    for q in queries:
+        _cell_box(points[q], interval[-1], origin, cell_size, shape, lo, hi)
+        cur[:] = lo
+        while True:
+            cell = _ravel(cur, shape)
+            for kk in range(indptr[cell], indptr[cell + 1]):
+                j = order[kk]
+                if splits[j] < split:
+                    continue
+                d = _distance(coords, kk, points[q], 2)
+                if d <= interval[0] or d > interval[-1]:
+                    continue
+                idx = np.searchsorted(interval, d) - 1
+                out[splits[j] - split, labs[q], labs[j], idx] += 1
+            if not _next_cell(lo, hi, cur):
+                break
+
+    return out
 
 
 @njit(
-    ft[:, :, :](tt(it[:], 2), ft[:, :], it[:], ft[:]),
+    ft[:, :, :](nt.int64[:, :, :], it[:]),
     parallel=False,
     fastmath=True,
+    cache=True,
 )
-def _occur_count(
-    clust: tuple[NDArrayA, NDArrayA],
-    pw_dist: NDArrayA,
+def _occur_probs(
+    counts: NDArrayA,
     labs_unique: NDArrayA,
-    interval: NDArrayA,
 ) -> NDArrayA:
     num = labs_unique.shape[0]
-    out = np.zeros((num, num, interval.shape[0] - 1), dtype=ft)
+    out = np.zeros((num, num, counts.shape[2]), dtype=ft)
 
-    for idx in range(interval.shape[0] - 1):
-        co_occur = np.zeros((num, num), dtype=ft)
+    for idx in range(counts.shape[2]):
+        co_occur = counts[:, :, idx].astype(np.float32)
         probs_con = np.zeros((num, num), dtype=ft)
 
-        thres_min = interval[idx]
-        thres_max = interval[idx + 1]
-        clust_x, clust_y = clust
-
-        idx_x, idx_y = np.nonzero((pw_dist <= thres_max) & (pw_dist > thres_min))
-        x = clust_x[idx_x]
-        y = clust_y[idx_y]
-        for i, j in zip(x, y):
-            co_occur[i, j] += 1
-
         probs_matrix = co_occur / np.sum(co_occur)
         probs = np.sum(probs_matrix, axis=1)
 
@@ -265,23 +372,31 @@ def _occur_count(
 
 
 def _co_occurrence_helper(
-    idx_splits: Iterable[tuple[int, int]],
-    spatial_splits: Sequence[NDArrayA],
-    labs_splits: Sequence[NDArrayA],
+    idx_splits: Iterable[int],
+    index: SpatialIndex,
+    splits: NDArrayA,
+    n_splits: int,
+    labs: NDArrayA,
     labs_unique: NDArrayA,
     interval: NDArrayA,
     queue: SigQueue | None = None,
-) -> pd.DataFrame:
+) -> list[NDArrayA]:
 
     out_lst = []
-    for t in idx_splits:
-        idx_x, idx_y = t
-        labs_x = labs_splits[idx_x]
-        labs_y = labs_splits[idx_y]
-        dist = pairwise_distances(spatial_splits[idx_x], spatial_splits[idx_y])
-
-        out = _occur_count((labs_x, labs_y), dist, labs_unique, interval)
-        out_lst.append(out)
+    for split in idx_splits:
+        counts = _occur_count(
+            *index._arrays(),
+            index.coords,
+            np.flatnonzero(splits == split),
+            splits,
+            split,
+            n_splits,
+            labs,
+            len(labs_unique),
+            interval.astype(np.float64),
+        )
+        # the same split combinations as the upper triangle of the splits
+        out_lst.extend(_occur_probs(c, labs_unique) for c in counts)
 
         if queue is not None:
             queue.put(Signal.UPDATE)
@@ -318,7 +433,8 @@ def co_occurrence(
     %(copy)s
     n_splits
         Number of splits in which to divide the spatial coordinates in
-        :attr:`anndata.AnnData.obsm` ``['{spatial_key}']``.
+        :attr:`anndata.AnnData.obsm` ``['{spatial_key}']``. The probabilities are averaged across the combinations
+        of the splits. If `None`, use only one split.
     %(parallelize)s
 
     Returns
@@ -335,7 +451,7 @@ def co_occurrence(
     _assert_categorical_obs(adata, key=cluster_key)
     _assert_spatial_basis(adata, key=spatial_key)
 
-    spatial = adata.obsm[spatial_key].astype(fp)
+    index = _get_spatial_index(adata, spatial_key)
     original_clust = adata.obs[cluster_key]
 
     # annotate cluster idx
@@ -345,55 +461,42 @@ def co_occurrence(
 
     # create intervals thresholds
     if isinstance(interval, int):
-        thresh_min, thresh_max = _find_min_max(spatial)
+        thresh_min, thresh_max = _find_min_max(index.coords)
         interval = np.linspace(thresh_min, thresh_max, num=interval, dtype=fp)
     else:
         interval = np.array(sorted(interval), dtype=fp, copy=True)
     if len(interval) <= 1:
         raise ValueError(f"Expected interval to be of length `>= 2`, found `{len(interval)}`.")
 
-    n_obs = spatial.shape[0]
-    if n_splits is None:
-        size_arr = (n_obs**2 * spatial.itemsize) / 1024 / 1024  # calc expected mem usage
-        if size_arr > 2000:
-            n_splits = 1
-            while 2048 < (n_obs / n_splits):
-                n_splits += 1
-            logg.warning(
-                f"`n_splits` was automatically set to `{n_splits}` to "
-                f"prevent `{n_obs}x{n_obs}` distance matrix from being created"
-            )
-        else:
-            n_splits = 1
-    n_splits = max(min(n_splits, n_obs), 1)
-
-    # split array and labels
-    spatial_splits = tuple(s for s in np.array_split(spatial, n_splits, axis=0) if len(s))
-    labs_splits = tuple(s for s in np.array_split(labs, n_splits, axis=0) if len(s))
-    # create idx array including unique combinations and self-comparison
-    x, y = np.triu_indices_from(np.empty((n_splits, n_splits)))
-    idx_splits = [(i, j) for i, j in zip(x, y)]
+    # the pairs are counted in the cells of the spatial index, without the distance matrix
+    n_obs = adata.n_obs
+    n_splits = max(min(1 if n_splits is None else n_splits, n_obs), 1)
+    splits = np.repeat(np.arange(n_splits), [len(s) for s in np.array_split(np.arange(n_obs), n_splits)])
+    # each split is counted with itself and the later splits
+    n_combs = n_splits * (n_splits + 1) // 2
 
     n_jobs = _get_n_cores(n_jobs)
     start = logg.info(
         f"Calculating co-occurrence probabilities for `{len(interval)}` intervals "
-        f"`{len(idx_splits)}` split combinations using `{n_jobs}` core(s)"
+        f"`{n_combs}` split combinations using `{n_jobs}` core(s)"
     )
 
     out_lst = parallelize(
         _co_occurrence_helper,
-        collection=idx_splits,
+        collection=np.arange(n_splits),
         extractor=chain.from_iterable,
         n_jobs=n_jobs,
         backend=backend,
         show_progress_bar=show_progress_bar,
     )(
-        spatial_splits=spatial_splits,
-        labs_splits=labs_splits,
+        index=index,
+        splits=splits,
+        n_splits=n_splits,
+        labs=labs,
         labs_unique=labs_unique,
         interval=interval,
     )
-    out = list(out_lst)[0] if len(idx_splits) == 1 else sum(list(out_lst)) / len(idx_splits)
+    out = list(out_lst)[0] if n_combs == 1 else sum(list(out_lst)) / n_combs
 
     if copy:
         logg.info("Finish", time=start)
@@ -408,17 +511,15 @@ def _find_min_max(spatial: NDArrayA) -> tuple[float, float]:
     coord_sum = np.sum(spatial, axis=1)
     min_idx, min_idx2 = np.argpartition(coord_sum, 2)[:2]
     max_idx = np.argmax(coord_sum)
-    # fmt: off
-    thres_max = pairwise_distances(spatial[min_idx, :].reshape(1, -1), spatial[max_idx, :].reshape(1, -1))[0, 0] / 2.0
-    thres_min = pairwise_distances(spatial[min_idx, :].reshape(1, -1), spatial[min_idx2, :].reshape(1, -1))[0, 0]
-    # fmt: on
+    thres_max = np.linalg.norm(spatial[min_idx] - spatial[max_idx]) / 2.0
+    thres_min = np.linalg.norm(spatial[min_idx] - spatial[min_idx2])
 
     return thres_min.astype(fp), thres_max.astype(fp)
 
 
 def _p_value_calc(
     score: NDArrayA,
-    sims: NDArrayA | None,
+    sims: tuple[int | NDArrayA, NDArrayA, NDArrayA, NDArrayA] | None,
     weights: spmatrix | NDArrayA,
     params: dict[str, Any],
 ) -> dict[str, Any]:
@@ -430,7 +531,8 @@ def _p_value_calc(
     score
         (n_features,).
     sims
-        (n_simulations, n_features).
+        Number of simulations, mean and sum of squared deviations from the mean of the simulated scores
+        and number of simulated scores greater or equal to ``score``, each (n_features,).
     params
         Object to store relevant function parameters.
 
@@ -449,27 +551,30 @@ def _p_value_calc(
     if sims is None:
         return results
 
-    n_perms = sims.shape[0]
-    large_perm = (sims >= score).sum(axis=0)  # type: ignore[attr-defined]
+    n_perms, e_score_sim, m2, large_perm = sims
+    n_perms = np.broadcast_to(n_perms, score.shape)
     # subtract total perm for negative values
-    large_perm[(n_perms - large_perm) < large_perm] = n_perms - large_perm[(n_perms - large_perm) < large_perm]
+    large_perm = np.minimum(large_perm, n_perms - large_perm)
     # get p-value based on permutation
     p_sim: NDArrayA = (large_perm + 1) / (n_perms + 1)
+    if params["early_stopping"] is not None:
+        stopped = large_perm >= params["early_stopping"]
+        p_sim[stopped] = large_perm[stopped] / n_perms[stopped]
 
     # get p-value based on standard normal approximation from permutations
-    e_score_sim = sims.sum(axis=0) / n_perms
-    se_score_sim = sims.std(axis=0)
+    var_sim = m2 / n_perms
+    se_score_sim = np.sqrt(var_sim)
     z_sim = (score - e_score_sim) / se_score_sim
     p_z_sim = np.empty(z_sim.shape)
 
     p_z_sim[z_sim > 0] = 1 - stats.norm.cdf(z_sim[z_sim > 0])
     p_z_sim[z_sim <= 0] = stats.norm.cdf(z_sim[z_sim <= 0])
 
-    var_sim = np.var(sims, axis=0)
-
     results["pval_z_sim"] = p_z_sim
     results["pval_sim"] = p_sim
     results["var_sim"] = var_sim
+    if params["early_stopping"] is not None:
+        results["n_perms"] = n_perms
 
     return results
 
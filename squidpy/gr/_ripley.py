@@ -18,6 +18,7 @@ import pandas as pd
 
 from squidpy._docs import d, inject_docs
 from squidpy._utils import NDArrayA
+from squidpy.gr._index import _METRICS, SpatialIndex
 from squidpy.gr._utils import _save_data, _assert_spatial_basis, _assert_categorical_obs
 from squidpy._constants._constants import RipleyStat
 from squidpy._constants._pkg_constants import Key
@@ -131,6 +132,7 @@ def ripley(
 
     for i in np.arange(np.max(cluster_idx) + 1):
         coord_c = coordinates[cluster_idx == i, :]
+        # a tree of the cluster, the grid of the index is slow for queries far from a compact cluster
         if mode == RipleyStat.F:
             random = _ppp(hull, n_simulations=1, n_observations=n_observations, seed=seed)
             tree_c = NearestNeighbors(metric=metric, n_neighbors=n_neigh).fit(coord_c)
@@ -153,12 +155,10 @@ def ripley(
     for i in range(n_simulations):
         random_i = _ppp(hull, n_simulations=1, n_observations=n_observations, seed=seed)
         if mode == RipleyStat.F:
-            tree_i = NearestNeighbors(metric=metric, n_neighbors=n_neigh).fit(random_i)
-            distances_i, _ = tree_i.kneighbors(random, n_neighbors=1)
+            distances_i = _kneighbors_distances(random_i, random, 1, metric=metric)
             _, stats_i = _f_g_function(distances_i.squeeze(), support)
         elif mode == RipleyStat.G:
-            tree_i = NearestNeighbors(metric=metric, n_neighbors=n_neigh).fit(random_i)
-            distances_i, _ = tree_i.kneighbors(coordinates, n_neighbors=1)
+            distances_i = _kneighbors_distances(random_i, coordinates, 1, metric=metric)
             _, stats_i = _f_g_function(distances_i.squeeze(), support)
         elif mode == RipleyStat.L:
             distances_i = pdist(random_i, metric=metric)
@@ -197,6 +197,16 @@ def _reshape_res(results: NDArrayA, columns: NDArrayA | list[str], index: NDArra
     return df
 
 
+def _kneighbors_distances(coords: NDArrayA, points: NDArrayA, n_neighbors: int, metric: str = "euclidean") -> NDArrayA:
+    """Get the distances of ``points`` to their nearest neighbors in ``coords``, in a grid or else a tree over it."""
+    if metric in _METRICS:
+        return SpatialIndex(coords).kneighbors(points, n_neighbors=n_neighbors, metric=metric)[0]
+
+    tree = NearestNeighbors(metric=metric, n_neighbors=n_neighbors).fit(coords)
+
+    return tree.kneighbors(points, n_neighbors=n_neighbors)[0]  # type: ignore[no-any-return]
+
+
 def _f_g_function(distances: NDArrayA, support: NDArrayA) -> tuple[NDArrayA, NDArrayA]:
     counts, bins = np.histogram(distances, bins=support)
     fracs = np.cumsum(counts) / counts.sum()
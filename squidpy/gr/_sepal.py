@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from typing import Union  # noqa: F401
-from typing import Callable, Sequence
+from typing import Sequence
 from typing_extensions import Literal  # < 3.8
 
 from scanpy import logging as logg
@@ -9,12 +9,12 @@ from anndata import AnnData
 
 from numba import njit
 from scipy.sparse import issparse, spmatrix, csr_matrix, isspmatrix_csr
-from sklearn.metrics import pairwise_distances
 import numpy as np
 import pandas as pd
 
 from squidpy._docs import d, inject_docs
 from squidpy._utils import Signal, NDArrayA, SigQueue, parallelize, _get_n_cores
+from squidpy.gr._index import SpatialIndex, _get_spatial_index
 from squidpy.gr._utils import (
     _save_data,
     _extract_expression,
@@ -99,7 +99,7 @@ def sepal(
     if max_neighs not in (4, 6):
         raise ValueError(f"Expected `max_neighs` to be either `4` or `6`, found `{max_neighs}`.")
 
-    spatial = adata.obsm[spatial_key].astype(np.float_)
+    index = _get_spatial_index(adata, spatial_key)
 
     if genes is None:
         genes = adata.var_names.values
@@ -119,7 +119,7 @@ def sepal(
         raise ValueError(f"Expected `max_neighs={max_neighs}`, found node with `{max_n}` neighbors.")
 
     # get saturated/unsaturated nodes
-    sat, sat_idx, unsat, unsat_idx = _compute_idxs(g, spatial, max_neighs, "l1")
+    sat, sat_idx, unsat, unsat_idx = _compute_idxs(g, index, max_neighs, "l1")
 
     # get counts
     vals, genes = _extract_expression(adata, genes=genes, use_raw=use_raw, layer=layer)
@@ -172,17 +172,13 @@ def _score_helper(
     thresh: np.float_,
     queue: SigQueue | None = None,
 ) -> NDArrayA:
-    if max_neighs == 4:
-        fun = _laplacian_rect
-    elif max_neighs == 6:
-        fun = _laplacian_hex
-    else:
+    if max_neighs not in (4, 6):
         raise NotImplementedError(f"Laplacian for `{max_neighs}` neighbors is not yet implemented.")
 
     score, sparse = [], issparse(vals)
     for i in ixs:
         conc = vals[:, i].A.flatten() if sparse else vals[:, i].copy()
-        time_iter = _diffusion(conc, fun, n_iter, sat, sat_idx, unsat, unsat_idx, dt=dt, thresh=thresh)
+        time_iter = _diffusion(conc, max_neighs, n_iter, sat, sat_idx, unsat, unsat_idx, dt=dt, thresh=thresh)
         score.append(dt * time_iter)
 
         if queue is not None:
@@ -194,10 +190,10 @@ def _score_helper(
     return np.array(score)
 
 
-@njit(fastmath=True)
+@njit(cache=True, fastmath=True)
 def _diffusion(
     conc: NDArrayA,
-    laplacian: Callable[[NDArrayA, NDArrayA, NDArrayA], np.float_],
+    max_neighs: int,
     n_iter: int,
     sat: NDArrayA,
     sat_idx: NDArrayA,
@@ -207,7 +203,7 @@ def _diffusion(
     D: float = 1.0,
     thresh: float = 1e-8,
 ) -> float:
-    """Simulate diffusion process on a regular graph."""
+    """Simulate diffusion process on a regular graph with ``max_neighs`` neighbors, either `4` or `6`."""
     sat_shape, conc_shape = sat.shape[0], conc.shape[0]
     entropy_arr = np.zeros(n_iter)
     prev_ent = 1.0
@@ -217,7 +213,11 @@ def _diffusion(
     for i in range(n_iter):
         for j in range(sat_shape):
             nhood[j] = np.sum(conc[sat_idx[j]])
-        d2 = laplacian(conc[sat], nhood, weights)
+        # the Laplacian is selected here, a function argument would prevent caching the compiled function
+        if max_neighs == 4:
+            d2 = _laplacian_rect(conc[sat], nhood, weights)
+        else:
+            d2 = _laplacian_hex(conc[sat], nhood, weights)
 
         dcdt = np.zeros(conc_shape)
         dcdt[sat] = D * d2
@@ -237,7 +237,7 @@ def _diffusion(
 
 
 # taken from https://github.com/almaan/sepal/blob/master/sepal/models.py
-@njit(parallel=False, fastmath=True)
+@njit(parallel=False, fastmath=True, cache=True)
 def _laplacian_rect(
     centers: NDArrayA,
     nbrs: NDArrayA,
@@ -255,7 +255,7 @@ def _laplacian_rect(
 
 
 # taken from https://github.com/almaan/sepal/blob/master/sepal/models.py
-@njit(fastmath=True)
+@njit(cache=True, fastmath=True)
 def _laplacian_hex(
     centers: NDArrayA,
     nbrs: NDArrayA,
@@ -278,7 +278,7 @@ def _laplacian_hex(
 
 
 # taken from https://github.com/almaan/sepal/blob/master/sepal/models.py
-@njit(fastmath=True)
+@njit(cache=True, fastmath=True)
 def _entropy(
     xx: NDArrayA,
 ) -> float:
@@ -291,22 +291,24 @@ def _entropy(
 
 
 def _compute_idxs(
-    g: spmatrix, spatial: NDArrayA, sat_thresh: int, metric: str = "l1"
+    g: spmatrix, index: SpatialIndex, sat_thresh: int, metric: str = "l1"
 ) -> tuple[NDArrayA, NDArrayA, NDArrayA, NDArrayA]:
     """Get saturated and unsaturated nodes and neighborhood indices."""
     sat, unsat = _get_sat_unsat_idx(g.indptr, g.shape[0], sat_thresh)
 
     sat_idx, nearest_sat, un_unsat = _get_nhood_idx(sat, unsat, g.indptr, g.indices, sat_thresh)
 
-    # compute dist btwn remaining unsat and all sat
-    dist = pairwise_distances(spatial[un_unsat], spatial[sat], metric=metric)
-    # assign closest sat to remaining nearest_sat
-    nearest_sat[np.isnan(nearest_sat)] = sat[np.argmin(dist, axis=1)]
+    # assign closest sat to remaining nearest_sat, the ties are broken by the lowest index
+    if len(un_unsat):
+        is_sat = np.zeros((g.shape[0],), dtype=bool)
+        is_sat[sat] = True
+        _, nearest = index.kneighbors(index.coords[un_unsat], n_neighbors=1, mask=is_sat, metric=metric)
+        nearest_sat[np.isnan(nearest_sat)] = nearest[:, 0]
 
     return sat, sat_idx, unsat, nearest_sat.astype(np.int32)
 
 
-@njit
+@njit(cache=True)
 def _get_sat_unsat_idx(g_indptr: NDArrayA, g_shape: int, sat_thresh: int) -> tuple[NDArrayA, NDArrayA]:
     """Get saturated and unsaturated nodes based on thresh."""
     n_indices = np.diff(g_indptr)
@@ -316,7 +318,7 @@ def _get_sat_unsat_idx(g_indptr: NDArrayA, g_shape: int, sat_thresh: int) -> tup
     return sat, unsat
 
 
-@njit
+@njit(cache=True)
 def _get_nhood_idx(
     sat: NDArrayA, unsat: NDArrayA, g_indptr: NDArrayA, g_indices: NDArrayA, sat_thresh: int
 ) -> tuple[NDArrayA, NDArrayA, NDArrayA]:
@@ -10,7 +10,7 @@ from anndata import AnnData
 from anndata.utils import make_index_unique
 from anndata._core.views import ArrayView, SparseCSCView, SparseCSRView
 
-from scipy.sparse import issparse, spmatrix, csc_matrix, csr_matrix
+from scipy.sparse import issparse, spmatrix, csc_matrix, csr_matrix, isspmatrix_csr
 from pandas.api.types import infer_dtype, is_categorical_dtype
 import numpy as np
 import pandas as pd
@@ -188,6 +188,68 @@ def _assert_in_range(value: float, minn: float, maxx: float, *, name: str) -> No
         raise ValueError(f"Expected `{name}` to be in interval `[{minn}, {maxx}]`, found `{value}`.")
 
 
+def _is_row_normalized(g: spmatrix) -> bool:
+    """Check whether the non-empty rows of the non-negative weights sum to `1`, e.g. after ``transform = 'row'``."""
+    if not isspmatrix_csr(g) or not g.nnz or np.issubdtype(g.dtype, np.integer) or g.data.min() < 0:
+        return False
+
+    sums = np.asarray(g.sum(axis=1)).squeeze(axis=1)
+    sums = sums[np.diff(g.indptr) > 0]
+    # rounding errors accumulate with the number of neighbors
+    atol = np.finfo(g.dtype).eps * max(1, np.diff(g.indptr).max())
+
+    return bool(np.allclose(sums, 1.0, rtol=0, atol=atol))
+
+
+def _get_strata(codes: NDArrayA, n_strata: int | None = None) -> list[NDArrayA]:
+    """Split the observations into the sorted indices of each library, ignoring the negative codes."""
+    valid = codes >= 0
+    if n_strata is None:
+        n_strata = int(codes.max()) + 1 if valid.any() else 0
+    ixs = np.argsort(codes, kind="stable")[len(codes) - valid.sum() :]
+
+    return np.split(ixs, np.cumsum(np.bincount(codes[valid], minlength=n_strata))[:-1]) if n_strata else []
+
+
+def _shuffle(
+    rs: np.random.RandomState | np.random.Generator, x: NDArrayA, strata: Sequence[NDArrayA] | None = None
+) -> None:
+    """Shuffle ``x`` in place, only within each of the ``strata``, if not `None`."""
+    if strata is None:
+        rs.shuffle(x)
+        return
+
+    for ix in strata:
+        x[ix] = x[rs.permutation(ix)]
+
+
+def _permutation(
+    rs: np.random.RandomState | np.random.Generator, n: int, strata: Sequence[NDArrayA] | None = None
+) -> NDArrayA:
+    """Permute ``n`` indices, only within each of the ``strata``, if not `None`."""
+    if strata is None:
+        return rs.permutation(n)
+
+    perm = np.arange(n)
+    _shuffle(rs, perm, strata)
+
+    return perm
+
+
+def _combine_moments(
+    moments: Sequence[tuple[int | NDArrayA, NDArrayA, NDArrayA]]
+) -> tuple[int | NDArrayA, NDArrayA, NDArrayA]:
+    """Combine the sizes, means and sums of squared deviations of several samples, as in Chan et al. (1983)."""
+    n, mean, m2 = moments[0]
+    for n_b, mean_b, m2_b in moments[1:]:
+        delta = mean_b - mean
+        mean = mean + delta * (n_b / (n + n_b))
+        m2 = m2 + m2_b + delta**2 * (n * n_b / (n + n_b))
+        n = n + n_b
+
+    return n, mean, m2
+
+
 def _save_data(adata: AnnData, *, attr: str, key: str, data: Any, prefix: bool = True, time: Any | None = None) -> None:
     obj = getattr(adata, attr)
     obj[key] = data
@@ -0,0 +1,125 @@
+"""Ahead-of-time compilation of the :mod:`numba` kernels."""
+from __future__ import annotations
+
+from time import perf_counter
+from types import ModuleType
+from typing import Any, Callable, Sequence
+
+from scanpy import logging as logg
+from anndata import AnnData
+
+from numba.core.dispatcher import Dispatcher
+import numpy as np
+import pandas as pd
+
+from squidpy.gr import _build, _index, _nhood, _sepal, _ligrec, _ppatterns
+from squidpy._constants._pkg_constants import Key
+
+__all__ = ["warmup"]
+
+_MODULES: Sequence[ModuleType] = (_build, _index, _nhood, _sepal, _ligrec, _ppatterns)
+
+
+def warmup() -> pd.DataFrame:
+    """
+    Compile the :mod:`numba` kernels of :mod:`squidpy.gr` for the common signatures.
+
+    The graph functions are run on a small synthetic dataset. The compiled kernels are cached on disk, in the
+    ``__pycache__`` directories of :mod:`squidpy` or, if these are not writable, in the user-wide cache directory.
+    A different directory can be set with the ``NUMBA_CACHE_DIR`` environment variable before importing
+    :mod:`squidpy`, it is inherited by the worker processes. After running this function once per environment,
+    the new processes only load the compiled kernels.
+
+    Returns
+    -------
+    :class:`pandas.DataFrame` indexed by the functions that were run, with the following columns:
+
+        - `'time'` - time in seconds, mostly spent compiling or loading the kernels.
+        - `'cache_hits'` - number of kernel signatures loaded from the disk cache.
+        - `'cache_misses'` - number of kernel signatures compiled.
+    """
+    from squidpy.gr import (
+        sepal,
+        ligrec,
+        co_occurrence,
+        nhood_enrichment,
+        spatial_autocorr,
+        centrality_scores,
+        nhood_composition,
+        spatial_neighbors,
+        interaction_matrix,
+    )
+
+    adata = _synthetic_adata()
+    ck, kwargs = "cluster", {"copy": True, "n_jobs": 1, "show_progress_bar": False}
+
+    def build() -> None:
+        spatial_neighbors(adata, coord_type="generic", delaunay=True, key_added="delaunay")
+        spatial_neighbors(adata, coord_type="generic", radius=2.0, key_added="radius")
+        spatial_neighbors(adata, coord_type="generic", n_neighs=[4, 6], key_added="knn")
+        spatial_neighbors(adata, coord_type="grid", n_neighs=4, n_rings=2, key_added="rings")
+        spatial_neighbors(adata, coord_type="grid", n_neighs=4)
+
+    def nhood() -> None:
+        nhood_enrichment(adata, cluster_key=ck, n_perms=10, seed=0, **kwargs)
+        nhood_enrichment(adata, cluster_key=ck, n_perms=10, seed=0, library_key="library", **kwargs)
+        nhood_enrichment(adata, cluster_key=ck, analytical=True, copy=True)
+        centrality_scores(adata, cluster_key=ck, copy=True, n_jobs=1)
+        centrality_scores(adata, cluster_key=ck, score="closeness_centrality", n_samples=10, copy=True, n_jobs=1)
+        interaction_matrix(adata, cluster_key=[ck, "library"], library_key="library", copy=True)
+        nhood_composition(adata, cluster_key=ck, copy=True)
+
+    steps: dict[str, Callable[[], Any]] = {
+        "spatial_neighbors": build,
+        "nhood_enrichment": nhood,
+        "co_occurrence": lambda: co_occurrence(adata, cluster_key=ck, interval=5, **kwargs),
+        "spatial_autocorr": lambda: spatial_autocorr(adata, n_perms=10, seed=0, **kwargs),
+        "sepal": lambda: sepal(adata, max_neighs=4, n_iter=100, **kwargs),
+        "ligrec": lambda: ligrec(
+            adata,
+            ck,
+            interactions=pd.DataFrame({"source": ["g0", "g1"], "target": ["g2", "g3"]}),
+            threshold=0,
+            use_raw=False,
+            n_perms=10,
+            seed=0,
+            **kwargs,
+        ),
+    }
+
+    res = {}
+    for name, fn in steps.items():
+        hits, misses = _cache_stats()
+        start = perf_counter()
+        fn()
+        end = perf_counter()
+        new_hits, new_misses = _cache_stats()
+        res[name] = {"time": end - start, "cache_hits": new_hits - hits, "cache_misses": new_misses - misses}
+        logg.info(f"Compiled the kernels of `{name}` in `{end - start:.2f}s`")
+
+    return pd.DataFrame.from_dict(res, orient="index")
+
+
+def _synthetic_adata(n: int = 8) -> AnnData:
+    rng = np.random.RandomState(0)
+    coords = np.stack(np.meshgrid(np.arange(n), np.arange(n)), axis=-1).reshape(-1, 2).astype(np.float64)
+    adata = AnnData(
+        rng.poisson(2, size=(n * n, 4)).astype(np.float32), obsm={Key.obsm.spatial: coords}, dtype=np.float32
+    )
+    adata.var_names = [f"g{i}" for i in range(adata.n_vars)]
+    adata.obs["cluster"] = pd.Categorical(rng.choice(["a", "b", "c"], size=adata.n_obs))
+    adata.obs["library"] = pd.Categorical(np.repeat(["a", "b"], adata.n_obs // 2))
+
+    return adata
+
+
+def _cache_stats() -> tuple[int, int]:
+    """Return the number of cache hits and misses of all the compiled kernels."""
+    hits, misses = 0, 0
+    for module in _MODULES:
+        for obj in vars(module).values():
+            if isinstance(obj, Dispatcher):
+                hits += sum(obj.stats.cache_hits.values())
+                misses += sum(obj.stats.cache_misses.values())
+
+    return hits, misses
@@ -60,19 +60,20 @@ def _position_cluster_labels(coords: NDArrayA, clusters: pd.Series, colors: NDAr
     return {"clusters": clusters, "colors": colors}
 
 
-def _not_in_01(arr: NDArrayA | da.Array) -> bool:
-    @njit
-    def _helper_arr(arr: NDArrayA) -> bool:
-        for val in arr.flat:
-            if not (0 <= val <= 1):
-                return True
+@njit(cache=True)
+def _not_in_01_arr(arr: NDArrayA) -> bool:
+    for val in arr.flat:
+        if not (0 <= val <= 1):
+            return True
+
+    return False
 
-        return False
 
+def _not_in_01(arr: NDArrayA | da.Array) -> bool:
     if isinstance(arr, da.Array):
         return bool(np.min(arr) < 0) or bool(np.max(arr) > 1)
 
-    return bool(_helper_arr(np.asarray(arr)))
+    return bool(_not_in_01_arr(np.asarray(arr)))
 
 
 def _display_channelwise(arr: NDArrayA | da.Array) -> bool:
@@ -187,7 +187,7 @@ def _point_inside_triangles(triangles: NDArrayA) -> np.bool_:
     return np.any((s_AB != s_AC) & (s_AB == s_BC))
 
 
-@njit(parallel=True)
+@njit(parallel=True, cache=True)
 def _points_inside_triangles(points: NDArrayA, triangles: NDArrayA) -> NDArrayA:
     out = np.empty(
         len(
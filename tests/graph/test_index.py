@@ -0,0 +1,104 @@
+from typing import Optional
+import pytest
+
+from anndata import AnnData
+import anndata as ad
+
+from sklearn.neighbors import NearestNeighbors
+import numpy as np
+
+from squidpy.gr import spatial_neighbors
+from squidpy.gr._index import SpatialIndex, _get_spatial_index
+from squidpy._constants._pkg_constants import Key
+
+
+class TestSpatialIndex:
+    @pytest.mark.parametrize("n_dims", [1, 2, 3])
+    @pytest.mark.parametrize("metric", ["euclidean", "manhattan"])
+    @pytest.mark.parametrize("n_neighbors", [1, 5])
+    def test_kneighbors(self, n_dims: int, metric: str, n_neighbors: int):
+        rng = np.random.RandomState(42)
+        coords = rng.uniform(0, 100, size=(1000, n_dims))
+        index = SpatialIndex(coords)
+
+        dists, _ = index.kneighbors(n_neighbors=n_neighbors, metric=metric)
+        expected, _ = NearestNeighbors(n_neighbors=n_neighbors, metric=metric).fit(coords).kneighbors()
+        np.testing.assert_allclose(dists, expected)
+
+        points, mask = rng.uniform(-10, 110, size=(200, n_dims)), rng.uniform(size=len(coords)) < 0.2
+        dists, neighs = index.kneighbors(points, n_neighbors=n_neighbors, mask=mask, metric=metric)
+        expected, _ = NearestNeighbors(n_neighbors=n_neighbors, metric=metric).fit(coords[mask]).kneighbors(points)
+        np.testing.assert_allclose(dists, expected)
+        assert mask[neighs].all()
+
+    @pytest.mark.parametrize("n_dims", [2, 3])
+    def test_kneighbors_far(self, n_dims: int):
+        rng = np.random.RandomState(42)
+        # a compact cluster queried from far away, which scans only the rings of cells close to the points
+        coords = rng.normal(0, 1, size=(500, n_dims))
+        coords[::7] = coords[1::7]  # duplicates
+        points = rng.uniform(-100, 100, size=(300, n_dims))
+        index = SpatialIndex(coords)
+
+        dists, neighs = index.kneighbors(points, n_neighbors=4)
+        expected, expected_neighs = NearestNeighbors(n_neighbors=4).fit(coords).kneighbors(points)
+        np.testing.assert_allclose(dists, expected)
+        np.testing.assert_allclose(np.linalg.norm(coords[neighs] - points[:, np.newaxis], axis=-1), expected)
+
+    @pytest.mark.parametrize("radius", [0.5, 5.0])
+    def test_radius_neighbors(self, radius: float):
+        rng = np.random.RandomState(42)
+        coords = rng.uniform(0, 100, size=(1000, 2))
+        coords[::10] = coords[1::10]  # duplicates
+        index = SpatialIndex(coords)
+
+        dists, neighs, offsets = index.radius_neighbors(radius=radius)
+        expected_dists, expected_neighs = NearestNeighbors(radius=radius).fit(coords).radius_neighbors()
+
+        assert offsets.shape == (len(coords) + 1,)
+        for i in range(len(coords)):
+            actual = slice(offsets[i], offsets[i + 1])
+            order, expected_order = np.argsort(neighs[actual]), np.argsort(expected_neighs[i])
+            np.testing.assert_array_equal(neighs[actual][order], expected_neighs[i][expected_order])
+            np.testing.assert_allclose(dists[actual][order], expected_dists[i][expected_order])
+
+    def test_ties(self):
+        coords = np.array([[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [-1.0, 0.0], [0.0, -1.0]])
+        _, neighs = SpatialIndex(coords).kneighbors(coords[:1], n_neighbors=3, mask=np.arange(5) != 0)
+
+        np.testing.assert_array_equal(neighs, [[1, 2, 3]])
+
+    def test_invalid_n_neighbors(self):
+        with pytest.raises(ValueError, match=r"at most `9`"):
+            SpatialIndex(np.random.RandomState(0).normal(size=(10, 2))).kneighbors(n_neighbors=10)
+
+    @pytest.mark.parametrize("cell_size", [None, 0.1, 1e3])
+    def test_cell_size(self, cell_size: Optional[float]):
+        coords = np.random.RandomState(42).uniform(0, 10, size=(100, 2))
+        dists, _ = SpatialIndex(coords, cell_size=cell_size).kneighbors(n_neighbors=3)
+
+        np.testing.assert_allclose(dists, NearestNeighbors(n_neighbors=3).fit(coords).kneighbors()[0])
+
+    def test_write_h5ad(self, tmp_path, non_visium_adata: AnnData):
+        key = Key.uns.spatial_index()
+        spatial_neighbors(non_visium_adata, coord_type="generic", n_neighs=2)
+        assert key not in non_visium_adata.uns
+
+        spatial_neighbors(non_visium_adata, coord_type="generic", n_neighs=2, store_index=True)
+        assert key in non_visium_adata.uns
+
+        non_visium_adata.write_h5ad(tmp_path / "adata.h5ad")
+        adata = ad.read_h5ad(tmp_path / "adata.h5ad")
+        index = _get_spatial_index(adata)
+
+        np.testing.assert_array_equal(index.to_dict()["order"], non_visium_adata.uns[key]["order"])
+        assert index.fingerprint == non_visium_adata.uns[key]["fingerprint"]
+
+    def test_stale(self, non_visium_adata: AnnData):
+        spatial_neighbors(non_visium_adata, coord_type="generic", n_neighs=2, store_index=True)
+        non_visium_adata.obsm[Key.obsm.spatial] = non_visium_adata.obsm[Key.obsm.spatial] * 2
+
+        index = _get_spatial_index(non_visium_adata)
+
+        assert index.fingerprint != non_visium_adata.uns[Key.uns.spatial_index()]["fingerprint"]
+        np.testing.assert_array_equal(index.coords, non_visium_adata.obsm[Key.obsm.spatial])
@@ -1,7 +1,7 @@
-from time import time
 from typing import Tuple, Mapping, Optional, Sequence, TYPE_CHECKING
 from itertools import product
 import sys
+import zarr
 import pytest
 
 from scanpy import settings as s
@@ -9,12 +9,13 @@ from anndata import AnnData
 from scanpy.datasets import blobs
 import scanpy as sc
 
+from numba import get_num_threads
 from pandas.testing import assert_frame_equal
 import numpy as np
 import pandas as pd
 
 from squidpy.gr import ligrec
-from squidpy.gr._ligrec import PermutationTest
+from squidpy.gr._ligrec import PermutationTest, _load_interactions, _save_interactions
 from squidpy._constants._pkg_constants import Key
 
 _CK = "leiden"
@@ -308,8 +309,96 @@ class TestValidBehavior:
         assert not np.allclose(r3["pvalues"], r1["pvalues"])
         assert not np.allclose(r3["pvalues"], r2["pvalues"])
 
+    def test_library_key(self, adata: AnnData, interactions: Interactions_t):
+        kwargs = {"interactions": interactions, "n_perms": 25, "copy": True, "show_progress_bar": False, "seed": 42}
+        adata.obs["library"] = pd.Categorical(["a"] * adata.n_obs)
+        r1 = ligrec(adata, _CK, **kwargs)
+        r2 = ligrec(adata, _CK, library_key="library", **kwargs)
+
+        np.testing.assert_allclose(r1["means"], r2["means"])
+        np.testing.assert_allclose(r1["pvalues"], r2["pvalues"])
+
+        adata.obs["library"] = pd.Categorical(np.random.RandomState(0).choice(["a", "b"], size=adata.n_obs))
+        r3 = ligrec(adata, _CK, library_key="library", **kwargs)
+
+        np.testing.assert_allclose(r1["means"], r3["means"])
+        assert not np.allclose(r1["pvalues"], r3["pvalues"], equal_nan=True)
+
+    def test_early_stopping(self, adata: AnnData, interactions: Interactions_t):
+        kwargs = {"interactions": interactions, "copy": True, "show_progress_bar": False, "seed": 42}
+        r1 = ligrec(adata, _CK, n_perms=25, **kwargs)
+        r2 = ligrec(adata, _CK, n_perms=25, early_stopping=1000, **kwargs)
+
+        assert "n_perms" not in r1
+        np.testing.assert_allclose(r1["means"], r2["means"])
+        np.testing.assert_allclose(r1["pvalues"], r2["pvalues"])
+        np.testing.assert_array_equal(r2["n_perms"], 25)
+
+        r3 = ligrec(adata, _CK, n_perms=300, early_stopping=5, **kwargs)
+        n_perms, pvals = r3["n_perms"].values, r3["pvalues"].values
+
+        np.testing.assert_allclose(r1["means"], r3["means"])
+        assert np.all((n_perms > 0) & (n_perms <= 300))
+        assert np.any(n_perms < 300)
+        stopped = n_perms < 300
+        np.testing.assert_array_equal(np.isnan(pvals), np.isnan(r1["pvalues"].values))
+        assert np.all(pvals[stopped & ~np.isnan(pvals)] >= 5 / 300)
+
+    def test_sparse_dense_equal(self, adata: AnnData, interactions: Interactions_t, monkeypatch):
+        kwargs = {"interactions": interactions, "n_perms": 25, "copy": True, "show_progress_bar": False, "seed": 42}
+        monkeypatch.setattr("squidpy.gr._ligrec._MAX_SPARSE_DENSITY", np.inf)
+        r1 = ligrec(adata, _CK, **kwargs)
+        monkeypatch.setattr("squidpy.gr._ligrec._MAX_SPARSE_DENSITY", 0)
+        r2 = ligrec(adata, _CK, **kwargs)
+
+        np.testing.assert_allclose(r1["means"], r2["means"])
+        np.testing.assert_allclose(r1["pvalues"], r2["pvalues"])
+
+    @pytest.mark.parametrize("density", [0, np.inf])
+    @pytest.mark.parametrize("batch_size", [1, 7, 100])
+    def test_batch_size(
+        self, adata: AnnData, interactions: Interactions_t, density: float, batch_size: int, monkeypatch
+    ):
+        kwargs = {"interactions": interactions, "n_perms": 25, "copy": True, "show_progress_bar": False, "seed": 42}
+        monkeypatch.setattr("squidpy.gr._ligrec._MAX_SPARSE_DENSITY", density)
+        r1 = ligrec(adata, _CK, **kwargs)
+        r2 = ligrec(adata, _CK, batch_size=batch_size, **kwargs)
+
+        np.testing.assert_array_equal(r1["means"], r2["means"])
+        np.testing.assert_array_equal(r1["pvalues"], r2["pvalues"])
+
+    def test_null_cache(self, adata: AnnData, interactions: Interactions_t, tmpdir):
+        kwargs = {"n_perms": 25, "copy": True, "show_progress_bar": False, "seed": 42}
+        path = str(tmpdir / "null.zarr")
+        r1 = ligrec(adata, _CK, interactions=interactions, **kwargs)
+        r2 = ligrec(adata, _CK, interactions=interactions, null_cache=path, **kwargs)
+
+        np.testing.assert_array_equal(r1["means"], r2["means"])
+        np.testing.assert_array_equal(r1["pvalues"], r2["pvalues"])
+
+        subset = interactions[: len(interactions) // 2]
+        r3 = ligrec(adata, _CK, interactions=subset, **kwargs)
+        r4 = ligrec(adata, _CK, interactions=subset, null_cache=path, **kwargs)
+
+        np.testing.assert_array_equal(r3["means"], r4["means"])
+        np.testing.assert_array_equal(r3["pvalues"], r4["pvalues"])
+
+        # the cache is keyed by the full clustering, a subset of the clusters is read from it
+        clusters = list(adata.obs[_CK].cat.categories[:2])
+        r5 = ligrec(adata, _CK, interactions=interactions, clusters=clusters, null_cache=path, **kwargs)
+        pairs = list(product(clusters, repeat=2))
+
+        assert len(list(zarr.open_group(path).group_keys())) == 1
+        np.testing.assert_array_equal(r5["means"], r2["means"][pairs])
+        np.testing.assert_array_equal(r5["pvalues"], r2["pvalues"][pairs])
+
+        with pytest.raises(ValueError, match=r"without a `seed`"):
+            ligrec(adata, _CK, interactions=interactions, null_cache=path, n_perms=25, copy=True)
+        with pytest.raises(ValueError, match=r"`early_stopping`"):
+            ligrec(adata, _CK, interactions=interactions, null_cache=path, early_stopping=5, **kwargs)
+
     def test_reproducibility_numba_parallel_off(self, adata: AnnData, interactions: Interactions_t):
-        t1 = time()
+        n_threads = get_num_threads()
         r1 = ligrec(
             adata,
             _CK,
@@ -320,9 +409,6 @@ class TestValidBehavior:
             seed=42,
             numba_parallel=False,
         )
-        t1 = time() - t1
-
-        t2 = time()
         r2 = ligrec(
             adata,
             _CK,
@@ -333,11 +419,10 @@ class TestValidBehavior:
             seed=42,
             numba_parallel=True,
         )
-        t2 = time() - t2
 
         assert r1 is not r2
-        # for such a small data, overhead from parallelization is too high
-        assert t1 <= t2, (t1, t2)
+        # the kernels are compiled once, only the number of threads is changed during the test
+        assert get_num_threads() == n_threads
         np.testing.assert_allclose(r1["means"], r2["means"])
         np.testing.assert_allclose(r1["pvalues"], r2["pvalues"])
 
@@ -457,3 +542,54 @@ class TestValidBehavior:
         )
         assert isinstance(pt.interactions, pd.DataFrame)
         assert len(pt.interactions) == 1
+
+    def test_interactions_cache_dtypes(self, tmpdir):
+        interactions = pd.DataFrame(
+            {
+                "source": ["A", "B", "C"],
+                "target": ["D", None, "E"],
+                "is_stimulation": [True, False, True],
+                "consensus": pd.Series([True, np.nan, False], dtype=object),
+                "n_references": pd.Series([1, np.nan, 3], dtype=object),
+                "is_inhibition": pd.array([False, None, True], dtype="boolean"),
+                "curation_effort": [0.5, np.nan, 1.0],
+            }
+        )
+        path = str(tmpdir / "interactions.npz")
+        _save_interactions(interactions, path)
+        res = _load_interactions(path)
+
+        assert_frame_equal(res, interactions)
+        assert res["consensus"].tolist()[::2] == [True, False]
+        assert res["n_references"].tolist()[::2] == [1, 3]
+
+    def test_interactions_cache(self, adata: AnnData, tmpdir, monkeypatch):
+        g = adata.raw.var_names
+        fetched = pd.DataFrame(
+            {
+                "source": [g[0].upper(), f"{g[1]}_{g[2]}".upper(), g[3].upper()],
+                "target": [g[4].upper(), g[5].upper(), None],
+                "is_stimulation": [True, False, True],
+                "references": ["a;b", None, "c"],
+            }
+        )
+        calls = []
+
+        def fetch(*args):
+            calls.append(args)
+            return fetched.copy()
+
+        monkeypatch.setattr("squidpy.gr._ligrec._fetch_interactions", fetch)
+        pt1 = PermutationTest(adata).prepare(cache_dir=tmpdir)
+        pt2 = PermutationTest(adata).prepare(cache_dir=tmpdir, offline=True)
+
+        assert len(calls) == 1
+        assert len(tmpdir.listdir()) == 1
+        assert_frame_equal(pt1.interactions, pt2.interactions)
+
+        # different query parameters
+        with pytest.raises(FileNotFoundError, match=r"No cached interactions"):
+            PermutationTest(adata).prepare(cache_dir=tmpdir, receiver_params={"categories": "ligand"}, offline=True)
+        with pytest.raises(ValueError, match=r"without `cache_dir`"):
+            PermutationTest(adata).prepare(offline=True)
+        assert len(calls) == 1
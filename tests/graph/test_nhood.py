@@ -1,16 +1,23 @@
+from typing import Optional
 import pytest
+import itertools
 
 from anndata import AnnData
 
+from scipy.sparse import csr_matrix
 import numpy as np
 import pandas as pd
 
+import networkx as nx
+
 from squidpy.gr import (
     nhood_enrichment,
     centrality_scores,
+    nhood_composition,
     spatial_neighbors,
     interaction_matrix,
 )
+from squidpy.gr._nhood import _nenrich_perms, _combine_moments
 from squidpy._constants._pkg_constants import Key
 
 _CK = "leiden"
@@ -57,6 +64,101 @@ class TestNhoodEnrichment:
             else:  # counts
                 np.testing.assert_array_equal(res3[key], res2[key])
 
+    @pytest.mark.parametrize("numba_parallel", [False, True])
+    def test_count(self, adata: AnnData, numba_parallel: bool):
+        spatial_neighbors(adata)
+        adj, clusters = adata.obsp[Key.obsp.spatial_conn()].tocoo(), adata.obs[_CK].cat.codes.values
+        expected = np.zeros((len(adata.obs[_CK].cat.categories),) * 2, dtype=np.uint32)
+        np.add.at(expected, (clusters[adj.row], clusters[adj.col]), 1)
+
+        _, count = nhood_enrichment(adata, cluster_key=_CK, n_perms=5, numba_parallel=numba_parallel, copy=True)
+
+        np.testing.assert_array_equal(count, expected)
+
+    def test_many_clusters(self, adata: AnnData):
+        spatial_neighbors(adata)
+        fine = np.random.RandomState(0).randint(300, size=adata.n_obs)
+        adata.obs["fine"] = pd.Categorical(fine, categories=np.arange(300))
+
+        _, count = nhood_enrichment(adata, cluster_key="fine", n_perms=5, copy=True)
+
+        assert count.shape == (300, 300)
+        assert count.sum() == adata.obsp[Key.obsp.spatial_conn()].nnz
+
+    def test_perms_moments(self, adata: AnnData):
+        spatial_neighbors(adata)
+        adj = adata.obsp[Key.obsp.spatial_conn()].tocoo()
+        rows, cols = adj.row.astype(np.uint32), adj.col.astype(np.uint32)
+        clusters = adata.obs[_CK].cat.codes.values.astype(np.uint32)
+        n_cls = len(adata.obs[_CK].cat.categories)
+
+        order, offsets, edge_libs = np.arange(adata.n_obs), np.array([0, adata.n_obs]), np.empty((0,), dtype=np.int64)
+
+        mean, m2 = _nenrich_perms(rows, cols, clusters.copy(), n_cls, 30, 42, order, offsets, edge_libs, 0)
+        mean2, m22 = _nenrich_perms(rows, cols, clusters.copy(), n_cls, 30, 42, order, offsets, edge_libs, 0)
+
+        assert mean.shape == (1, n_cls, n_cls)
+        np.testing.assert_allclose(mean.sum(), adj.nnz)
+        assert np.all(m2 >= 0)
+        np.testing.assert_array_equal(mean, mean2)
+        np.testing.assert_array_equal(m2, m22)
+
+    @pytest.mark.parametrize("set_diag", [False, True])
+    def test_analytical(self, set_diag: bool):
+        adj = (np.random.RandomState(0).uniform(size=(7, 7)) < 0.4).astype(float)
+        np.fill_diagonal(adj, set_diag)
+        adata = AnnData(np.zeros((7, 1)), obsp={Key.obsp.spatial_conn(): csr_matrix(adj)}, dtype=float)
+        adata.obs[_CK] = pd.Categorical(["a", "a", "a", "b", "b", "c", "c"])
+        # all permutations of the labels
+        adjs = [adj[np.ix_(perm, perm)] for perm in itertools.permutations(range(adata.n_obs))]
+        codes = adata.obs[_CK].cat.codes.values
+        onehot = np.eye(3)[codes]
+        counts = np.array([onehot.T @ a @ onehot for a in adjs])
+
+        zscore, count = nhood_enrichment(adata, cluster_key=_CK, analytical=True, copy=True)
+
+        np.testing.assert_array_equal(count, onehot.T @ adj @ onehot)
+        np.testing.assert_allclose(zscore, (count - counts.mean(axis=0)) / counts.std(axis=0))
+
+    def test_analytical_partial_diag(self, adata: AnnData):
+        spatial_neighbors(adata)
+        adata.obsp[Key.obsp.spatial_conn()][0, 0] = 1
+
+        with pytest.raises(NotImplementedError, match=r"all or none"):
+            nhood_enrichment(adata, cluster_key=_CK, analytical=True)
+
+    def test_library_key(self, adata: AnnData):
+        adata.obs["library"] = pd.Categorical(np.random.RandomState(0).choice(["a", "b"], size=adata.n_obs))
+        spatial_neighbors(adata, library_key="library")
+
+        nhood_enrichment(adata, cluster_key=_CK, library_key="library", n_perms=20)
+        zscore, count, lib_zscore, lib_count = nhood_enrichment(
+            adata, cluster_key=_CK, library_key="library", analytical=True, copy=True
+        )
+        res = adata.uns[Key.uns.nhood_enrichment(_CK)]
+
+        n_cls = len(adata.obs[_CK].cat.categories)
+        assert res["library_zscore"].shape == res["library_count"].shape == (2, n_cls, n_cls)
+        np.testing.assert_array_equal(res["library_count"], lib_count)
+        np.testing.assert_array_equal(lib_count.sum(axis=0), count)
+        for i, lib in enumerate(["a", "b"]):
+            bdata = adata[adata.obs["library"] == lib].copy()
+            bdata.obs[_CK] = bdata.obs[_CK].cat.set_categories(adata.obs[_CK].cat.categories)
+            lib_zscore_i, lib_count_i = nhood_enrichment(bdata, cluster_key=_CK, analytical=True, copy=True)
+
+            np.testing.assert_array_equal(lib_count[i], lib_count_i)
+            np.testing.assert_allclose(lib_zscore[i], lib_zscore_i)
+
+    def test_combine_moments(self):
+        x = np.random.RandomState(0).normal(size=(100, 3, 3))
+        moments = [(len(c), c.mean(axis=0), ((c - c.mean(axis=0)) ** 2).sum(axis=0)) for c in np.array_split(x, 7)]
+
+        n, mean, m2 = _combine_moments(moments)
+
+        assert n == len(x)
+        np.testing.assert_allclose(mean, x.mean(axis=0))
+        np.testing.assert_allclose(m2 / n, x.var(axis=0))
+
 
 def test_centrality_scores(nhood_data: AnnData):
     adata = nhood_data
@@ -76,6 +178,24 @@ def test_centrality_scores(nhood_data: AnnData):
     assert adata.uns[key]["closeness_centrality"].dtype == np.dtype("float64")
 
 
+def test_centrality_scores_networkx():
+    rng = np.random.RandomState(0)
+    adj = csr_matrix(rng.binomial(1, 0.05, size=(60, 60)))
+    adata = AnnData(np.zeros((60, 1)), obsp={Key.obsp.spatial_conn(): adj}, dtype=float)
+    adata.obs[_CK] = pd.Categorical(rng.choice(["a", "b", "c"], size=60))
+
+    df = centrality_scores(adata, cluster_key=_CK, copy=True, n_jobs=1)
+    df_sampled = centrality_scores(adata, cluster_key=_CK, score="closeness_centrality", n_samples=60, copy=True)
+
+    graph = nx.Graph(adj)
+    for c in ["a", "b", "c"]:
+        idx = np.where(adata.obs[_CK] == c)[0]
+        np.testing.assert_allclose(df.loc[c, "closeness_centrality"], nx.group_closeness_centrality(graph, idx))
+        np.testing.assert_allclose(df.loc[c, "degree_centrality"], nx.group_degree_centrality(graph, idx))
+        np.testing.assert_allclose(df.loc[c, "average_clustering"], nx.average_clustering(graph, idx))
+    np.testing.assert_allclose(df_sampled["closeness_centrality"], df["closeness_centrality"])
+
+
 @pytest.mark.parametrize("copy", [True, False])
 def test_interaction_matrix_copy(nhood_data: AnnData, copy: bool):
     adata = nhood_data
@@ -162,3 +282,72 @@ def test_interaction_matrix_nan_values(adata_intmat: AnnData):
 
     np.testing.assert_array_equal(expected_weighted, result_weighted)
     np.testing.assert_array_equal(expected_unweighted, result_unweighted)
+
+
+def test_interaction_matrix_multiple_keys(adata_intmat: AnnData):
+    adata_intmat.obs["cat2"] = pd.Categorical(["x", "y", "x", "x", np.nan])
+    adata_intmat.obs["library"] = pd.Categorical(["a", "b", "a", "b", "a"])
+    res = interaction_matrix(adata_intmat, ["cat", "cat2"], weights=True, library_key="library", copy=True)
+
+    assert set(res) == {"cat", "cat2"}
+    for key in ["cat", "cat2"]:
+        mat, lib_mat = res[key]
+        np.testing.assert_array_equal(mat, interaction_matrix(adata_intmat, key, weights=True, copy=True))
+        np.testing.assert_array_equal(lib_mat.sum(axis=0), mat)
+        for i, lib in enumerate(["a", "b"]):
+            bdata = adata_intmat.copy()
+            mask = (bdata.obs["library"] == lib).values.astype(int)[:, None]
+            bdata.obsp["spatial_connectivities"] = csr_matrix(bdata.obsp["spatial_connectivities"].multiply(mask))
+            np.testing.assert_array_equal(lib_mat[i], interaction_matrix(bdata, key, weights=True, copy=True))
+
+    interaction_matrix(adata_intmat, ["cat", "cat2"], library_key="library")
+    assert Key.uns.interaction_matrix("cat2", "library") in adata_intmat.uns
+
+
+class TestNhoodComposition:
+    def test_interaction_matrix(self, nhood_data: AnnData):
+        adata = nhood_data
+        nhood_composition(adata, cluster_key=_CK, connectivity_key="spatial")
+        comp = adata.obsm[Key.obsm.nhood_composition(_CK)]
+        onehot = pd.get_dummies(adata.obs[_CK]).values.astype(np.float32)
+
+        assert comp.dtype == np.float32
+        assert comp.shape == (adata.n_obs, len(adata.obs[_CK].cat.categories))
+        np.testing.assert_allclose(onehot.T @ comp, interaction_matrix(adata, cluster_key=_CK, copy=True))
+
+    @pytest.mark.parametrize("normalized", [False, True])
+    def test_sparse_batches(self, nhood_data: AnnData, normalized: bool):
+        adata = nhood_data
+        kwargs = {"cluster_key": _CK, "connectivity_key": ["spatial", "spatial"], "normalized": normalized}
+        dense = nhood_composition(adata, copy=True, **kwargs)
+        sparse = nhood_composition(adata, copy=True, sparse=True, batch_size=7, **kwargs)
+
+        assert isinstance(sparse, csr_matrix)
+        n_cls = len(adata.obs[_CK].cat.categories)
+        assert dense.shape == (adata.n_obs, 2 * n_cls)
+        np.testing.assert_allclose(sparse.toarray(), dense)
+        np.testing.assert_array_equal(dense[:, :n_cls], dense[:, n_cls:])
+        if normalized:
+            sums = dense[:, :n_cls].sum(axis=1)
+            np.testing.assert_allclose(sums[sums > 0], 1, rtol=1e-5)
+
+    def test_bandwidth(self, nhood_data: AnnData):
+        adata = nhood_data
+        comp = nhood_composition(adata, cluster_key=_CK, connectivity_key="spatial", copy=True)
+        comp_bw = nhood_composition(adata, cluster_key=_CK, connectivity_key="spatial", bandwidth=1e6, copy=True)
+        comp_small = nhood_composition(adata, cluster_key=_CK, connectivity_key="spatial", bandwidth=1e-6, copy=True)
+
+        np.testing.assert_allclose(comp_bw, comp, rtol=1e-5)
+        assert np.all(comp_small <= comp)
+
+    @pytest.mark.parametrize("bandwidth", [None, 1.0])
+    def test_dense_batches(self, nhood_data: AnnData, bandwidth: Optional[float]):
+        adata = nhood_data
+        conn = adata.obsp[Key.obsp.spatial_conn("spatial")].copy()
+        kwargs = {"cluster_key": _CK, "connectivity_key": "spatial", "bandwidth": bandwidth}
+        comp = nhood_composition(adata, copy=True, **kwargs)
+        comp_batched = nhood_composition(adata, copy=True, batch_size=7, **kwargs)
+
+        assert comp_batched.dtype == np.float32
+        np.testing.assert_array_equal(comp_batched, comp)
+        np.testing.assert_array_equal(adata.obsp[Key.obsp.spatial_conn("spatial")].toarray(), conn.toarray())
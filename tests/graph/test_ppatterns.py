@@ -1,12 +1,17 @@
 import pytest
 
 from anndata import AnnData
+from scanpy.metrics._morans_i import _morans_i
 
+from numpy.random import default_rng
 from pandas.testing import assert_frame_equal
 import numpy as np
+import pandas as pd
 
-from squidpy.gr import co_occurrence, spatial_autocorr
-from squidpy.gr._ppatterns import _find_min_max
+from squidpy.gr import co_occurrence, spatial_autocorr, spatial_neighbors
+from squidpy.gr._utils import _get_strata, _permutation, _is_row_normalized
+from squidpy.gr._ppatterns import _find_min_max, _score_helper, _combine_score_stats
+from squidpy._constants._constants import SpatialAutocorr
 from squidpy._constants._pkg_constants import Key
 
 MORAN_K = "moranI"
@@ -46,6 +51,81 @@ def test_spatial_autocorr_seq_par(dummy_adata: AnnData, mode: str):
         assert_frame_equal(df, df_parallel)
 
 
+@pytest.mark.parametrize("mode", ["moran", "geary"])
+def test_spatial_autocorr_row_normalized(dummy_adata: AnnData, mode: str):
+    """Check that a row-normalized graph gives the same results as normalizing it in `spatial_autocorr`."""
+    df = spatial_autocorr(dummy_adata, mode=mode, copy=True, n_jobs=1, seed=42, n_perms=10)
+    conn = dummy_adata.obsp[Key.obsp.spatial_conn()]
+    spatial_neighbors(dummy_adata, transform="row")
+
+    assert _is_row_normalized(dummy_adata.obsp[Key.obsp.spatial_conn()])
+    assert not _is_row_normalized(conn)
+    df_row = spatial_autocorr(dummy_adata, mode=mode, copy=True, n_jobs=1, seed=42, n_perms=10)
+    assert_frame_equal(df, df_row)
+
+
+@pytest.mark.parametrize("mode", ["moran", "geary"])
+def test_spatial_autocorr_library_key(dummy_adata: AnnData, mode: str):
+    """Check that the permutations within a single library are the same as the global permutations."""
+    df = spatial_autocorr(dummy_adata, mode=mode, copy=True, n_jobs=1, seed=42, n_perms=10)
+    dummy_adata.obs["library"] = pd.Categorical(["a"] * dummy_adata.n_obs)
+    df_lib = spatial_autocorr(dummy_adata, mode=mode, copy=True, n_jobs=1, seed=42, n_perms=10, library_key="library")
+
+    assert_frame_equal(df, df_lib)
+
+
+@pytest.mark.parametrize("mode", ["moran", "geary"])
+def test_spatial_autocorr_early_stopping(dummy_adata: AnnData, mode: str):
+    kwargs = {"mode": mode, "copy": True, "n_jobs": 1, "seed": 42}
+    df = spatial_autocorr(dummy_adata, n_perms=50, **kwargs)
+    df_es = spatial_autocorr(dummy_adata, n_perms=50, early_stopping=1000, **kwargs)
+
+    np.testing.assert_array_equal(df_es.pop("n_perms"), 50)
+    assert_frame_equal(df, df_es)
+
+    df_es = spatial_autocorr(dummy_adata, n_perms=300, early_stopping=5, **kwargs)
+    stopped = df_es["n_perms"] < 300
+
+    assert np.all(df_es["n_perms"] > 0)
+    assert stopped.any()
+    assert np.all(df_es.loc[stopped, "pval_sim"] >= 5 / 300)
+    assert not df_es["var_sim"].isnull().any()
+
+
+def test_spatial_autocorr_score_stats(dummy_adata: AnnData):
+    """Check that the accumulated statistics match the stacked permuted scores."""
+    spatial_neighbors(dummy_adata)
+    g, vals = dummy_adata.obsp[Key.obsp.spatial_conn()], dummy_adata.X.T
+    score = _morans_i(g, vals)
+    stats = [
+        _score_helper(ix, perms, SpatialAutocorr.MORAN, g, vals, score, seed=42)
+        for ix, perms in enumerate(np.array_split(np.arange(30), 3))
+    ]
+    n, mean, m2, n_large = _combine_score_stats(stats)
+
+    sims = []
+    for ix, perms in enumerate(np.array_split(np.arange(30), 3)):
+        rng = default_rng(ix + 42)
+        sims.extend(_morans_i(g[_permutation(rng, g.shape[0]), :], vals) for _ in perms)
+    sims = np.array(sims)
+
+    assert n == 30
+    np.testing.assert_allclose(mean, sims.mean(axis=0))
+    np.testing.assert_allclose(m2 / n, sims.var(axis=0))
+    np.testing.assert_array_equal(n_large, (sims >= score).sum(axis=0))
+
+
+def test_permutation_strata():
+    codes = np.array([1, 0, -1, 1, 2, 0, 1, 1])
+    strata = _get_strata(codes, n_strata=4)
+    perm = _permutation(np.random.default_rng(0), len(codes), strata)
+
+    assert len(strata) == 4
+    np.testing.assert_array_equal(np.concatenate(strata), [1, 5, 0, 3, 6, 7, 4])
+    np.testing.assert_array_equal(codes[perm], codes)
+    assert perm[2] == 2
+
+
 @pytest.mark.parametrize("mode", ["moran", "geary"])
 @pytest.mark.parametrize("n_jobs", [1, 2])
 def test_spatial_autocorr_reproducibility(dummy_adata: AnnData, n_jobs: int, mode: str):
@@ -111,6 +191,25 @@ def test_co_occurrence_reproducibility(adata: AnnData, n_jobs: int, n_splits: in
     np.testing.assert_allclose(arr_1, arr_2)
 
 
+def test_co_occurrence_pairwise(adata: AnnData):
+    """Check co_occurrence against the counts of the pairwise distances."""
+    arr, interval = co_occurrence(adata, cluster_key="leiden", copy=True, interval=10)
+
+    dist = np.linalg.norm(adata.obsm[Key.obsm.spatial][:, None] - adata.obsm[Key.obsm.spatial][None], axis=-1)
+    labs = adata.obs["leiden"].cat.codes.values
+    n_labs = len(adata.obs["leiden"].cat.categories)
+    interval = interval.astype(np.float64)
+    for i in range(len(interval) - 1):
+        x, y = np.nonzero((dist > interval[i]) & (dist <= interval[i + 1]))
+        counts = np.zeros((n_labs, n_labs))
+        np.add.at(counts, (labs[x], labs[y]), 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            probs = counts.sum(axis=1) / counts.sum()
+            expected = counts / counts.sum(axis=1, keepdims=True) / probs[None, :]
+
+        np.testing.assert_allclose(arr[:, :, i], expected, rtol=1e-4)
+
+
 @pytest.mark.parametrize("size", [1, 3])
 def test_co_occurrence_explicit_interval(adata: AnnData, size: int):
     minn, maxx = _find_min_max(adata.obsm[Key.obsm.spatial])
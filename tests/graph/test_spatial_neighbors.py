@@ -1,13 +1,17 @@
-from typing import Tuple
+from typing import Tuple, Optional
 import pytest
 
 from anndata import AnnData
 import anndata as ad
 
 from scipy.sparse import isspmatrix_csr
+from scipy.spatial.distance import cdist
+from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
+import pandas as pd
 
-from squidpy.gr import spatial_neighbors
+from squidpy.gr import spatial_neighbors, update_spatial_neighbors
+from squidpy.gr._build import _build_connectivity, _update_spatial_neighbors
 from squidpy._constants._pkg_constants import Key
 
 
@@ -183,3 +187,310 @@ class TestSpatialNeighbors:
         assert Key.obsp.spatial_dist() not in non_visium_adata.obsp
         np.testing.assert_allclose(dist.A, self._gt_ddist)
         np.testing.assert_allclose(conn.A, self._gt_dgraph)
+
+    @pytest.mark.parametrize("radius", [None, 5.0, (1.0, 4.0)])
+    @pytest.mark.parametrize("dtype", [np.float32, np.float64])
+    def test_csr_structure(self, non_visium_adata: AnnData, radius: Optional[float], dtype: type):
+        coords = non_visium_adata.obsm[Key.obsm.spatial]
+        conn, dist = _build_connectivity(
+            coords, n_neighs=3, radius=radius, set_diag=True, return_distance=True, dtype=dtype
+        )
+
+        assert conn.dtype == dtype
+        assert dist.dtype == dtype
+        assert conn.indices.dtype == np.int32
+        assert conn.has_sorted_indices
+        assert np.shares_memory(conn.indices, dist.indices)
+        assert np.shares_memory(conn.indptr, dist.indptr)
+        np.testing.assert_array_equal(conn.diagonal(), 1.0)
+        np.testing.assert_array_equal(dist.diagonal(), 0.0)
+
+    @pytest.mark.parametrize(
+        "kwargs",
+        [
+            {"coord_type": "grid", "n_rings": 2},
+            {"coord_type": "generic", "delaunay": True, "transform": "spectral"},
+            {"coord_type": "generic", "radius": 5.0, "library_key": "library_id"},
+            {"coord_type": "generic", "max_memory": 0.05},
+            {"coord_type": "generic", "radius": 5.0, "section_key": "library_id"},
+        ],
+    )
+    def test_dtype(self, kwargs: dict):
+        rng = np.random.RandomState(42)
+        adata = AnnData(np.zeros((200, 1)), obsm={Key.obsm.spatial: rng.uniform(0, 30, size=(200, 2))}, dtype=float)
+        adata.obs["library_id"] = pd.Categorical(rng.choice(["a", "b"], size=adata.n_obs))
+
+        spatial_neighbors(adata, dtype=np.float32, **kwargs)
+        conn, dist = spatial_neighbors(adata, copy=True, **kwargs)
+
+        assert adata.obsp[Key.obsp.spatial_conn()].dtype == np.float32
+        assert adata.obsp[Key.obsp.spatial_dist()].dtype == np.float32
+        np.testing.assert_allclose(adata.obsp[Key.obsp.spatial_conn()].A, conn.A, rtol=1e-6)
+        np.testing.assert_allclose(adata.obsp[Key.obsp.spatial_dist()].A, dist.A, rtol=1e-6)
+
+    def test_dtype_invalid(self, non_visium_adata: AnnData):
+        with pytest.raises(TypeError, match=r"floating point"):
+            spatial_neighbors(non_visium_adata, coord_type="generic", dtype=np.int32)
+
+    @pytest.mark.parametrize("percentile", [0.0, 50.0, 99.0, 100.0])
+    def test_delaunay_percentile(self, non_visium_adata: AnnData, percentile: float):
+        gt_ddist = self._gt_ddist.copy()
+        gt_dgraph = self._gt_dgraph.copy()
+
+        mask = gt_ddist > np.percentile(gt_ddist[gt_ddist > 0], percentile)
+        gt_ddist[mask] = 0.0
+        gt_dgraph[mask] = 0.0
+
+        spatial_neighbors(non_visium_adata, delaunay=True, coord_type="generic", percentile=percentile)
+        spatial_dist = non_visium_adata.obsp[Key.obsp.spatial_dist()].A
+        spatial_graph = non_visium_adata.obsp[Key.obsp.spatial_conn()].A
+
+        np.testing.assert_allclose(spatial_graph, gt_dgraph)
+        np.testing.assert_allclose(spatial_dist, gt_ddist)
+
+    @pytest.mark.parametrize("n_jobs", [1, 2])
+    def test_library_key_shuffled(self, non_visium_adata: AnnData, n_jobs: int):
+        adata_concat, _, _ = TestSpatialNeighbors._adata_concat(non_visium_adata, non_visium_adata.copy())
+        perm = np.random.RandomState(42).permutation(adata_concat.n_obs)
+        adata_shuffled = adata_concat[perm].copy()
+
+        conn, dist = spatial_neighbors(
+            adata_concat, library_key="library_id", delaunay=True, coord_type="generic", copy=True, n_jobs=n_jobs
+        )
+        conn_shuffled, dist_shuffled = spatial_neighbors(
+            adata_shuffled, library_key="library_id", delaunay=True, coord_type="generic", copy=True, n_jobs=n_jobs
+        )
+
+        assert conn_shuffled.has_sorted_indices
+        np.testing.assert_array_equal(conn_shuffled.A, conn[perm][:, perm].A)
+        np.testing.assert_allclose(dist_shuffled.A, dist[perm][:, perm].A)
+        np.testing.assert_array_equal(conn[:4, :4].A, self._gt_dgraph)
+        np.testing.assert_array_equal(conn[:4, 4:].A, 0.0)
+
+    @pytest.mark.parametrize("n_jobs", [1, 2])
+    def test_library_key_nan(self, n_jobs: int):
+        rng = np.random.RandomState(42)
+        adata = AnnData(np.zeros((300, 1)), obsm={Key.obsm.spatial: rng.uniform(0, 30, size=(300, 2))}, dtype=float)
+        libs = rng.choice(["a", "b", "c"], size=adata.n_obs).astype(object)
+        libs[rng.choice(adata.n_obs, size=30, replace=False)] = np.nan
+        adata.obs["library_id"] = pd.Categorical(libs, categories=["a", "b", "c"])
+
+        conn, dist = spatial_neighbors(
+            adata, library_key="library_id", coord_type="generic", radius=5.0, copy=True, n_jobs=n_jobs
+        )
+
+        nan = adata.obs["library_id"].isna().values
+        assert conn[nan].nnz == 0
+        assert conn[:, nan].nnz == 0
+        for lib in ["a", "b", "c"]:
+            mask = (adata.obs["library_id"] == lib).values
+            conn_lib, dist_lib = spatial_neighbors(adata[mask], coord_type="generic", radius=5.0, copy=True)
+
+            assert conn[mask].nnz == conn_lib.nnz > 0
+            np.testing.assert_array_equal(conn[mask][:, mask].A, conn_lib.A)
+            np.testing.assert_allclose(dist[mask][:, mask].A, dist_lib.A)
+
+    @pytest.mark.parametrize("n_rings", [2, 4, 8])
+    def test_grid_rings_distance(self, n_rings: int):
+        coords = np.stack(np.meshgrid(np.arange(12), np.arange(10)), axis=-1).reshape(-1, 2)
+        adata = AnnData(np.zeros((coords.shape[0], 1)), obsm={Key.obsm.spatial: coords}, dtype=np.float64)
+        manhattan = np.abs(coords[:, None, :] - coords[None, :, :]).sum(-1).astype(float)
+        manhattan[manhattan > n_rings] = 0.0
+
+        conn, dist = spatial_neighbors(adata, n_neighs=4, n_rings=n_rings, coord_type="grid", copy=True)
+
+        np.testing.assert_array_equal(dist.A, manhattan)
+        np.testing.assert_array_equal(conn.A, manhattan > 0)
+
+    @pytest.mark.parametrize("set_diag", [False, True])
+    @pytest.mark.parametrize("radius", [None, 5.0, (2.0, 6.0)])
+    def test_tiled(self, tmp_path, radius: Optional[float], set_diag: bool):
+        coords = np.random.RandomState(42).uniform(0, 100, size=(2000, 2))
+        adata = AnnData(np.zeros((coords.shape[0], 1)), obsm={Key.obsm.spatial: coords}, dtype=np.float64)
+
+        conn, dist = spatial_neighbors(
+            adata, coord_type="generic", n_neighs=8, radius=radius, set_diag=set_diag, copy=True
+        )
+        conn_tiled, dist_tiled = spatial_neighbors(
+            adata,
+            coord_type="generic",
+            n_neighs=8,
+            radius=radius,
+            set_diag=set_diag,
+            copy=True,
+            max_memory=0.05,
+            store=tmp_path,
+        )
+
+        assert (tmp_path / "indices.npy").is_file()
+        np.testing.assert_array_equal(conn_tiled.indptr, conn.indptr)
+        np.testing.assert_array_equal(conn_tiled.indices, conn.indices)
+        np.testing.assert_array_equal(conn_tiled.data, conn.data)
+        np.testing.assert_allclose(dist_tiled.data, dist.data)
+
+    def test_tiled_not_implemented(self, non_visium_adata: AnnData):
+        with pytest.raises(NotImplementedError, match=r"Tiled graph creation"):
+            spatial_neighbors(non_visium_adata, coord_type="generic", delaunay=True, max_memory=1)
+
+    @pytest.mark.parametrize("set_diag", [False, True])
+    @pytest.mark.parametrize("radius", [None, 5.0, (2.0, 6.0)])
+    def test_update(self, radius: Optional[float], set_diag: bool):
+        rng = np.random.RandomState(42)
+        coords, new_coords = rng.uniform(0, 100, size=(2000, 2)), rng.uniform(0, 30, size=(50, 2))
+        removed = rng.choice(len(coords), size=100, replace=False)
+        kwargs = {"n_neighs": 8, "radius": radius, "set_diag": set_diag}
+
+        conn, dist = _build_connectivity(coords, return_distance=True, **kwargs)
+        conn_upd, dist_upd = _update_spatial_neighbors(conn, dist, coords, new_coords, removed, **kwargs)
+
+        keep = np.ones((len(coords),), dtype=bool)
+        keep[removed] = False
+        conn, dist = _build_connectivity(np.concatenate([coords[keep], new_coords]), return_distance=True, **kwargs)
+        np.testing.assert_array_equal(conn_upd.indptr, conn.indptr)
+        np.testing.assert_array_equal(conn_upd.indices, conn.indices)
+        np.testing.assert_array_equal(conn_upd.data, conn.data)
+        np.testing.assert_allclose(dist_upd.data, dist.data)
+
+    @pytest.mark.parametrize("store_index", [False, True])
+    @pytest.mark.parametrize("radius", [None, 5.0])
+    def test_update_adata(self, radius: Optional[float], store_index: bool):
+        rng = np.random.RandomState(42)
+        adata = AnnData(np.zeros((500, 1)), obsm={Key.obsm.spatial: rng.uniform(0, 50, size=(500, 2))}, dtype=float)
+        added = AnnData(np.ones((20, 1)), obsm={Key.obsm.spatial: rng.uniform(0, 10, size=(20, 2))}, dtype=float)
+        removed = rng.choice(adata.n_obs, size=30, replace=False)
+        kwargs = {"coord_type": "generic", "n_neighs": 4, "radius": radius, "set_diag": True}
+        spatial_neighbors(adata, store_index=store_index, **kwargs)
+
+        res = update_spatial_neighbors(adata, added, removed=removed)
+        conn, dist = spatial_neighbors(res, copy=True, **kwargs)
+
+        assert res.n_obs == adata.n_obs - len(removed) + added.n_obs
+        assert Key.uns.spatial_index(Key.obsm.spatial) not in res.uns
+        np.testing.assert_array_equal(res.X[-added.n_obs :], 1.0)
+        np.testing.assert_array_equal(res.obsp[Key.obsp.spatial_conn()].A, conn.A)
+        np.testing.assert_allclose(res.obsp[Key.obsp.spatial_dist()].A, dist.A)
+
+    def test_update_adata_invalid(self, non_visium_adata: AnnData):
+        with pytest.raises(KeyError, match=r"spatial_neighbors"):
+            update_spatial_neighbors(non_visium_adata)
+        spatial_neighbors(non_visium_adata, coord_type="generic", delaunay=True)
+        with pytest.raises(NotImplementedError, match=r"Updating the graph"):
+            update_spatial_neighbors(non_visium_adata, removed=[0])
+
+    @pytest.mark.parametrize("library_key", [None, "library_id"])
+    @pytest.mark.parametrize(("key", "values"), [("radii", [2.0, 5.0, 3.0]), ("n_neighs", [4, 10, 6])])
+    def test_multiple_scales(self, key: str, values: list, library_key: Optional[str]):
+        rng = np.random.RandomState(42)
+        adata = AnnData(np.zeros((600, 1)), obsm={Key.obsm.spatial: rng.uniform(0, 30, size=(600, 2))}, dtype=float)
+        adata.obs["library_id"] = pd.Categorical(rng.choice(["a", "b", "c"], size=adata.n_obs))
+        kwargs = {"coord_type": "generic", "library_key": library_key, "set_diag": True}
+
+        spatial_neighbors(adata, **kwargs, **{key: values})
+        for value in values:
+            conn, dist = spatial_neighbors(adata, copy=True, **kwargs, **{"radius" if key == "radii" else key: value})
+            params = adata.uns[f"spatial_{value}_neighbors"]["params"]
+
+            assert params["radius" if key == "radii" else "n_neighbors"] == value
+            np.testing.assert_array_equal(adata.obsp[f"spatial_{value}_connectivities"].A, conn.A)
+            np.testing.assert_array_equal(adata.obsp[f"spatial_{value}_distances"].A, dist.A)
+
+    def test_multiple_scales_invalid(self, non_visium_adata: AnnData):
+        with pytest.raises(ValueError, match=r"only one of"):
+            spatial_neighbors(non_visium_adata, coord_type="generic", n_neighs=[1, 2], radii=[1.0, 2.0])
+        with pytest.raises(ValueError, match=r"only one of"):
+            spatial_neighbors(non_visium_adata, coord_type="generic", radius=1.0, radii=[1.0, 2.0])
+        with pytest.raises(NotImplementedError, match=r"multiple"):
+            spatial_neighbors(non_visium_adata, coord_type="generic", radii=[1.0, 2.0], delaunay=True)
+
+    def test_radius_list_interval(self, non_visium_adata: AnnData):
+        conn, dist = spatial_neighbors(non_visium_adata, coord_type="generic", radius=[2.0, 5.0], copy=True)
+        conn_t, dist_t = spatial_neighbors(non_visium_adata, coord_type="generic", radius=(2.0, 5.0), copy=True)
+
+        np.testing.assert_array_equal(conn.A, conn_t.A)
+        np.testing.assert_array_equal(dist.A, dist_t.A)
+
+    @pytest.mark.parametrize("transform", ["spectral", "cosine", "row"])
+    def test_transform(self, non_visium_adata: AnnData, transform: str):
+        conn, _ = spatial_neighbors(non_visium_adata, coord_type="generic", n_neighs=2, copy=True)
+        conn_t, _ = spatial_neighbors(
+            non_visium_adata, coord_type="generic", n_neighs=2, transform=transform, copy=True
+        )
+        conn = conn.A
+
+        if transform == "spectral":
+            degrees = 1.0 / np.sqrt(conn.sum(axis=0))
+            expected = conn * degrees[:, np.newaxis] * degrees[np.newaxis, :]
+        elif transform == "cosine":
+            expected = cosine_similarity(conn)
+        else:
+            row_sums = conn.sum(axis=1, keepdims=True)
+            expected = np.divide(conn, row_sums, out=np.zeros_like(conn), where=row_sums > 0)
+
+        assert isspmatrix_csr(conn_t)
+        np.testing.assert_allclose(conn_t.A, expected)
+
+    @pytest.mark.parametrize("set_diag", [False, True])
+    def test_sections(self, set_diag: bool):
+        rng = np.random.RandomState(42)
+        coords, sections = rng.uniform(0, 20, size=(500, 2)), rng.choice(["a", "b", "c", "d"], size=500)
+        adata = AnnData(np.zeros((500, 1)), obsm={Key.obsm.spatial: coords}, dtype=float)
+        adata.obs["section"] = pd.Categorical(sections)
+        offsets = {"a": 0.0, "b": 1.0, "c": 3.0, "d": 3.5}
+
+        conn, dist = spatial_neighbors(
+            adata,
+            radius=2.0,
+            section_key="section",
+            section_offsets=offsets,
+            z_radius=1.0,
+            set_diag=set_diag,
+            copy=True,
+        )
+
+        z = np.array([offsets[s] for s in sections])
+        dxy, dz = cdist(coords, coords), np.abs(z[:, np.newaxis] - z[np.newaxis, :])
+        expected = (dxy <= 2.0) & (dz <= 1.0)
+        np.fill_diagonal(expected, set_diag)
+
+        np.testing.assert_array_equal(conn.A.astype(bool), expected)
+        np.testing.assert_allclose(dist.A[expected], np.sqrt(dxy**2 + dz**2)[expected])
+
+    @pytest.mark.parametrize("set_diag", [False, True])
+    def test_sections_nan(self, set_diag: bool):
+        rng = np.random.RandomState(42)
+        coords, sections = rng.uniform(0, 20, size=(500, 2)), rng.choice(["a", "b", "c"], size=500).astype(object)
+        sections[rng.choice(500, size=50, replace=False)] = np.nan
+        adata = AnnData(np.zeros((500, 1)), obsm={Key.obsm.spatial: coords}, dtype=float)
+        adata.obs["section"] = pd.Categorical(sections, categories=["a", "b", "c"])
+        offsets = {"a": 0.0, "b": 1.0, "c": 3.0}
+
+        conn, dist = spatial_neighbors(
+            adata,
+            radius=2.0,
+            section_key="section",
+            section_offsets=offsets,
+            z_radius=1.0,
+            set_diag=set_diag,
+            copy=True,
+        )
+
+        nan = adata.obs["section"].isna().values
+        z = np.array([np.nan if n else offsets[s] for s, n in zip(sections, nan)])
+        dxy, dz = cdist(coords, coords), np.abs(z[:, np.newaxis] - z[np.newaxis, :])
+        expected = (dxy <= 2.0) & (dz <= 1.0)
+        np.fill_diagonal(expected, set_diag & ~nan)
+
+        assert conn[nan].nnz == 0
+        assert conn[:, nan].nnz == 0
+        for section in offsets:
+            mask = (adata.obs["section"] == section).values
+            assert conn[mask].nnz == expected[mask].sum() > 0
+        np.testing.assert_array_equal(conn.A.astype(bool), expected)
+        np.testing.assert_allclose(dist.A[expected], np.sqrt(dxy**2 + dz**2)[expected])
+
+    def test_sections_invalid(self, non_visium_adata: AnnData):
+        non_visium_adata.obs["section"] = pd.Categorical(["a", "a", "b", "b"])
+        with pytest.raises(NotImplementedError, match=r"across sections"):
+            spatial_neighbors(non_visium_adata, coord_type="generic", n_neighs=2, section_key="section")
+        with pytest.raises(ValueError, match=r"Expected `2` section offsets"):
+            spatial_neighbors(non_visium_adata, radius=1.0, section_key="section", section_offsets=[0.0])
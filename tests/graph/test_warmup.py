@@ -0,0 +1,51 @@
+from anndata import AnnData
+
+import numpy as np
+
+from squidpy.gr import ligrec, warmup
+from squidpy.gr._ligrec import _test
+
+
+def test_warmup():
+    df = warmup()
+
+    assert list(df.columns) == ["time", "cache_hits", "cache_misses"]
+    assert {"spatial_neighbors", "nhood_enrichment", "ligrec"} <= set(df.index)
+    assert np.all(df["time"] > 0)
+    assert np.all(df["cache_hits"] + df["cache_misses"] >= 0)
+
+    # everything is compiled or loaded by now
+    df = warmup()
+    np.testing.assert_array_equal(df["cache_hits"] + df["cache_misses"], 0)
+
+
+def test_ligrec_kernel_cached():
+    n_sigs = len(_test.signatures)
+    for n_cls in [3, 10]:
+        mean = np.ones((4, n_cls))
+        res = np.zeros((2, n_cls))
+        _test(
+            np.array([[0, 1], [2, 3]], dtype=np.uint32),
+            np.array([[c, c] for c in range(n_cls)], dtype=np.uint32),
+            np.zeros((n_cls, 4)),
+            mean,
+            mean > 0,
+            res,
+            np.zeros_like(res),
+            True,
+        )
+        np.testing.assert_array_equal(res, 0)
+
+    # the number of clusters doesn't require a new kernel
+    assert len(_test.signatures) - n_sigs <= 1
+    assert _test.stats.cache_path is not None
+
+
+def test_ligrec_single_signature(adata: AnnData, interactions):
+    kwargs = {"interactions": interactions, "n_perms": 5, "n_jobs": 1, "copy": True, "show_progress_bar": False}
+    ligrec(adata, "leiden", **kwargs)
+    n_sigs = len(_test.signatures)
+    ligrec(adata, "leiden", early_stopping=2, **kwargs)
+
+    # the arrays are normalized before the kernel, stopping early doesn't compile a new signature
+    assert len(_test.signatures) == n_sigs